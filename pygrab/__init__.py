@@ -1 +1,2 @@
-from .pygrab import *
\ No newline at end of file
+from .pygrab import *
+from .pygrab import __getattr__
@@ -0,0 +1,74 @@
+import threading as _threading
+
+class _Call():
+    def __init__(self, key):
+        self.key = key
+        self.done = _threading.Event()
+        self.result = None
+        self.error = None
+
+class Coalescer():
+    """
+    Lets concurrent identical requests share one in-flight fetch. The first caller for a key (the leader)
+    makes the request, every caller that arrives before it finishes waits for it and gets a copy of its response.
+    Disabled by default, see `pygrab.coalesce_settings()`.
+    """
+    enabled = False
+    __lock = _threading.Lock()
+    __in_flight = {}
+
+    @classmethod
+    def key(cls, method:str, url:str, headers:dict, proxy:str, *extra) -> tuple:
+        # Header names are case insensitive, their order doesn't change the request
+        headers = tuple(sorted((str(k).lower(), str(v)) for k, v in (headers or {}).items()))
+        return (method.upper(), url, headers, proxy) + extra
+
+    @classmethod
+    def claim(cls, key:tuple) -> tuple:
+        """Returns the call in flight for `key` and whether the caller is its leader (and must resolve it)."""
+        with cls.__lock:
+            call = cls.__in_flight.get(key)
+            if call is not None:
+                return call, False
+            call = _Call(key)
+            cls.__in_flight[key] = call
+            return call, True
+
+    @classmethod
+    def resolve(cls, call:_Call, result=None, error:BaseException=None) -> None:
+        """
+        Hands the leader's response (or error) to the waiting callers. Later callers start a new fetch.
+        Only the first resolution of a call counts, resolving it again does nothing.
+        """
+        with cls.__lock:
+            if call.done.is_set():
+                return
+            call.result = result
+            call.error = error
+            if cls.__in_flight.get(call.key) is call:
+                del cls.__in_flight[call.key]
+            call.done.set()
+
+    @classmethod
+    def wait(cls, call:_Call):
+        """Waits for the leader and returns a copy of its response, or raises its error."""
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        # Responses decompress themselves in place, so followers each get their own
+        return call.result.copy() if hasattr(call.result, 'copy') else call.result
+
+    @classmethod
+    def do(cls, key:tuple, fetch):
+        """Runs `fetch` unless an identical request is already in flight, in which case its response is shared."""
+        call, leader = cls.claim(key)
+        if not leader:
+            return cls.wait(call)
+        try:
+            result = fetch()
+        except BaseException as e:
+            cls.resolve(call, error=e)
+            raise
+        # The followers copy from their own response, so the leader can read its response while they do
+        cls.resolve(call, result=result.copy() if hasattr(result, 'copy') else result)
+        return result
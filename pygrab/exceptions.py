@@ -1,3 +1,7 @@
 class DependencyLoadError(Exception):
     """General exception that's raised when a dependency is loaded incorrectly."""
-    pass
\ No newline at end of file
+    pass
+
+class ProcessingError(Exception):
+    """Exception that's raised when a processing function fails in a worker process."""
+    pass
@@ -0,0 +1,217 @@
+from .pygrab import get_batch as _get_batch
+from pygrab_ll import HttpResponse, BatchSink
+import contextlib as _contextlib
+import itertools as _itertools
+import sqlite3 as _sqlite3
+import threading as _threading
+import time as _time
+import typing as _typing
+
+# States a url can be in
+_PENDING = 0
+_IN_FLIGHT = 1
+_DONE = 2
+_FAILED = 3
+
+class Frontier():
+    """
+    A work queue of urls kept in a sqlite database, so a crawl can be stopped or crash and pick up where it left off.
+
+    Urls are claimed in batches, fetched with `get_batch()` and marked done (or retried) once their batch
+    finishes, which is the checkpoint. Urls that were in flight when the process died are fetched again on
+    resume, urls that were done are never fetched again. Only one batch of urls is held in memory at a time.
+    """
+    def __init__(self, path:str, batch_size:int=1000, max_attempts:int=3):
+        """
+        Opens (or creates) the frontier stored at `path` and requeues urls left in flight by a previous run.
+
+        Parameters:
+            path (str): The sqlite database file the frontier is stored in.
+            batch_size (int, optional): The number of urls claimed and fetched at a time. Defaults to 1000.
+            max_attempts (int, optional): The number of times a url is tried before it's marked as failed. Defaults to 3.
+
+        Raises:
+            TypeError: If any of the arguments are not of the desired data type.
+            ValueError: If 'batch_size' or 'max_attempts' is not positive.
+        """
+        if not isinstance(path, str):
+            raise TypeError("Argument 'path' must be a str")
+        if not isinstance(batch_size, int) or not isinstance(max_attempts, int):
+            raise TypeError("Arguments 'batch_size' and 'max_attempts' must be ints")
+        if batch_size < 1 or max_attempts < 1:
+            raise ValueError("Arguments 'batch_size' and 'max_attempts' must be positive")
+
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.__stop = _threading.Event()
+        # Urls can be added from other threads while a crawl is running
+        self.__lock = _threading.Lock()
+        self.__conn = _sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        with self.__lock:
+            self.__conn.execute("PRAGMA journal_mode=WAL")
+            self.__conn.execute("PRAGMA synchronous=NORMAL")
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS frontier ("
+                "id INTEGER PRIMARY KEY, "
+                "url TEXT NOT NULL UNIQUE, "
+                "state INTEGER NOT NULL DEFAULT 0, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "status INTEGER, "
+                "updated REAL)"
+            )
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS frontier_state ON frontier (state, id)")
+            # Anything in flight was never finished by the last process
+            self.__conn.execute("UPDATE frontier SET state=? WHERE state=?", (_PENDING, _IN_FLIGHT))
+
+    def add(self, urls:_typing.Iterable[str], chunk_size:int=10000) -> int:
+        """
+        Queues urls that aren't already in the frontier. The iterable is consumed in chunks,
+        so it can be a generator over more urls than fit in memory. Safe to call while `run()` is going.
+
+        Parameters:
+            urls (Iterable[str]): The urls to queue.
+            chunk_size (int, optional): The number of urls inserted per transaction. Defaults to 10000.
+
+        Returns:
+            int: The number of urls that were new.
+        """
+        if isinstance(urls, str):
+            raise TypeError("Argument 'urls' must be an iterable of str, not a str")
+
+        urls = iter(urls)
+        added = 0
+        while True:
+            chunk = list(_itertools.islice(urls, chunk_size))
+            if not chunk:
+                return added
+            with self.__lock:
+                before = self.__conn.total_changes
+                with self.__transaction():
+                    self.__conn.executemany(
+                        "INSERT OR IGNORE INTO frontier (url, updated) VALUES (?, ?)",
+                        ((url, _time.time()) for url in chunk)
+                    )
+                added += self.__conn.total_changes - before
+
+    def run(
+        self,
+        handler:_typing.Callable[[str, HttpResponse], None]=None,
+        sink:BatchSink=None,
+        max_batches:int=None,
+        **kwargs
+    ) -> dict:
+        """
+        Fetches pending urls batch by batch until none are left, `stop()` is called or `max_batches` batches were run.
+
+        Parameters:
+            handler (callable, optional): Called with the url and response of every successful request, before its batch is checkpointed.
+                With `extract=`, it gets the extracted fields instead of the response.
+            sink (BatchSink, optional): Archive the responses into JSON-lines or WARC files instead of returning them to `handler`.
+            max_batches (int, optional): The maximum number of batches to run.
+            **kwargs: Arbitrary keyword arguments passed to `get_batch()`.
+
+        Returns:
+            dict: The number of urls in each state once the run is over.
+        """
+        if handler is not None and sink is not None:
+            raise ValueError("Arguments 'handler' and 'sink' can't be combined")
+
+        self.__stop.clear()
+        batches = 0
+        while not self.__stop.is_set() and (max_batches is None or batches < max_batches):
+            claimed = self.__claim(self.batch_size)
+            if not claimed:
+                break
+            ids, urls = zip(*claimed)
+
+            if sink is not None:
+                manifest = _get_batch(list(urls), sink=sink, ordered=True, **kwargs)
+                failed = set(manifest.failed)
+                self.__checkpoint([(row_id, url not in failed, None) for row_id, url in claimed])
+            else:
+                responses = _get_batch(list(urls), ordered=True, **kwargs)
+                if handler is not None:
+                    for url, res in zip(urls, responses):
+                        if res is not None:
+                            handler(url, res)
+                # Extracted fields carry no status code
+                self.__checkpoint([
+                    (row_id, res is not None, res.status_code if isinstance(res, HttpResponse) else None) 
+                    for row_id, res in zip(ids, responses)
+                ])
+            batches += 1
+        return self.stats()
+
+    def stop(self) -> None:
+        """Makes `run()` return once its current batch is checkpointed."""
+        self.__stop.set()
+
+    def stats(self) -> dict:
+        """Returns the number of urls that are pending, in flight, done and failed."""
+        with self.__lock:
+            rows = self.__conn.execute("SELECT state, COUNT(*) FROM frontier GROUP BY state").fetchall()
+        counts = dict(rows)
+        return {
+            'pending': counts.get(_PENDING, 0),
+            'in_flight': counts.get(_IN_FLIGHT, 0),
+            'done': counts.get(_DONE, 0),
+            'failed': counts.get(_FAILED, 0),
+        }
+
+    def retry_failed(self) -> int:
+        """Requeues every url that ran out of attempts. Returns the number of urls requeued."""
+        with self.__lock:
+            cur = self.__conn.execute(
+                "UPDATE frontier SET state=?, attempts=0 WHERE state=?", (_PENDING, _FAILED)
+            )
+        return cur.rowcount
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __claim(self, n:int) -> list:
+        with self.__lock, self.__transaction("BEGIN IMMEDIATE"):
+            claimed = self.__conn.execute(
+                "SELECT id, url FROM frontier WHERE state=? ORDER BY id LIMIT ?", (_PENDING, n)
+            ).fetchall()
+            self.__conn.executemany(
+                "UPDATE frontier SET state=?, updated=? WHERE id=?",
+                ((_IN_FLIGHT, _time.time(), row_id) for row_id, _ in claimed)
+            )
+        return claimed
+
+    def __checkpoint(self, results:list) -> None:
+        # results are (id, succeeded, status code) tuples, the status code isn't known for archived responses
+        now = _time.time()
+        with self.__lock, self.__transaction():
+            self.__conn.executemany(
+                "UPDATE frontier SET state=?, status=?, updated=? WHERE id=?",
+                ((_DONE, status, now, row_id) for row_id, ok, status in results if ok)
+            )
+            self.__conn.executemany(
+                "UPDATE frontier SET attempts=attempts+1, updated=?, "
+                "state=CASE WHEN attempts+1 >= ? THEN ? ELSE ? END WHERE id=?",
+                ((now, self.max_attempts, _FAILED, _PENDING, row_id) for row_id, ok, _ in results if not ok)
+            )
+
+    @_contextlib.contextmanager
+    def __transaction(self, begin:str="BEGIN"):
+        # The connection is in autocommit mode, so a failed transaction has to be rolled back by hand,
+        # otherwise every later one fails with "cannot start a transaction within a transaction"
+        self.__conn.execute(begin)
+        try:
+            yield
+            self.__conn.execute("COMMIT")
+        except BaseException:
+            # Some errors make sqlite roll back on its own
+            if self.__conn.in_transaction:
+                self.__conn.execute("ROLLBACK")
+            raise
@@ -1,19 +1,36 @@
 from .warning import Warning
 from .tor import Tor
-
-# Include this because pyppeteer is often a buggy library and will often crash on import
-# Switch to new library soon
-try:
-    from pyppeteer import launch as _launch
-    pyppeteer_working = True
-except Exception:
-    pyppeteer_working = False
-
+from .exceptions import DependencyLoadError
+from pygrab_ll import HttpResponse
 
 import asyncio as _asyncio
 import atexit as _atexit
-import nest_asyncio as _nest_asyncio
-_nest_asyncio.apply()
+import re as _re
+import threading as _threading
+import time as _time
+from collections import OrderedDict as _OrderedDict
+from urllib.parse import urlsplit as _urlsplit
+
+# None until the browser backend is first needed, then whether pyppeteer could be imported
+pyppeteer_working = None
+_launch = None
+
+
+# Markers of a page whose content only appears after client side rendering
+_EMPTY_ROOT = _re.compile(
+    r'<(div|main|app-root)[^>]*\bid\s*=\s*["\']?(root|app|__next|__nuxt|svelte|main)["\']?[^>]*>\s*</\1>',
+    _re.IGNORECASE
+)
+_NOSCRIPT_MARKER = _re.compile(
+    r'<noscript[^>]*>[^<]*(enable|requires?|turn on|need)[^<]*javascript',
+    _re.IGNORECASE
+)
+_NON_VISIBLE = _re.compile(r'<(script|style|noscript|template)[^>]*>.*?</\1>|<[^>]+>', _re.IGNORECASE | _re.DOTALL)
+_ID_SEGMENT = _re.compile(r'^(\d+|[0-9a-fA-F-]{8,}|[0-9a-zA-Z_-]{20,})$')
+
+# Headers describing the original payload, which no longer apply to a body that was
+# re-serialized (a rendered DOM) or decompressed (a body handed to pipeline workers)
+_PAYLOAD_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
 
 
 class js_scraper:
@@ -21,6 +38,87 @@ class js_scraper:
     browser_tor = None
     cleanup_registered = False
 
+    # Minimum amount of visible text a script driven page must have to be considered rendered
+    min_visible_text = 200
+
+    # (host, path pattern) -> whether pages matching it needed a browser to render,
+    # the least recently used route is forgotten past max_render_decisions
+    render_decisions = _OrderedDict()
+    max_render_decisions = 1024
+    render_decisions_lock = _threading.Lock()
+
+    @classmethod
+    def route_key(cls, url:str) -> tuple:
+        parts = _urlsplit(url)
+        segments = ['*' if _ID_SEGMENT.match(seg) else seg for seg in parts.path.split('/') if seg]
+        return (parts.netloc.lower(), '/' + '/'.join(segments))
+
+    @classmethod
+    def cached_render_decision(cls, url:str) -> bool:
+        key = cls.route_key(url)
+        with cls.render_decisions_lock:
+            if key not in cls.render_decisions:
+                return False
+            cls.render_decisions.move_to_end(key)
+            return cls.render_decisions[key]
+
+    @classmethod
+    def needs_render(cls, url:str, response, predicate=None) -> bool:
+        """
+        Decides whether a natively fetched response has to be re-fetched through the browser.
+        A user supplied `predicate` takes precedence over the built in heuristic, and the
+        decision is remembered for every url that shares the host and path pattern.
+        Only successful (2xx) responses are judged, an error page says nothing about how its route renders.
+        """
+        if not 200 <= response.status_code < 300:
+            return False
+        if predicate is not None:
+            decision = bool(predicate(response))
+        else:
+            try:
+                decision = cls.__looks_unrendered(response.text)
+            except Exception:
+                decision = False
+        key = cls.route_key(url)
+        with cls.render_decisions_lock:
+            cls.render_decisions[key] = decision
+            cls.render_decisions.move_to_end(key)
+            while len(cls.render_decisions) > cls.max_render_decisions:
+                cls.render_decisions.popitem(last=False)
+        return decision
+
+    @classmethod
+    def __looks_unrendered(cls, html:str) -> bool:
+        if _EMPTY_ROOT.search(html):
+            return True
+        visible_text = ' '.join(_NON_VISIBLE.sub(' ', html).split())
+        if len(visible_text) >= cls.min_visible_text:
+            return False
+        return bool(_NOSCRIPT_MARKER.search(html)) or '<script' in html.lower()
+
+    @classmethod
+    def __load_browser_backend(cls) -> None:
+        """
+        Imports pyppeteer and patches asyncio the first time a page has to be rendered, 
+        so users that never render javascript don't pay for either.
+        """
+        global pyppeteer_working, _launch
+        if pyppeteer_working is not None:
+            return
+        # Include this because pyppeteer is often a buggy library and will often crash on import
+        # Switch to new library soon
+        try:
+            from pyppeteer import launch
+            _launch = launch
+            pyppeteer_working = True
+        except Exception:
+            pyppeteer_working = False
+            return
+
+        # pyppeteer_get runs its own event loop, which may be nested inside the caller's
+        import nest_asyncio as _nest_asyncio
+        _nest_asyncio.apply()
+
     @classmethod
     def __browser_cleanup(cls):
         if cls.browser_reg is not None:
@@ -56,51 +154,88 @@ class js_scraper:
         return await (cls.__get_browser_tor() if (use_tor) else cls.__get_browser_reg())
 
     @classmethod
-    async def __pyppeteer_kernel(cls, url, use_tor:bool=None, timeout:int=20):
+    async def __pyppeteer_kernel(cls, url, use_tor:bool=None, timeout:int=20) -> HttpResponse:
         browser = await cls.__get_browser(use_tor)
-        page = await browser.newPage()
-        try:
-            await page.goto(url, waitUntil='networkidle0', options={"timeout":timeout*1000})
-            html = await page.content()
-        finally:
-            await page.close()
-        return html
+        return await cls.get_page_content(browser, url, timeout)
 
     @classmethod
-    def pyppeteer_get(cls, url, use_tor:bool=None, timeout:int=20):
-        # Test it
+    def pyppeteer_get(cls, url, use_tor:bool=None, timeout:int=20) -> HttpResponse:
+        cls.__load_browser_backend()
         if not pyppeteer_working:
-            return None
+            raise DependencyLoadError("pyppeteer could not be imported, javascript rendering is unavailable.")
         loop = _asyncio.get_event_loop()
         result = loop.run_until_complete(cls.__pyppeteer_kernel(url, use_tor, timeout))
         return result
 
     @classmethod
-    async def get_page_content(cls, browser, url, timeout:int=20):
+    async def get_page_content(cls, browser, url, timeout:int=20) -> HttpResponse:
         page = await browser.newPage()
         try:
-            await page.goto(url, waitUntil='networkidle0', options={"timeout":timeout*1000})
+            start = _time.perf_counter()
+            main_doc = await page.goto(url, waitUntil='networkidle0', options={"timeout":timeout*1000})
             html = await page.content()
+            elapsed = _time.perf_counter() - start
+            final_url = page.url
         finally:
             await page.close()
-        return html
+
+        if main_doc is None:
+            raise RuntimeError(f"No main document response was received while rendering {url}")
+        headers = {str(k).lower(): str(v) for k, v in main_doc.headers.items() if str(k).lower() not in _PAYLOAD_HEADERS}
+        return HttpResponse(html.encode('utf-8'), main_doc.status, headers, final_url, elapsed)
 
     @classmethod
-    async def scrape_all(cls, urls, use_tor=None, timeout:int=20) -> dict:
+    async def scrape_all(cls, urls, use_tor=None, timeout:int=20, deadline:float=None, cancel=None, progress=None) -> dict:
+        """
+        Renders every url concurrently. Pages still loading once `deadline` seconds passed or `cancel` is
+        cancelled are closed and left out, as they are when the task running this is cancelled.
+        """
         browser = await cls.__get_browser(use_tor)
-        tasks = [cls.get_page_content(browser, url, timeout) for url in urls]
-        res = await _asyncio.gather(*tasks, return_exceptions=True)
+        tasks = [_asyncio.ensure_future(cls.get_page_content(browser, url, timeout)) for url in urls]
+        try:
+            await cls.__wait_all(tasks, deadline, cancel, progress)
+        finally:
+            # Cancelling a render closes its page
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await _asyncio.gather(*pending, return_exceptions=True)
 
         res_dict = {}
-        for i, url in zip(res, urls):
-            if isinstance(i, Exception):
-                Warning.raiseWarning(f"Waring: error for {url}: {i}")
+        for task, url in zip(tasks, urls):
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                Warning.raiseWarning(f"Waring: error for {url}: {task.exception()}")
             else:
-                res_dict[url] = i
+                res_dict[url] = task.result()
         return res_dict
 
     @classmethod
-    def pyppeteer_get_async(cls, urls, use_tor=None, timeout:int=20) -> dict:
+    async def __wait_all(cls, tasks, deadline:float=None, cancel=None, progress=None) -> None:
+        loop = _asyncio.get_running_loop()
+        end = None if deadline is None else loop.time() + deadline
+        pending = set(tasks)
+        while pending:
+            if cancel is not None and cancel.cancelled:
+                return
+            # The token can only be polled, so wake up regularly while it's set
+            wait = 0.1 if cancel is not None else None
+            if end is not None:
+                left = end - loop.time()
+                if left <= 0:
+                    return
+                wait = left if wait is None else min(wait, left)
+            done, pending = await _asyncio.wait(pending, timeout=wait, return_when=_asyncio.FIRST_COMPLETED)
+            if done and progress is not None:
+                finished = [task for task in tasks if task.done()]
+                rendered = [task.result() for task in finished if task.exception() is None]
+                progress(len(rendered), len(finished) - len(rendered), sum(len(res.raw_content()) for res in rendered))
+
+    @classmethod
+    def pyppeteer_get_async(cls, urls, use_tor=None, timeout:int=20, deadline:float=None, cancel=None, progress=None) -> dict:
+        cls.__load_browser_backend()
         if not pyppeteer_working:
-            return None
-        return _asyncio.run(cls.scrape_all(urls, use_tor=use_tor, timeout=timeout))
+            raise DependencyLoadError("pyppeteer could not be imported, javascript rendering is unavailable.")
+        return _asyncio.run(cls.scrape_all(urls, use_tor=use_tor, timeout=timeout, deadline=deadline, cancel=cancel, progress=progress))
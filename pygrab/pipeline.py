@@ -0,0 +1,219 @@
+from .pygrab import get_batch as _get_batch
+from .exceptions import ProcessingError
+from .js_scraper import _PAYLOAD_HEADERS
+from pygrab_ll import HttpResponse
+from multiprocessing import shared_memory as _shared_memory, resource_tracker as _resource_tracker
+import itertools as _itertools
+import multiprocessing as _multiprocessing
+import os as _os
+import pickle as _pickle
+import queue as _queue
+import threading as _threading
+import traceback as _traceback
+import typing as _typing
+
+def process_batch(
+    urls:_typing.Iterable[str],
+    process:_typing.Callable[[HttpResponse], _typing.Any],
+    workers:int=None,
+    ordered:bool=False,
+    batch_size:int=100,
+    queue_size:int=None,
+    **kwargs
+) -> _typing.Iterator[tuple]:
+    """
+    Fetches urls with `get_batch()` and runs `process` on every response in a pool of worker processes,
+    so CPU bound parsing isn't serialized by the GIL.
+
+    Urls are fetched `batch_size` at a time while the workers process earlier responses. Each body is copied
+    straight from the native response into a shared memory block the worker reads it from, so bodies are
+    never pickled. At most `queue_size` responses wait on the workers (or, when `ordered`, for their turn)
+    at a time, fetching pauses until they catch up.
+
+    Parameters:
+        urls (Iterable[str]): The urls to fetch. Consumed lazily, so it can be a generator.
+        process (callable): Takes a response and returns a picklable result. Must be picklable itself
+            (a module level function) when processes are spawned rather than forked.
+        workers (int, optional): The number of worker processes. Defaults to the number of cores.
+        ordered (bool, optional): Yield the results in the order of `urls` instead of as they finish.
+            Results that finish early are held until their turn. Defaults to False.
+        batch_size (int, optional): The number of urls fetched by each `get_batch()` call. Defaults to 100.
+        queue_size (int, optional): The number of responses that can wait on the workers. Defaults to 4 per worker.
+        **kwargs: Arbitrary keyword arguments passed to `get_batch()`, such as `headers`, `timeout` or `enable_js`.
+
+    Returns:
+        Iterator[tuple]: `(url, result)` tuples. Failed requests are yielded as `(url, None)` without reaching `process`.
+
+    Raises:
+        TypeError: If any of the arguments are not of the desired data type.
+        ValueError: If a count is not positive, or `sink` or `extract` is passed to `get_batch()`.
+        ProcessingError: When iterating, if `process` raised or a worker process died.
+    """
+    if isinstance(urls, str):
+        raise TypeError("Argument 'urls' must be an iterable of str, not a str")
+    if not callable(process):
+        raise TypeError("Argument 'process' must be callable")
+    for name, value in (('workers', workers), ('batch_size', batch_size), ('queue_size', queue_size)):
+        if not (isinstance(value, int) or value is None):
+            raise TypeError(f"Argument '{name}' must be an int")
+        if value is not None and value < 1:
+            raise ValueError(f"Argument '{name}' must be positive")
+    if 'sink' in kwargs or 'extract' in kwargs:
+        raise ValueError("Arguments 'sink' and 'extract' can't be used in a pipeline")
+
+    workers = (_os.cpu_count() or 1) if workers is None else workers
+    queue_size = 4 * workers if queue_size is None else queue_size
+    return _Pipeline(urls, process, workers, ordered, batch_size, queue_size, kwargs).run()
+
+class _Pipeline():
+    def __init__(self, urls, process, workers:int, ordered:bool, batch_size:int, queue_size:int, kwargs:dict):
+        self.urls = iter(urls)
+        self.process = process
+        self.workers = workers
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+
+        self.context = _multiprocessing.get_context()
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        # A slot is taken for every shared memory block, it's given back once the block's result is in,
+        # or once it's yielded when ordered so results held for their turn are bounded too
+        self.slots = _threading.BoundedSemaphore(queue_size)
+        # Blocks are owned by the parent, which unlinks them once their result is in
+        self.blocks = {}
+        self.stop = _threading.Event()
+        # Set by the feeder once every url was sent, or if fetching failed
+        self.total = None
+        self.error = None
+
+    def run(self) -> _typing.Iterator[tuple]:
+        # Workers share the parent's resource tracker, so a block attached to in a worker is still only unlinked once
+        _resource_tracker.ensure_running()
+        # Workers are started before the feeder thread, so forking never copies a thread mid-request
+        procs = [
+            self.context.Process(target=_work, args=(self.process, self.tasks, self.results), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for proc in procs:
+            proc.start()
+        feeder = _threading.Thread(target=self.__feed, daemon=True)
+        feeder.start()
+
+        finished = False
+        try:
+            yield from self.__collect(procs)
+            finished = True
+        finally:
+            self.stop.set()
+            feeder.join()
+            if finished:
+                for _ in procs:
+                    self.tasks.put(None)
+                for proc in procs:
+                    proc.join()
+            else:
+                # The caller stopped early or something failed, the queued work is dropped
+                for proc in procs:
+                    proc.terminate()
+                    proc.join()
+            for block in self.blocks.values():
+                block.close()
+                block.unlink()
+            self.blocks.clear()
+
+    def __collect(self, procs:list) -> _typing.Iterator[tuple]:
+        received = 0
+        next_index = 0
+        held = {}
+        while self.total is None or received < self.total:
+            try:
+                index, url, payload, error = self.results.get(timeout=0.1)
+            except _queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                for proc in procs:
+                    if not proc.is_alive():
+                        raise ProcessingError(f"A worker process exited with code {proc.exitcode}")
+                continue
+
+            received += 1
+            block = self.blocks.pop(index, None)
+            if block is not None:
+                block.close()
+                block.unlink()
+                if not self.ordered:
+                    self.slots.release()
+            if error is not None:
+                raise ProcessingError(f"`process` failed for {url}:\n{error}")
+
+            item = (url, None if payload is None else _pickle.loads(payload))
+            if not self.ordered:
+                yield item
+                continue
+            held[index] = (item, block is not None)
+            while next_index in held:
+                item, has_slot = held.pop(next_index)
+                if has_slot:
+                    self.slots.release()
+                yield item
+                next_index += 1
+
+    def __feed(self) -> None:
+        index = 0
+        try:
+            while not self.stop.is_set():
+                chunk = list(_itertools.islice(self.urls, self.batch_size))
+                if not chunk:
+                    break
+                responses = _get_batch(chunk, ordered=True, **self.kwargs)
+                for url, res in zip(chunk, responses):
+                    if res is None or not self.__send(index, url, res):
+                        if self.stop.is_set():
+                            return
+                        # Failed requests don't go through the workers
+                        self.results.put((index, url, None, None))
+                    index += 1
+            self.total = index
+        except BaseException as e:
+            self.error = e
+
+    def __send(self, index:int, url:str, res:HttpResponse) -> bool:
+        while not self.slots.acquire(timeout=0.1):
+            if self.stop.is_set():
+                return False
+        try:
+            size = res.body_len()
+            # Zero sized blocks can't be created
+            block = _shared_memory.SharedMemory(create=True, size=max(size, 1))
+        except Exception:
+            # The body couldn't be decompressed, or is over the decompression limit
+            self.slots.release()
+            return False
+        res.copy_into(block.buf)
+        self.blocks[index] = block
+
+        headers = {k: v for k, v in res.headers.items() if k.lower() not in _PAYLOAD_HEADERS}
+        self.tasks.put((index, url, block.name, size, res.status_code, headers, res.url, res.elapsed))
+        return True
+
+def _work(process, tasks, results) -> None:
+    # Runs in the worker processes until it gets the None sentinel
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, url, name, size, status_code, headers, final_url, elapsed = task
+        try:
+            block = _shared_memory.SharedMemory(name=name)
+            view = block.buf[:size]
+            try:
+                res = HttpResponse.from_buffer(view, status_code, headers, final_url, elapsed)
+            finally:
+                view.release()
+                block.close()
+            # Pickled here so an unpicklable result is reported instead of getting lost in the queue
+            out = (index, url, _pickle.dumps(process(res)), None)
+        except Exception:
+            out = (index, url, None, _traceback.format_exc())
+        results.put(out)
@@ -10,32 +10,52 @@ Javascript-enabled sites, and local requests.
 """
 
 # Local modules
+# The browser (js_scraper), requests based Session, sqlite backed Frontier and multiprocessing pipeline subsystems 
+# are heavy to import, so they are only loaded the first time they are used.
 from .tor import Tor
-from .session import Session
-from .js_scraper import js_scraper as _js_scraper
 from .warning import Warning as _Warning
-from pygrab_ll import ThreadSessionRs, HttpResponse
+from .coalesce import Coalescer as _Coalescer
+from pygrab_ll import ThreadSessionRs, HttpResponse, BatchSink, SinkManifest, TimeoutPolicy, ProxyPool, CancelToken, host_latency
+from pygrab_ll import set_max_decompressed_size as _set_max_decompressed_size, set_timeout_policy as _set_timeout_policy
 
 # Libraries
 import re as _re
-import asyncio as _asyncio
+import os as _os
+import time as _time
 import typing as _typing
 
+# Public names that are imported on first access, mapped to the module that defines them
+_LAZY_ATTRIBUTES = {
+    'Session': '.session',
+    'Frontier': '.frontier',
+    'process_batch': '.pipeline',
+}
+
+def __getattr__(name:str):
+    if name in _LAZY_ATTRIBUTES:
+        import importlib as _importlib
+        module = _importlib.import_module(_LAZY_ATTRIBUTES[name], __package__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 __DEFAULT_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.150 Safari/537.36",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
     "Accept-Language": "en-US,en;q=0.9",
-    "Accept-Encoding": "gzip, br",
+    "Accept-Encoding": "gzip, deflate, br, zstd",
     "Upgrade-Insecure-Requests": "1",
     "Cache-Control": "max-age=0",
 }
 
 def get(
     url:str, 
-    enable_js:bool=False, 
+    enable_js:_typing.Union[bool, str]=False, 
     timeout:int=None, 
     override_default_headers:bool=False, 
     params:dict=None, 
+    js_predicate:_typing.Callable[[HttpResponse], bool]=None,
     **kwargs
 ) -> HttpResponse: 
     """
@@ -43,9 +63,12 @@ def get(
 
     Parameters:
         url (str): The URL to get.
-        enable_js (bool, optional): Whether to use a headless browser to scrape a url.
+        enable_js (bool | str, optional): Whether to use a headless browser to scrape a url. 
+            Pass 'auto' to fetch natively first and only render the page if it needs javascript.
         timeout (int, optional): The timeout in number of seconds
         params (dict, optional): The query parameters to append to the URL
+        js_predicate (callable, optional): Used when `enable_js='auto'`. Takes the native response and 
+            returns True if the page must be rendered. Defaults to a heuristic that detects empty app roots.
         *args: Variable length argument list passed to requests.get.
         **kwargs: Arbitrary keyword arguments passed to requests.get.
 
@@ -58,11 +81,8 @@ def get(
     """
     if not (isinstance(url, str)):
         raise TypeError("Argument `url` must be a str")
-    if not (isinstance(enable_js, bool)):
-        raise TypeError("Argument `enable_js` must be a bool")
-
-    if timeout is None:
-        timeout = 20 if enable_js else 5
+    if not (isinstance(enable_js, bool) or enable_js == 'auto'):
+        raise TypeError("Argument `enable_js` must be a bool or 'auto'")
 
     if _re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(?::\d{1,5})?$', url):
         url = "http://" + url
@@ -70,28 +90,24 @@ def get(
     if any([url.startswith(i) for i in local_file_starts]):
         raise ValueError ("Url must start with http. use `get_local()` for local requests.")
 
-    # Handles rotating tor connections
-    Tor.increment_rotation_counter()
-    
     # Handle query params
     url = __append_query_params(url, params)
+    proxy = __set_proxy(kwargs)
+    headers = __set_headers(kwargs) if not override_default_headers else kwargs.get('headers', {})
 
-    # Handle Js enables requests
-    if enable_js:
-        res = _js_scraper.pyppeteer_get(url, timeout=timeout)
-        return HttpResponse([i for i in res.encode('utf-8')], 200, {})
-    else:
-        proxy = __set_proxy(kwargs)
-        headers = __set_headers(kwargs) if not override_default_headers else kwargs.get('headers', {})
-        client = ThreadSessionRs(timeout, headers, proxy)
-        return client.get(url)
+    if not _Coalescer.enabled:
+        return __get(url, enable_js, timeout, headers, proxy, js_predicate)
+    # Identical requests made while this one is in flight share its response
+    key = _Coalescer.key('GET', url, headers, proxy, enable_js)
+    return _Coalescer.do(key, lambda: __get(url, enable_js, timeout, headers, proxy, js_predicate))
 
 async def get_async(
     url:str, 
-    enable_js:bool=False, 
+    enable_js:_typing.Union[bool, str]=False, 
     timeout:int=None, 
     override_default_headers:bool=False, 
     params:dict=None, 
+    js_predicate:_typing.Callable[[HttpResponse], bool]=None,
     **kwargs
 ) -> HttpResponse: 
     """
@@ -99,10 +115,11 @@ async def get_async(
 
     Parameters:
         url (str): The URL to get.
-        enable_js (bool, optional): Whether to use a headless browser to scrape the URL.
+        enable_js (bool | str, optional): Whether to use a headless browser to scrape the URL, or 'auto'.
         timeout (int, optional): The timeout in number of seconds.
         override_default_headers (bool, optional): Whether to override default headers with custom headers.
         params (dict, optional): The query parameters to append to the URL.
+        js_predicate (callable, optional): Decides if a natively fetched page must be rendered when `enable_js='auto'`.
         **kwargs: Arbitrary keyword arguments passed to the synchronous `get` function.
 
     Returns:
@@ -112,62 +129,97 @@ async def get_async(
         TypeError: If any of the arguments are not of the desired data type.
         ValueError: If the user is trying to read a local file.
     """
-    return await _asyncio.to_thread(
+    return await __to_thread(
         get, 
         url=url, 
         enable_js=enable_js, 
         timeout=timeout, 
         override_default_headers=override_default_headers, 
         params=params, 
+        js_predicate=js_predicate,
         **kwargs
     )
 
 def get_batch(
     urls:list, 
-    enable_js:bool=False, 
+    enable_js:_typing.Union[bool, str]=False, 
     timeout:int=None, 
     params:list=None,
     thread_limit:int=None, 
     override_default_headers:bool=False, 
+    js_predicate:_typing.Callable[[HttpResponse], bool]=None,
+    ordered:bool=False,
+    dedupe:bool=False,
+    sink:BatchSink=None,
+    extract:dict=None,
+    deadline:float=None,
+    cancel:CancelToken=None,
+    progress:_typing.Callable[[int, int, int], None]=None,
     **kwargs
-) -> dict[str:HttpResponse]:
+) -> _typing.Union[dict, list, SinkManifest]:
 
     """
     Gets multiple URLs asynchronously.
 
     This function sends HTTP requests to a list of URLs in separate threads, allowing for concurrent HTTP requests.
-    The function returns a list of responses from the grabbed URLs. For each request that had a connection error,
-    a warning will be printed to the console.
+    By default the responses are returned in a dictionary keyed by URL, which means repeated URLs are only fetched once. 
+    Pass `ordered=True` to get a list of responses in the same order as `urls` instead. For each request that had a 
+    connection error, a warning will be printed to the console.
 
     Args:
         urls (list): A list of URLs to grab.
+        enable_js (bool | str, optional): Whether to use a headless browser to scrape the URLs. Pass 'auto' to
+            fetch every URL natively and only render the pages that need javascript.
         thread_limit (int, optional): The maximum number of threads that will be spawned. 
-        time_rest (float, optional): The time in seconds to wait between starting each thread. Defaults to 0.
-        *args: Variable length argument list to pass to the get function.
+        js_predicate (callable, optional): Decides if a natively fetched page must be rendered when `enable_js='auto'`.
+        ordered (bool, optional): Return a list of responses aligned with `urls`, with None for failed requests. Defaults to False.
+        dedupe (bool, optional): With `ordered=True`, fetch each distinct URL once and share its response between 
+            the positions it appears in. Otherwise every position is fetched. Defaults to False.
+        sink (BatchSink, optional): Archive the responses into JSON-lines or WARC files as they arrive instead of
+            returning them. Can't be combined with `enable_js`.
+        extract (dict, optional): Maps field names to CSS selector rules (`'sel'` for text, `'sel@attr'` for an attribute, 
+            `'@links'` or `'@meta'`). Pages are parsed natively and only the extracted fields are returned in place of 
+            each response. Can't be combined with `enable_js` or `sink`.
+        deadline (float, optional): The number of seconds the whole batch may take. Requests unfinished by then are 
+            abandoned and treated as failed.
+        cancel (CancelToken, optional): Stops the batch as soon as `cancel.cancel()` is called, from any thread. 
+            Requests unfinished by then are abandoned and treated as failed.
+        progress (callable, optional): Called with the number of completed and failed requests and the bytes received 
+            so far, at most twice a second and once more when the batch is over.
         **kwargs: Arbitrary keyword arguments to pass to the get function.
 
     Returns:
-        disc: A dictionary of responses with the grabbed URLs as keys and their respective responses as values.
+        dict | list | SinkManifest: A dictionary of responses with the grabbed URLs as keys and their respective responses as values,
+            a list of responses in the order of `urls` if `ordered` is True, or the manifest of the written files if `sink` is given.
     
     Raises:
         TypeError: If any of the arguments are not of the desired data type.
+        ValueError: If `sink` or `extract` is combined with `enable_js`, or with each other, or `deadline` is not positive.
+        KeyboardInterrupt: If Ctrl-C is pressed while the batch runs. Requests in flight are abandoned.
     """
     try:
         urls = list(urls)
     except Exception as e:
         raise TypeError(f"Argument 'urls' must be an iterable object: {e}")
-    if not (isinstance(enable_js, bool)):
-        raise TypeError("Argument 'enable_js' must be a bool")
+    if not (isinstance(enable_js, bool) or enable_js == 'auto'):
+        raise TypeError("Argument 'enable_js' must be a bool or 'auto'")
     if not (isinstance(thread_limit, (int)) or thread_limit is None):
         raise TypeError("Argument 'thread_limit' must be a int")
     if not (isinstance(timeout, (int, float)) or timeout is None):
         raise TypeError("Argument 'timeout' must be a int or float")
+    if not (isinstance(sink, BatchSink) or sink is None):
+        raise TypeError("Argument 'sink' must be a BatchSink")
+    if sink is not None and enable_js is not False:
+        raise ValueError("Rendered pages can't be written to a sink, `enable_js` must be False")
+    if not (isinstance(extract, dict) or extract is None):
+        raise TypeError("Argument 'extract' must be a dict")
+    if extract is not None and (enable_js is not False or sink is not None):
+        raise ValueError("Argument 'extract' can't be combined with `enable_js` or `sink`")
+    end = __batch_deadline(deadline, cancel, progress)
     
-    if thread_limit is None:
-        thread_limit = 30 if enable_js else 200
-    
-    if timeout is None:
-        timeout = int( (25 if enable_js else 8) * (1.75 if Tor.tor_status() else 1) )
+    tor_factor = 1.75 if Tor.tor_status() else 1
+    js_thread_limit = 30 if thread_limit is None else thread_limit
+    js_timeout = int(25 * tor_factor) if timeout is None else timeout
 
     # Handle query params
     if params is not None:
@@ -178,28 +230,98 @@ def get_batch(
                 raise ValueError("Arguments `urls` and `params` must be of the same length.")
             urls = [__append_query_params(url, param) for url, param in zip(urls, params)]
 
-    # remove repeats to prevent accidental DoS attacks
-    urls = list(dict.fromkeys(urls))
+    # remove repeats to prevent accidental DoS attacks, unless every position was explicitly asked for
+    unique_urls = list(dict.fromkeys(urls))
+    source_urls = urls if (ordered and not dedupe) else unique_urls
+
+    # Responses are archived by the worker threads and never become python objects
+    if sink is not None:
+        headers = __set_headers(kwargs) if not override_default_headers else kwargs.get('headers', {})
+        client = ThreadSessionRs(int(8 * tor_factor) if timeout is None else timeout, headers, __set_proxy(kwargs))
+        manifest = client.get_batch_to_sink(
+            source_urls, 200 if thread_limit is None else thread_limit, sink, _Warning.warning_settings, 
+            **__batch_control(end, cancel, progress)
+        )
+        Tor.increment_rotation_counter(len(source_urls))
+        return manifest
 
     # Handle async js enabled scraping
-    if enable_js:
+    if enable_js is True:
         # Don't increment the number of requests, but rotate connections if it's necessary
         Tor.increment_rotation_counter(0) 
-        result = {url:None for url in urls}
-        for thread_counter in range (0, len(urls), thread_limit):
-            curr_urls = urls[thread_counter:thread_counter+thread_limit]
-            if enable_js:
-                htmls:dict = _js_scraper.pyppeteer_get_async(curr_urls, timeout=timeout)
-                result.update( {k:HttpResponse([i for i in v.encode('utf-8')], 200, {}) for k,v in htmls.items()} )
-        Tor.increment_rotation_counter(len(urls))
-        return result
+        rendered = __js_get_batch(unique_urls, js_timeout, js_thread_limit, end, cancel, progress)
+        Tor.increment_rotation_counter(len(unique_urls))
+        if ordered:
+            return [rendered.get(url) for url in urls]
+        return {url:rendered.get(url) for url in unique_urls}
+
+    # Urls whose route is already known to need rendering skip the native fetch entirely
+    skip = set()
+    if enable_js == 'auto':
+        skip = {url for url in unique_urls if __js_scraper().cached_render_decision(url)}
+    fetch_urls = [url for url in source_urls if url not in skip] if skip else source_urls
 
     headers = __set_headers(kwargs) if not override_default_headers else kwargs.get('headers', {})
     proxy = __set_proxy(kwargs)
-    client = ThreadSessionRs(timeout, headers, proxy)
-    result = client.get_batch(urls, thread_limit, _Warning.warning_settings)
-    Tor.increment_rotation_counter(len(urls))
-    return result
+    client = ThreadSessionRs(int(8 * tor_factor) if timeout is None else timeout, headers, proxy)
+    control = __batch_control(end, cancel, progress)
+    if extract is not None:
+        responses = client.get_batch_extract(fetch_urls, 200 if thread_limit is None else thread_limit, extract, _Warning.warning_settings, **control)
+    elif _Coalescer.enabled:
+        responses = __coalesced_get_batch(client, fetch_urls, headers, proxy, 200 if thread_limit is None else thread_limit, control)
+    else:
+        responses = client.get_batch(fetch_urls, 200 if thread_limit is None else thread_limit, _Warning.warning_settings, **control)
+    Tor.increment_rotation_counter(len(fetch_urls))
+
+    rendered = {}
+    if enable_js == 'auto':
+        render_urls = list(skip) + [
+            url for url, res in zip(fetch_urls, responses) 
+            if res is not None and __js_scraper().needs_render(url, res, js_predicate)
+        ]
+        render_urls = list(dict.fromkeys(render_urls))
+        if render_urls:
+            Tor.increment_rotation_counter(0)
+            rendered = __js_get_batch(render_urls, js_timeout, js_thread_limit, end, cancel)
+            Tor.increment_rotation_counter(len(render_urls))
+
+    # Merge the rendered pages back in, falling back to the native response if a render failed
+    if skip or rendered:
+        native = iter(responses)
+        responses = [rendered.get(url, None if url in skip else next(native)) for url in source_urls]
+
+    if not ordered:
+        return {url:res for url, res in zip(source_urls, responses) if res is not None}
+    if dedupe:
+        by_url = dict(zip(source_urls, responses))
+        return [by_url[url] for url in urls]
+    return responses
+
+async def get_batch_async(urls:list, cancel:CancelToken=None, **kwargs) -> _typing.Union[dict, list, SinkManifest]:
+    """
+    Asynchronously gets multiple URLs using a separate thread. Cancelling the awaiting task cancels the batch,
+    so its worker threads stop instead of running to completion in the background.
+
+    Parameters:
+        urls (list): A list of URLs to grab.
+        cancel (CancelToken, optional): A token that can also cancel the batch. It is cancelled along with the task.
+        **kwargs: Arbitrary keyword arguments passed to `get_batch()`, such as `deadline` and `progress`.
+
+    Returns:
+        dict | list | SinkManifest: The result of `get_batch()`.
+
+    Raises:
+        TypeError: If any of the arguments are not of the desired data type.
+    """
+    import asyncio as _asyncio
+    if not (isinstance(cancel, CancelToken) or cancel is None):
+        raise TypeError("Argument 'cancel' must be a CancelToken")
+    token = CancelToken() if cancel is None else cancel
+    try:
+        return await __to_thread(get_batch, urls=urls, cancel=token, **kwargs)
+    except _asyncio.CancelledError:
+        token.cancel()
+        raise
 
 def get_local(filename:str, local_read_type:str='r', encoding:str='utf-8') -> str:
     """
@@ -274,9 +396,19 @@ async def download_async(url:str, local_filename:str, timeout:float=5) -> None:
         TypeError: If any of the arguments are not of the desired data type.
         ValueError: If 'local_filename' is specified but does not contain a file extension.
     """
-    return await _asyncio.to_thread(download, url=url, local_filename=local_filename, timeout=timeout)
+    return await __to_thread(download, url=url, local_filename=local_filename, timeout=timeout)
 
-def download_batch(urls:list, local_filenames:list=None, thread_limit:int=50, timeout:float=12.0, time_rest:float=0) -> None:
+def download_batch(
+    urls:list, 
+    local_filenames:list=None, 
+    thread_limit:int=50, 
+    timeout:float=12.0, 
+    time_rest:float=0, 
+    sink:BatchSink=None,
+    deadline:float=None,
+    cancel:CancelToken=None,
+    progress:_typing.Callable[[int, int, int], None]=None
+) -> _typing.Optional[SinkManifest]:
     """
     Executes multiple file downloads asynchronously from a list of given URLs and saves them locally.
 
@@ -287,14 +419,34 @@ def download_batch(urls:list, local_filenames:list=None, thread_limit:int=50, ti
         local_filename (list of str, optional): A list of names to be used when saving the files locally. If none is provided, the function uses the filename from each corresponding URL. Each filename must include a file extension if provided. Must be of same length as 'urls' if provided.
         thread_limit (int, optional): The maximum number of threads that will be spawned. 
         time_rest (int, optional): The amount of time to rest between the start of each download thread. Defaults to 0 seconds.
+        sink (BatchSink, optional): Archive the downloads into JSON-lines or WARC files instead of writing one file per URL. 
+            'local_filenames' is ignored when a sink is given.
+        deadline (float, optional): The number of seconds the whole batch may take. Downloads still running by then are 
+            aborted and their partial files removed.
+        cancel (CancelToken, optional): Stops the batch as soon as `cancel.cancel()` is called, from any thread.
+        progress (callable, optional): Called with the number of completed and failed downloads and the bytes received 
+            so far, at most twice a second and once more when the batch is over.
 
     Returns:
-        None
+        SinkManifest | None: The manifest of the written files if `sink` is given.
 
     Raises:
         TypeError: If any of the arguments are not of the desired data type.
         ValueError: If a 'local_filenames' is specified but does not contain a file extension.
+        KeyboardInterrupt: If Ctrl-C is pressed while the batch runs. Downloads in flight are aborted.
     """
+    end = __batch_deadline(deadline, cancel, progress)
+    if sink is not None:
+        if not isinstance(sink, BatchSink):
+            raise TypeError("Argument 'sink' must be a BatchSink")
+        if not (isinstance(timeout, (int, float))):
+            raise TypeError("Argument 'timeout' must be a int or float")
+        urls = list(dict.fromkeys(urls))
+        client = ThreadSessionRs(timeout, __set_headers({}), __set_proxy({}))
+        manifest = client.get_batch_to_sink(urls, thread_limit, sink, _Warning.warning_settings, **__batch_control(end, cancel, progress))
+        Tor.increment_rotation_counter(len(urls))
+        return manifest
+
     # Validate argument 
     if local_filenames is not None:
         if len(urls) != len(local_filenames):
@@ -314,7 +466,7 @@ def download_batch(urls:list, local_filenames:list=None, thread_limit:int=50, ti
 
     # Uses rust dependencies to asynchronously download files
     client = ThreadSessionRs(timeout, __set_headers({}), __set_proxy({}))
-    client.download_batch(urls, local_filenames, thread_limit, _Warning.warning_settings)
+    client.download_batch(urls, local_filenames, thread_limit, _Warning.warning_settings, **__batch_control(end, cancel, progress))
 
     # If tor rotations isn't None, then make this entire batch of requests with one connection
     # and then the connection to be changed on the next request
@@ -329,16 +481,27 @@ def head(url:str, params:dict=None, timeout:float=5, **kwargs) -> HttpResponse:
     client = ThreadSessionRs(timeout, headers, proxy)
     return client.head(url)
 
-def post(url:str, data=None, json:dict=None, params:dict=None, timeout:float=5, **kwargs) -> HttpResponse:
+def post(
+    url:str, 
+    data=None, 
+    json=None, 
+    params:dict=None, 
+    timeout:float=5, 
+    form:dict=None, 
+    files:dict=None, 
+    **kwargs
+) -> HttpResponse:
     """
     Sends a POST request to the specified URL.
 
     Parameters:
         url (str): The URL to send the POST request to.
-        data (str, dict, bytes, optional): The data to be sent in the body of the request. Can be a string, dictionary, or bytes.
-        json (dict, optional): A JSON object to be sent in the body of the request.
+        data (str, bytes, dict, list, optional): The data to be sent in the body of the request. Strings and bytes are sent as-is, dicts and lists are sent as JSON.
+        json (optional): Any JSON compatible object (dict, list, str, int, float, bool or None) to be serialized and sent as JSON.
         params (dict, optional): The query parameters to append to the URL.
         timeout (float, optional): The timeout in number of seconds.
+        form (dict, optional): Fields to send as an `application/x-www-form-urlencoded` body, or as the text fields of a multipart body if `files` is given.
+        files (dict, optional): Files to send as a `multipart/form-data` body. Maps field names to bytes, file objects, or `(filename, content[, content_type])` tuples.
         **kwargs: Arbitrary keyword arguments passed to requests.post.
 
     Returns:
@@ -356,28 +519,41 @@ def post(url:str, data=None, json:dict=None, params:dict=None, timeout:float=5,
     proxy = __set_proxy(kwargs)
     url = __append_query_params(url, params)
     client = ThreadSessionRs(timeout, headers, proxy)
-    if data is not None and isinstance(data, str):
-        data = data.encode('utf-8')
-        return client.post(url, data)
-    if json is not None and isinstance(json, dict):
-        json = {str(k): str(v) for k, v in json.items()}
+    if files is not None:
+        if form is None and isinstance(data, dict):
+            form = data
+        return client.post_multipart(url, __form_fields(form), __file_parts(files))
+    if form is not None:
+        return client.post_form(url, __form_fields(form))
+    if json is not None:
         return client.post_json(url, json)
-    if data is not None and isinstance(data, dict):
-        data = {str(k): str(v) for k, v in data.items()}
+    if data is None or isinstance(data, (str, bytes, bytearray)):
+        return client.post(url, data)
+    if isinstance(data, (dict, list)):
         return client.post_json(url, data)
-    if data is not None and isinstance(data, bytes):
-        return client.post(url, [i for i in data])
+    raise TypeError("Argument `data` must be a str, bytes, dict or list")
 
-async def post_async(url:str, data=None, json:dict=None, params:dict=None, timeout:float=5, **kwargs) -> HttpResponse:
+async def post_async(
+    url:str, 
+    data=None, 
+    json=None, 
+    params:dict=None, 
+    timeout:float=5, 
+    form:dict=None, 
+    files:dict=None, 
+    **kwargs
+) -> HttpResponse:
     """
     Asynchronously sends a POST request to the specified URL using a separate thread.
 
     Parameters:
         url (str): The URL to send the POST request to.
-        data (str, dict, bytes, optional): The data to be sent in the body of the request. Can be a string, dictionary, or bytes.
-        json (dict, optional): A JSON object to be sent in the body of the request.
+        data (str, bytes, dict, list, optional): The data to be sent in the body of the request. Strings and bytes are sent as-is, dicts and lists are sent as JSON.
+        json (optional): Any JSON compatible object to be serialized and sent as JSON.
         params (dict, optional): The query parameters to append to the URL.
         timeout (float, optional): The timeout in number of seconds.
+        form (dict, optional): Fields to send as a form encoded body.
+        files (dict, optional): Files to send as a multipart body.
         **kwargs: Arbitrary keyword arguments passed to requests.post.
 
     Returns:
@@ -387,24 +563,64 @@ async def post_async(url:str, data=None, json:dict=None, params:dict=None, timeo
         ValueError: If the URL is trying to create a local file.
         TypeError: If the data type of 'data', 'json', or 'params' is not supported.
     """
-    return await _asyncio.to_thread(post, url=url, data=data, json=json, params=params, timeout=timeout, **kwargs)
+    return await __to_thread(
+        post, 
+        url=url, 
+        data=data, 
+        json=json, 
+        params=params, 
+        timeout=timeout, 
+        form=form, 
+        files=files, 
+        **kwargs
+    )
+
+def post_batch(
+    urls:_typing.Union[list, str], 
+    data:list=None, 
+    json:list=None, 
+    timeout:float=5, 
+    thread_limit:int=200, 
+    **kwargs
+) -> list:
+    """
+    Sends multiple POST requests concurrently.
+
+    Each payload is encoded on its own, so a single batch may mix strings, bytes and JSON compatible objects.
+    JSON payloads are serialized natively by the worker threads. Every payload is sent, even when many of them
+    go to the same URL.
+
+    Parameters:
+        urls (list | str): The URLs to post to, or a single URL that every payload will be posted to.
+        data (list, optional): The payloads. Strings and bytes are sent as-is, any other object is sent as JSON.
+        json (list, optional): Payloads that are all serialized as JSON, including plain strings.
+        timeout (float, optional): The timeout in number of seconds.
+        thread_limit (int, optional): The maximum number of threads that will be spawned.
+
+    Returns:
+        list: The responses in the same order as the payloads, with None in place of the requests that failed.
+
+    Raises:
+        ValueError: If neither `data` or `json` is given, or if there is a different number of urls and payloads.
+    """
+    payloads = json if json is not None else data
+    if payloads is None:
+        raise ValueError("One of the arguments `data` or `json` must be specified.")
+    payloads = list(payloads)
+
+    if isinstance(urls, str):
+        urls = [urls for _ in range(len(payloads))]
+    if len(urls) != len(payloads):
+        raise ValueError("Arguments `urls` and `data` must be of the same length.")
 
-def post_batch(urls:list[str] | str, data:list[_typing.Any], timeout:float=5, **kwargs):
     Tor.increment_rotation_counter(len(urls))
     headers = __set_headers(kwargs)
     proxy = __set_proxy(kwargs)
     client = ThreadSessionRs(timeout, headers, proxy)
 
-    if isinstance(urls, str):
-        urls = [urls for _ in range(len(data))]
-
-    if isinstance(data[0], str):
-        data = [i.encode('utf-8') for i in data]
-        return client.post_batch(urls, data)
-    if isinstance(data[0], bytes):
-        return client.post_batch(urls, data)
-    if isinstance(data[0], dict):
-        return client.post_json_batch(urls, data)
+    if json is not None:
+        return client.post_json_batch(urls, payloads, thread_limit, _Warning.warning_settings)
+    return client.post_batch(urls, payloads, thread_limit, _Warning.warning_settings)
 
 def post_local(filepath:str, data:str, local_save_type:str="w", encoding:str='utf-8') -> None:
     """
@@ -424,16 +640,19 @@ def post_local(filepath:str, data:str, local_save_type:str="w", encoding:str='ut
     with open(filepath, local_save_type, encoding=encoding) as f:
         f.write(str(data))
 
-def put(url, data:str=None, timeout:float=5, **kwargs):
+def put(url, data=None, timeout:float=5, **kwargs):
     Tor.increment_rotation_counter()
     headers = __set_headers(kwargs)
     proxy = __set_proxy(kwargs)
     client = ThreadSessionRs(timeout, headers, proxy)
     return client.put(url, data)
 
-def patch(url, data=None, **kwargs):
-    raise NotImplementedError("Not yet implemented in rust backend")
+def patch(url, data=None, timeout:float=5, **kwargs):
     Tor.increment_rotation_counter()
+    headers = __set_headers(kwargs)
+    proxy = __set_proxy(kwargs)
+    client = ThreadSessionRs(timeout, headers, proxy)
+    return client.patch(url, data)
 
 def delete(url, timeout:float=5, **kwargs):
     Tor.increment_rotation_counter()
@@ -449,6 +668,61 @@ def options(url, timeout:float=5, **kwargs):
     client = ThreadSessionRs(timeout, headers, proxy)
     return client.options(url)
 
+def request_batch(
+    requests:list, 
+    thread_limit:int=200, 
+    timeout:float=None, 
+    override_default_headers:bool=False, 
+    deadline:float=None,
+    cancel:CancelToken=None,
+    progress:_typing.Callable[[int, int, int], None]=None,
+    **kwargs
+) -> dict:
+    """
+    Sends a list of requests with arbitrary HTTP methods concurrently.
+
+    Every request is a dict with the key `url` and optionally `method` (defaults to 'GET'), `headers`,
+    `params`, `data`, `json` and `timeout`. The requests run through the same thread pool as `get_batch`.
+
+    Parameters:
+        requests (list of dict): The requests to send.
+        thread_limit (int, optional): The maximum number of threads that will be spawned.
+        timeout (float, optional): The default timeout in number of seconds for requests that don't specify one.
+        override_default_headers (bool, optional): Whether to override default headers with custom headers.
+        deadline (float, optional): The number of seconds the whole batch may take, see `get_batch()`.
+        cancel (CancelToken, optional): Stops the batch as soon as `cancel.cancel()` is called, see `get_batch()`.
+        progress (callable, optional): Called with the number of completed and failed requests and the bytes received so far.
+        **kwargs: Arbitrary keyword arguments, such as `headers` shared by every request and `proxies`.
+
+    Returns:
+        dict: A dictionary of responses keyed by the index of their request in `requests`. Failed requests are left out.
+
+    Raises:
+        TypeError: If any of the arguments are not of the desired data type.
+        ValueError: If `deadline` is not positive.
+        KeyError: If a request is missing its `url`.
+        KeyboardInterrupt: If Ctrl-C is pressed while the batch runs. Requests in flight are abandoned.
+    """
+    if not isinstance(requests, (list, tuple)):
+        raise TypeError("Argument 'requests' must be a list of dicts")
+    if not (isinstance(thread_limit, int)):
+        raise TypeError("Argument 'thread_limit' must be a int")
+    if not (isinstance(timeout, (int, float)) or timeout is None):
+        raise TypeError("Argument 'timeout' must be a int or float")
+    end = __batch_deadline(deadline, cancel, progress)
+
+    if timeout is None:
+        timeout = int( 8 * (1.75 if Tor.tor_status() else 1) )
+
+    requests = [__prepare_request_spec(spec) for spec in requests]
+
+    headers = __set_headers(kwargs) if not override_default_headers else kwargs.get('headers', {})
+    proxy = __set_proxy(kwargs)
+    client = ThreadSessionRs(timeout, headers, proxy)
+    result = client.request_batch(requests, thread_limit, _Warning.warning_settings, **__batch_control(end, cancel, progress))
+    Tor.increment_rotation_counter(len(requests))
+    return result
+
 def display_public_status() -> None:
     connection_data = get('http://ip-api.com/json').json()
     print("Tor Service Enabled:  ", Tor.tor_status())
@@ -465,9 +739,171 @@ def warn_settings(warn: bool) -> True:
         raise TypeError("Argument 'warn' must be a bool")
     _Warning.warning_settings = warn
 
-def __set_proxy(kwargs) -> str:
+def decompress_settings(max_size:int=None) -> None:
+    """
+    Sets the largest size a response body may decompress to. Protects against 
+    decompression bombs, where a small compressed body inflates to gigabytes.
+
+    Parameters:
+        max_size (int, optional): The limit in bytes. None (the default) removes the limit.
+
+    Raises:
+        TypeError: If 'max_size' is not an int or None.
+        ValueError: If 'max_size' is not positive.
+    """
+    if max_size is not None and (not isinstance(max_size, int) or isinstance(max_size, bool)):
+        raise TypeError("Argument 'max_size' must be an int or None")
+    if max_size is not None and max_size < 1:
+        raise ValueError("Argument 'max_size' must be positive")
+    _set_max_decompressed_size(max_size)
+
+def timeout_settings(policy:TimeoutPolicy=None) -> None:
+    """
+    Sets the timeout policy of every request made afterwards. A policy separates the connect, read and 
+    total deadlines, can learn each host's deadline from its observed latency and can hedge stragglers 
+    with a duplicate request. 
+
+    Parameters:
+        policy (TimeoutPolicy, optional): The policy to use. None (the default) restores the plain `timeout` arguments.
+
+    Raises:
+        TypeError: If 'policy' is not a TimeoutPolicy or None.
+    """
+    if not (isinstance(policy, TimeoutPolicy) or policy is None):
+        raise TypeError("Argument 'policy' must be a TimeoutPolicy or None")
+    _set_timeout_policy(policy)
+
+def coalesce_settings(enabled: bool) -> None:
+    """
+    Enables or disables request coalescing for the entire library. While enabled, identical GET requests 
+    (same url, headers and proxy) made concurrently from `get()`, `get_async()` or `get_batch()` share 
+    one in-flight fetch and each caller gets its own copy of the response. Disabled by default.
+
+    Parameters:
+        enabled (bool): Whether to coalesce concurrent identical requests.
+
+    Raises:
+        TypeError: If 'enabled' is not a bool.
+    """
+    if not isinstance(enabled, bool):
+        raise TypeError("Argument 'enabled' must be a bool")
+    _Coalescer.enabled = enabled
+
+def __get(url:str, enable_js, timeout, headers:dict, proxy:str, js_predicate) -> HttpResponse:
+    # Handles rotating tor connections
+    Tor.increment_rotation_counter()
+
+    # Handle Js enables requests
+    if enable_js is True or (enable_js == 'auto' and __js_scraper().cached_render_decision(url)):
+        return __js_get(url, timeout)
+
+    client = ThreadSessionRs(5 if timeout is None else timeout, headers, proxy)
+    res = client.get(url)
+
+    # Only pay for the browser if the native response is missing its content
+    if enable_js == 'auto' and __js_scraper().needs_render(url, res, js_predicate):
+        return __js_get(url, timeout)
+    return res
+
+def __coalesced_get_batch(client:ThreadSessionRs, urls:list, headers:dict, proxy:str, thread_limit:int, control:dict) -> list:
+    # Only urls that no one else is fetching are requested, the rest wait on the request in flight
+    calls = {}
+    leading = []
+    for url in dict.fromkeys(urls):
+        calls[url], leader = _Coalescer.claim(_Coalescer.key('GET', url, headers, proxy, False))
+        if leader:
+            leading.append(url)
+
+    # Each url is handed to its waiting callers as soon as its response is in, not once the whole batch is.
+    # The callback gets its own response object, separate from the one returned here
+    def resolve(index:int, res:HttpResponse) -> None:
+        url = leading[index]
+        if res is None:
+            _Coalescer.resolve(calls[url], error=ConnectionError(f"Request to `{url}` failed"))
+        else:
+            _Coalescer.resolve(calls[url], result=res)
+
+    try:
+        fetched = client.get_batch(leading, thread_limit, _Warning.warning_settings, on_result=resolve, **control) if leading else []
+    except BaseException as e:
+        for url in leading:
+            _Coalescer.resolve(calls[url], error=e)
+        raise
+
+    by_url = dict(zip(leading, fetched))
+    # Requests abandoned once the batch stopped never reached the callback
+    for url in leading:
+        _Coalescer.resolve(calls[url], error=ConnectionError(f"Request to `{url}` failed"))
+    for url, call in calls.items():
+        if url not in by_url:
+            try:
+                by_url[url] = _Coalescer.wait(call)
+            except Exception:
+                by_url[url] = None
+
+    # A url repeated in the batch is identical to itself, so it's fetched once as well.
+    # Every later position still gets its own response object
+    seen = set()
+    results = []
+    for url in urls:
+        res = by_url[url]
+        if url in seen and res is not None:
+            res = res.copy()
+        seen.add(url)
+        results.append(res)
+    return results
+
+def __js_scraper():
+    from .js_scraper import js_scraper
+    return js_scraper
+
+async def __to_thread(func, /, **kwargs):
+    import asyncio as _asyncio
+    return await _asyncio.to_thread(func, **kwargs)
+
+def __js_get(url:str, timeout:int=None) -> HttpResponse:
+    return __js_scraper().pyppeteer_get(url, timeout=20 if timeout is None else timeout)
+
+def __js_get_batch(urls:list, timeout:int, thread_limit:int, end:float=None, cancel:CancelToken=None, progress=None) -> dict:
+    result = {}
+    for thread_counter in range (0, len(urls), thread_limit):
+        # The progress of each chunk is offset by the earlier chunks below
+        control = __batch_control(end, cancel, None)
+        control.pop('progress')
+        if (cancel is not None and cancel.cancelled) or (end is not None and _time.monotonic() >= end):
+            break
+        curr_urls = urls[thread_counter:thread_counter+thread_limit]
+        # Counts from earlier chunks are carried over, so progress covers the whole batch
+        done = (len(result), thread_counter - len(result), sum(len(res.raw_content()) for res in result.values()))
+        chunk_progress = None if progress is None else (
+            lambda completed, failed, received, done=done: progress(done[0] + completed, done[1] + failed, done[2] + received)
+        )
+        result.update(__js_scraper().pyppeteer_get_async(curr_urls, timeout=timeout, progress=chunk_progress, **control))
+    return result
+
+def __batch_deadline(deadline:float, cancel:CancelToken, progress) -> _typing.Optional[float]:
+    # Validates the controls of a batch and returns the monotonic time it must be over by
+    if not (isinstance(deadline, (int, float)) or deadline is None):
+        raise TypeError("Argument 'deadline' must be a int or float")
+    if deadline is not None and deadline <= 0:
+        raise ValueError("Argument 'deadline' must be positive")
+    if not (isinstance(cancel, CancelToken) or cancel is None):
+        raise TypeError("Argument 'cancel' must be a CancelToken")
+    if not (callable(progress) or progress is None):
+        raise TypeError("Argument 'progress' must be callable")
+    return None if deadline is None else _time.monotonic() + deadline
+
+def __batch_control(end:float, cancel:CancelToken, progress) -> dict:
+    # The deadline covers every stage of a batch (native fetch, then rendering), so each stage gets the time left
+    deadline = None if end is None else max(end - _time.monotonic(), 0.001)
+    return {'deadline': deadline, 'cancel': cancel, 'progress': progress}
+
+def __set_proxy(kwargs) -> _typing.Union[str, ProxyPool]:
     # Defaults to user specified proxies and headers over those defined by the tor interface
     if 'proxies' in kwargs.keys():
+        # A pool is handed to the session as is, which picks a proxy per request
+        if isinstance(kwargs['proxies'], ProxyPool):
+            return kwargs['proxies']
         try: return kwargs['proxies']['http']
         except: raise ValueError("proxies incorrectly formatted. {'http': '0.0.0.0:8080', 'https': '0.0.0.0:8080'}")
     elif Tor.tor_status():
@@ -478,6 +914,34 @@ def __set_headers(kwargs):
     headers.update(kwargs.get('headers', {}))
     return headers
 
+def __prepare_request_spec(spec:dict) -> dict:
+    if not isinstance(spec, dict):
+        raise TypeError("Every request in a batch must be a dict")
+    if spec.get('params') is not None:
+        spec = dict(spec)
+        spec['url'] = __append_query_params(spec['url'], spec.pop('params'))
+    return spec
+
+def __form_fields(form:dict) -> list:
+    if form is None:
+        return []
+    return [(str(k), str(v)) for k, v in form.items()]
+
+def __file_parts(files:dict) -> list:
+    parts = []
+    for field, value in files.items():
+        content_type = None
+        if isinstance(value, tuple):
+            filename, content = value[0], value[1]
+            if len(value) > 2:
+                content_type = value[2]
+        else:
+            filename, content = getattr(value, 'name', field), value
+        if hasattr(content, 'read'):
+            content = content.read()
+        parts.append((str(field), _os.path.basename(str(filename)), content, content_type))
+    return parts
+
 def __append_query_params(url:str, params:dict=None) -> str:
     """
     A function to append query parameters to a URL.
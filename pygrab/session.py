@@ -4,6 +4,7 @@ from .js_scraper import js_scraper as _js_scraper
 import requests as _requests
 import threading as _threading
 import time as _time
+import datetime as _datetime
 
 class Session(_requests.Session):
     def __init__(self, use_tor:bool=None, **kwargs):
@@ -45,8 +46,8 @@ class Session(_requests.Session):
         if thread_limit is None:
             thread_limit = 30 if enable_js else 800
 
-        # remove repeats to prevent possible DoS attacks
-        urls = list(set(urls))
+        # remove repeats to prevent possible DoS attacks, keeping the order the urls were given in
+        urls = list(dict.fromkeys(urls))
 
         # Handle async js enabled scraping
         if enable_js:
@@ -71,7 +72,7 @@ class Session(_requests.Session):
             for thread in threads:
                 thread.join()
             thread_counter += thread_limit
-        return result
+        return {url:result[url] for url in urls if url in result}
 
     def get_local(self, filename:str, local_read_type:str='r', encoding:str='utf-8')->str:
         if not (isinstance(filename, str)):
@@ -159,15 +160,13 @@ class Session(_requests.Session):
         elif not (isinstance(time_rest, int) or isinstance(time_rest, float)):
             raise TypeError("Argument 'time_rest' must be a int or float")
 
-        # remove repeats to prevent possible DoS attacks
-        urls = list(set(urls))
-        local_filenames = list(set(local_filenames))
+        urls, local_filenames = list(urls), list(local_filenames)
+        if len(urls) != len(local_filenames):
+            raise ValueError("Lists 'url' and 'local_filenames' must be of equal length.")
 
-        if local_filenames is not None:
-            if len(urls) != len(local_filenames):
-                raise ValueError("Lists 'url' and 'local_filenames' must be of equal length.")
-        else:
-            local_filenames = [None for _ in range(len(urls))]
+        # remove repeats to prevent possible DoS attacks, keeping each url paired with its filename
+        pairs = dict(zip(urls, local_filenames))
+        urls, local_filenames = list(pairs.keys()), list(pairs.values())
 
         # Uses the threading module to asynchronously download the files
         thread_counter = 0
@@ -221,10 +220,13 @@ class Session(_requests.Session):
         except _requests.exceptions.RequestException as err:
             _Warning.raiseWarning(f"Warning: Failed to grab {url} | {err}\n")
 
-    def __responseify_html(self, html):
+    def __responseify_html(self, rendered):
         resp = _requests.models.Response()
-        resp.status_code = 200
-        resp.headers = {'header_key': 'NaN'}
-        resp._content = str(html).encode("utf-8")
+        resp.status_code = rendered.status_code
+        resp.headers = _requests.structures.CaseInsensitiveDict(rendered.headers)
+        resp.url = rendered.url
+        resp.elapsed = _datetime.timedelta(seconds=rendered.elapsed)
+        resp.encoding = 'utf-8'
+        resp._content = rendered.content
         resp.request = _requests.models.PreparedRequest()
         return resp
\ No newline at end of file
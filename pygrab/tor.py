@@ -1,9 +1,5 @@
-import subprocess as _subprocess
 import os as _os
 import atexit as _atexit
-import signal as _signal
-import tarfile as _tarfile
-from pathlib import Path as _Path
 import platform as _platform
 from .exceptions import *
 
@@ -23,6 +19,10 @@ class Tor():
 
     @classmethod
     def start_tor(cls, verbose:int=0, force_start=None) -> None:
+        # Only needed once tor is actually started, so they aren't imported with pygrab
+        import subprocess as _subprocess
+        import signal as _signal
+
         if force_start is None and cls.__os == 'Windows':
             force_start = False
         elif force_start is None and cls.__os == 'Linux':
@@ -110,6 +110,7 @@ class Tor():
 
         cls.__tor_path_init()        
         if filepath.endswith('.tar.gz'):
+            import tarfile as _tarfile
             with _tarfile.open(filepath, 'r:gz') as tar:
                 tar.extractall(path=cls.__tor_path)
             return
@@ -148,6 +149,7 @@ class Tor():
     @classmethod
     def __tor_path_init(cls):
         if cls.__tor_path is None:
+            from pathlib import Path as _Path
             tor_path = _Path(_os.path.dirname(_os.path.realpath(__file__)))
             if "tor-dependencies" not in _os.listdir(tor_path):
                 _os.mkdir(_os.path.join(tor_path, "./tor-dependencies"))
@@ -156,6 +158,7 @@ class Tor():
     @classmethod
     def __tor_installed_linux(cls):
         # Determine if tor service is installed for linux
+        import subprocess as _subprocess
         try:
             result = _subprocess.run(['tor', '--version'], stdout=_subprocess.PIPE, stderr=_subprocess.PIPE)
             if result.returncode == 0:
@@ -1,23 +1,29 @@
 use crate::response::HttpResponse;
+use crate::body::{RequestBody, JsonBody, FilePart};
+use crate::batch::parse_method;
+use crate::timeouts::{TimeoutPolicy, host_of, record_latency};
 
 use std::{
     fs,
     collections::HashMap,
     str::FromStr,
+    time::Instant,
+    sync::atomic::{AtomicUsize, Ordering},
 };
 use pyo3::prelude::*;
-use pyo3::exceptions::{PyException, PyValueError};
+use pyo3::exceptions::PyException;
 use tokio::runtime::Runtime;
-use reqwest::{self, Method, header, Client};
+use reqwest::{self, header, Client};
 
 
 #[pyclass]
 pub struct AsyncSessionRs {
     client: Client,
-    num_req: usize,
+    num_req: AtomicUsize,
     timeout: f64,
     headers: HashMap<String, String>,
     proxy: Option<String>,
+    policy: Option<TimeoutPolicy>,
     rt: Runtime,
 }
 
@@ -35,6 +41,7 @@ impl AsyncSessionRs {
             );
         }
 
+        let policy = TimeoutPolicy::default_policy();
         let mut client = Client::builder()
             .timeout(std::time::Duration::from_secs_f64(timeout))
             .default_headers(client_headers);
@@ -43,14 +50,18 @@ impl AsyncSessionRs {
             let proxy= reqwest::Proxy::all(proxy).unwrap();
             client = client.proxy(proxy);
         }
+        if let Some(ref policy) = policy {
+            client = policy.configure_async(client);
+        }
         let client = client.build().unwrap();
-        
+
         AsyncSessionRs {
             client: client,
-            num_req: 0,
+            num_req: AtomicUsize::new(0),
             timeout: timeout,
             headers: headers,
             proxy: proxy_url,
+            policy: policy,
             rt: Runtime::new().unwrap(),
         }
     }
@@ -58,7 +69,7 @@ impl AsyncSessionRs {
     pub fn set_proxy(&mut self, proxy: String) {
         self.proxy = Some(proxy);
         self.build_client();
-    } 
+    }
 
     pub fn remove_proxy(&mut self) {
         self.proxy = None;
@@ -70,126 +81,127 @@ impl AsyncSessionRs {
         self.build_client();
     }
 
-    pub fn get(&mut self, url: String) -> PyResult<HttpResponse> {
-        let res = self.client.get(url).send();
-        let res = self.rt.block_on(res);
+    pub fn get(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        let res = py.allow_threads(|| self.rt.block_on(
+            Self::fetch_with_policy(self.client.clone(), reqwest::Method::GET, url, self.policy.clone(), self.timeout)
+        ));
         match res {
             Ok(x) => {
-                self.num_req += 1;
-                Ok(self.rt.block_on(HttpResponse::from_reqwest(x)))
+                self.num_req.fetch_add(1, Ordering::Relaxed);
+                Ok(x)
             }
             Err(x) => { Err(PyException::new_err(format!("Error: {}", x))) }
         }
     }
 
+    #[getter]
+    pub fn get_num_req(&self) -> usize {
+        self.num_req.load(Ordering::Relaxed)
+    }
+
     #[pyo3(signature = (urls, warn_status=None))]
-    pub fn get_batch (&mut self, urls: Vec<String>, warn_status: Option<bool>) -> HashMap<String, HttpResponse> {
+    pub fn get_batch (&self, py: Python<'_>, urls: Vec<String>, warn_status: Option<bool>) -> Vec<Option<HttpResponse>> {
         let warn_status = warn_status.unwrap_or(true);
 
-        let res = self.rt.block_on(self.get_batch_helper(&urls, warn_status));
-        self.num_req += res.len();
+        let res = py.allow_threads(|| self.rt.block_on(self.get_batch_helper(&urls, warn_status)));
+        self.num_req.fetch_add(res.iter().filter(|r| r.is_some()).count(), Ordering::Relaxed);
         res
     }
 
-    pub fn download(&mut self, url: String, filename: String) -> PyResult<()> {
-        let resp = self.rt.block_on(self.client.get(url).send());
-        let resp = match resp {
-            Ok(x) => { x }
-            Err(e) => { return Err(PyException::new_err(format!("{e}"))); }
-        };
-        let bytes = match self.rt.block_on(resp.bytes()) {
-            Ok(x) => { x }
-            Err(e) => { return  Err(PyException::new_err(format!("{e}"))); }
-        };
-        match fs::write(filename, bytes) {
-            Ok(_) => { 
-                self.num_req += 1;
-                return Ok (()); 
+    pub fn download(&self, py: Python<'_>, url: String, filename: String) -> PyResult<()> {
+        let res = py.allow_threads(|| self.rt.block_on(Self::download_helper(self.client.clone(), url, filename)));
+        match res {
+            Ok(_) => {
+                self.num_req.fetch_add(1, Ordering::Relaxed);
+                return Ok (());
             }
-            Err(e) => { return Err(PyException::new_err(format!("{e}"))); }
+            Err(e) => { return Err(PyException::new_err(e)); }
         }
     }
 
     #[pyo3(signature = (urls, filenames, warn_status=None))]
-    pub fn download_batch (&mut self, urls: Vec<String>, filenames: Vec<String>, warn_status: Option<bool>) {
+    pub fn download_batch (&self, py: Python<'_>, urls: Vec<String>, filenames: Vec<String>, warn_status: Option<bool>) {
         let warn_status = warn_status.unwrap_or(true);
-        self.num_req += urls.len();
-        self.rt.block_on(self.download_batch_helper(&urls, &filenames, warn_status));
+        self.num_req.fetch_add(urls.len(), Ordering::Relaxed);
+        py.allow_threads(|| self.rt.block_on(self.download_batch_helper(&urls, &filenames, warn_status)));
     }
 
-    pub fn head(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "HEAD")
+    pub fn head(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "HEAD")
     }
 
-    pub fn post(&mut self,url: String, data:Vec<u8>) -> PyResult<HttpResponse> {
-        let res = self.rt.block_on(self.client.post(url)
-            .body(data)
-            .send());
-        match res {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(self.rt.block_on(HttpResponse::from_reqwest(x))) 
-            }            
-            Err(e) => { Err(PyException::new_err(format!("Error with POST request: {e}"))) }
-        }
+    pub fn post(&self, py: Python<'_>, url: String, data: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, data, "POST")
     }
 
     #[pyo3(signature = (urls, data, warn_status=None))]
-    pub fn post_batch(&mut self, urls: Vec<String>, data: Vec<Vec<u8>>, warn_status: Option<bool>) -> HashMap<String, HttpResponse> {
+    pub fn post_batch(
+        &self,
+        py: Python<'_>,
+        urls: Vec<String>,
+        data: Vec<RequestBody>,
+        warn_status: Option<bool>
+    ) -> Vec<Option<HttpResponse>> {
         let warn_status = warn_status.unwrap_or(true);
-        let res = self.rt.block_on(self.post_batch_helper(urls, data, warn_status));
-        self.num_req += res.len();
+        let res = py.allow_threads(|| self.rt.block_on(self.post_batch_helper(urls, data, warn_status)));
+        self.num_req.fetch_add(res.iter().filter(|r| r.is_some()).count(), Ordering::Relaxed);
         res
     }
 
-    pub fn post_json(&mut self,url: String, data: HashMap<String, String>) -> PyResult<HttpResponse> {
-        let res = self.rt.block_on(self.client.post(url)
-            .json(&data)
-            .send());
-        match res {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(self.rt.block_on(HttpResponse::from_reqwest(x)))
-            }
-            Err(e) => { Err(PyException::new_err(format!("Error with POST request: {e}"))) }
-        }
+    pub fn post_json(&self, py: Python<'_>, url: String, data: JsonBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Json(data.0), "POST")
     }
 
     #[pyo3(signature = (urls, data, warn_status=None))]
     pub fn post_json_batch(
-        &mut self, 
-        urls: Vec<String>, 
-        data: Vec<HashMap<String, String>>, 
+        &self,
+        py: Python<'_>,
+        urls: Vec<String>,
+        data: Vec<JsonBody>,
         warn_status: Option<bool>
-    ) -> HashMap<String, HttpResponse> {
-        let warn_status = warn_status.unwrap_or(true);
+    ) -> Vec<Option<HttpResponse>> {
+        let data = data.into_iter().map(|json| RequestBody::Json(json.0)).collect();
+        self.post_batch(py, urls, data, warn_status)
+    }
 
-        let res = self.rt.block_on(
-            self.post_json_batch_helper(urls, data, warn_status)
-        );
-        self.num_req += res.len();
-        res
+    pub fn post_form(&self, py: Python<'_>, url: String, data: Vec<(String, String)>) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Form(data), "POST")
     }
 
+    pub fn post_multipart(
+        &self,
+        py: Python<'_>,
+        url: String,
+        fields: Vec<(String, String)>,
+        files: Vec<FilePart>
+    ) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Multipart(fields, files), "POST")
+    }
 
-    pub fn put(&mut self, url: String, body: String) -> PyResult<HttpResponse> {
-        self.send_request(url, body, "PUT")
+    #[pyo3(signature = (url, body=RequestBody::Empty))]
+    pub fn put(&self, py: Python<'_>, url: String, body: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, body, "PUT")
     }
 
-    pub fn delete(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "DELETE")
+    #[pyo3(signature = (url, body=RequestBody::Empty))]
+    pub fn patch(&self, py: Python<'_>, url: String, body: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, body, "PATCH")
     }
 
-    pub fn connect(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "CONNECT")
+    pub fn delete(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "DELETE")
     }
 
-    pub fn options(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "OPTIONS")
+    pub fn connect(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "CONNECT")
     }
 
-    pub fn trace(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "TRACE")
+    pub fn options(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "OPTIONS")
+    }
+
+    pub fn trace(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "TRACE")
     }
 
     #[setter]
@@ -204,34 +216,15 @@ impl AsyncSessionRs {
         self.build_client();
     }
 
-    fn send_request(&mut self, url: String, body: String, method_str: &str) -> PyResult<HttpResponse> {
-        let method  = match method_str.to_uppercase().as_str() {
-            "POST" => Method::POST,
-            "PUT" => Method::PUT,
-            "DELETE" => Method::DELETE,
-            "HEAD" => Method::HEAD,
-            "OPTIONS" => Method::OPTIONS,
-            "CONNECT" => Method::CONNECT,
-            "TRACE" => Method::TRACE,
-            "PATCH" => Method::PATCH,
-            _ => return Err(PyValueError::new_err("Invalid HTTP method")),
-        };
-
-        let builder = self.client.request(method.clone(), &url);
-        let res = if method == Method::POST || method == Method::PUT || method == Method::PATCH {
-            builder.body(body).send()
-        } 
-        else {
-            builder.send()
-        };
+    #[getter]
+    pub fn get_timeout_policy(&self) -> Option<TimeoutPolicy> {
+        self.policy.clone()
+    }
 
-        match self.rt.block_on(res) {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(self.rt.block_on(HttpResponse::from_reqwest(x)))
-            },
-            Err(e) => Err(PyException::new_err(format!("Error with {method_str} request: {e}"))),
-        }
+    #[setter]
+    pub fn set_timeout_policy(&mut self, policy: Option<TimeoutPolicy>) {
+        self.policy = policy;
+        self.build_client();
     }
 
     fn build_client(&mut self) {
@@ -251,109 +244,175 @@ impl AsyncSessionRs {
             let proxy= reqwest::Proxy::all(proxy).unwrap();
             client = client.proxy(proxy);
         }
+        if let Some(ref policy) = self.policy {
+            client = policy.configure_async(client);
+        }
         self.client = client.build().unwrap();
     }
 }
 
 impl AsyncSessionRs {
-    async fn download_batch_helper(&self, urls: &Vec<String>, filenames: &Vec<String>, warn_status: bool) {
-        let futures = urls.iter().zip(filenames.iter()).map(|(url, filename)| {
-            (url, filename, tokio::spawn(self.client.get(url).send()))
-        });
-
-        for (url, filename, fut) in futures {
-            let res = match fut.await {
-                Ok(Ok(r)) => r,
-                _ => {
-                    if warn_status {
-                        println!("Error downloading `{}`", url);
+    fn send_request(&self, py: Python<'_>, url: String, body: RequestBody, method_str: &str) -> PyResult<HttpResponse> {
+        let method = parse_method(method_str)?;
+
+        // Requests without a body can be rebuilt, so they may be hedged. The rest only get the policy's deadline.
+        let res = if let RequestBody::Empty = body {
+            py.allow_threads(|| self.rt.block_on(
+                Self::fetch_with_policy(self.client.clone(), method, url, self.policy.clone(), self.timeout)
+            ))
+        } else {
+            let mut builder = body.apply_async(self.client.request(method, &url))
+                .map_err(|e| PyException::new_err(format!("Error with {method_str} request: {e}")))?;
+            if let Some(policy) = &self.policy {
+                builder = builder.timeout(policy.request_timeout(&host_of(&url), self.timeout));
+            }
+            // Waiting on the server and reading the response don't need the GIL
+            py.allow_threads(|| self.rt.block_on(Self::fetch(builder)))
+        };
+        match res {
+            Ok(x) => {
+                self.num_req.fetch_add(1, Ordering::Relaxed);
+                Ok(x)
+            },
+            Err(e) => Err(PyException::new_err(format!("Error with {method_str} request: {e}"))),
+        }
+    }
+
+    /// Sends the request and reads the whole response, so spawned requests also read their bodies concurrently
+    async fn fetch(builder: reqwest::RequestBuilder) -> Result<HttpResponse, reqwest::Error> {
+        let start = Instant::now();
+        let res = builder.send().await?;
+        let elapsed = start.elapsed();
+        Ok(HttpResponse::from_reqwest(res).await.with_elapsed(elapsed))
+    }
+
+    /// Like `fetch`, but with `learn` the time the whole request took is recorded as that host's latency.
+    /// Timed out requests are recorded too, so the learned deadline of a host that slowed down can widen again.
+    async fn fetch_learning(builder: reqwest::RequestBuilder, learn: Option<&str>) -> Result<HttpResponse, reqwest::Error> {
+        let start = Instant::now();
+        let res = Self::fetch(builder).await;
+        if let Some(host) = learn {
+            if res.as_ref().err().map_or(true, |e| e.is_timeout()) {
+                record_latency(host, start.elapsed().as_secs_f64());
+            }
+        }
+        res
+    }
+
+    /// Sends a request without a body following `policy` (if any), hedging it with a duplicate once it turns into a straggler
+    async fn fetch_with_policy(
+        client: Client,
+        method: reqwest::Method,
+        url: String,
+        policy: Option<TimeoutPolicy>,
+        session_timeout: f64
+    ) -> Result<HttpResponse, reqwest::Error> {
+        match policy {
+            None => Self::fetch(client.request(method, &url)).await,
+            Some(policy) => {
+                let host = host_of(&url);
+                let learn = policy.learns_latency().then_some(host.as_str());
+                let timeout = policy.request_timeout(&host, session_timeout);
+                let primary = Self::fetch_learning(client.request(method.clone(), &url).timeout(timeout), learn);
+                match policy.hedge_delay(&host, &method) {
+                    None => primary.await,
+                    Some(delay) => {
+                        tokio::pin!(primary);
+                        let early = tokio::select! {
+                            res = &mut primary => Some(res),
+                            _ = tokio::time::sleep(delay) => None,
+                        };
+                        match early {
+                            Some(res) => res,
+                            None => {
+                                let backup = Self::fetch_learning(client.request(method.clone(), &url).timeout(timeout), learn);
+                                tokio::pin!(backup);
+                                let (first, backup_won) = tokio::select! {
+                                    res = &mut primary => (res, false),
+                                    res = &mut backup => (res, true),
+                                };
+                                // Take whichever finishes first, unless it failed
+                                match first {
+                                    Ok(x) => Ok(x),
+                                    Err(_) if backup_won => primary.await,
+                                    Err(_) => backup.await,
+                                }
+                            }
+                        }
                     }
-                    continue;
                 }
-            };
-
-            match &res.bytes().await {
-                Ok(r) => {
-                    let r = fs::write(filename, r);
-                    if let Err(e)= r {
-                        if warn_status { println!("Error writing to file `{}`: {}", filename, e); }  
-                    } 
-                    continue;
+            }
+        }
+    }
+
+    async fn download_helper(client: Client, url: String, filename: String) -> Result<(), String> {
+        let res = client.get(&url).send().await.map_err(|e| e.to_string())?;
+        let bytes = res.bytes().await.map_err(|e| e.to_string())?;
+        fs::write(filename, bytes).map_err(|e| e.to_string())
+    }
+
+    async fn download_batch_helper(&self, urls: &Vec<String>, filenames: &Vec<String>, warn_status: bool) {
+        // Spawn every download before awaiting any of them so they run concurrently
+        let futures = urls.iter().zip(filenames.iter()).map(|(url, filename)| {
+            let fut = Self::download_helper(self.client.clone(), url.clone(), filename.clone());
+            (url, tokio::spawn(fut))
+        }).collect::<Vec<_>>();
+
+        for (url, fut) in futures {
+            match fut.await {
+                Ok(Ok(_)) => {},
+                Ok(Err(e)) => {
+                    if warn_status { println!("Error downloading `{}`: {}", url, e); }
                 },
-                _ => {
-                    if warn_status {
-                        println!("Error extracting contents from {}", url);
-                    }
-                    continue;
+                Err(_) => {
+                    if warn_status { println!("Error downloading `{}`", url); }
                 }
-            }  
+            }
         }
     }
 
-    async fn get_batch_helper(&self, urls: &Vec<String>, warn_status: bool) -> HashMap<String, HttpResponse> {
+    async fn get_batch_helper(&self, urls: &Vec<String>, warn_status: bool) -> Vec<Option<HttpResponse>> {
+        // Spawn every request before awaiting any of them so they run concurrently
         let futures = urls.iter().map(|s| {
-            let fut = self.client.get(s.as_str()).send();
+            let fut = Self::fetch_with_policy(self.client.clone(), reqwest::Method::GET, s.clone(), self.policy.clone(), self.timeout);
             (s.clone(), tokio::spawn(fut))
-        });
+        }).collect::<Vec<_>>();
 
-        let mut res = HashMap::new();
+        let mut res = Vec::with_capacity(futures.len());
 
         for (url, fut) in futures {
-            let resp = if let Ok(Ok(res)) = fut.await {
-                res
+            if let Ok(Ok(resp)) = fut.await {
+                res.push(Some(resp));
             }
-            else{
+            else {
                 if warn_status {
                     println!("Error grabbing `{}`", &url);
                 }
-                continue;
-            };
-            res.insert(url, HttpResponse::from_reqwest(resp).await);
+                res.push(None);
+            }
         }
 
         res
     }
 
-    async fn post_batch_helper(&self, urls: Vec<String>, data: Vec<Vec<u8>>, warn_status: bool) -> HashMap<String, HttpResponse> {
-        let futures = urls.into_iter().zip(data.into_iter()).map(|(url, data)|{
-            let fut = tokio::spawn(self.client.post(&url).body(data).send());
-            (url, tokio::spawn(fut))
-        });
-
-        let mut res_lst = HashMap::new();
-        for (url, fut) in futures {
-            let res = match fut.await {
-                Ok(Ok(Ok(r))) => r,
-                _ => {
-                    if warn_status {
-                        println!("Error posting to `{}`", &url);
-                    }
-                    continue;
-                }
-            };
-            res_lst.insert(url, HttpResponse::from_reqwest(res).await);
-        }
-        res_lst
-    }
-
-    async fn post_json_batch_helper(&self, urls: Vec<String>, data: Vec<HashMap<String, String>>, warn_status: bool) -> HashMap<String, HttpResponse> {
+    async fn post_batch_helper(&self, urls: Vec<String>, data: Vec<RequestBody>, warn_status: bool) -> Vec<Option<HttpResponse>> {
         let futures = urls.into_iter().zip(data.into_iter()).map(|(url, data)|{
-            let fut = tokio::spawn(self.client.post(&url).json(&data).send());
-            (url, tokio::spawn(fut))
-        });
+            let builder = data.apply_async(self.client.post(&url));
+            let fut = tokio::spawn(async move { Self::fetch(builder?).await.map_err(|e| e.to_string()) });
+            (url, fut)
+        }).collect::<Vec<_>>();
 
-        let mut res_lst = HashMap::new();
+        let mut res_lst = Vec::with_capacity(futures.len());
         for (url, fut) in futures {
-            let res = match fut.await {
-                Ok(Ok(Ok(r))) => r,
-                _ => {
-                    if warn_status {
-                        println!("Error posting to `{}`", &url);
-                    }
-                    continue;
+            if let Ok(Ok(resp)) = fut.await {
+                res_lst.push(Some(resp));
+            }
+            else {
+                if warn_status {
+                    println!("Error posting to `{}`", &url);
                 }
-            };
-            res_lst.insert(url, HttpResponse::from_reqwest(res).await);
+                res_lst.push(None);
+            }
         }
         res_lst
     }
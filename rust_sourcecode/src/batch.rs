@@ -0,0 +1,136 @@
+use crate::body::{RequestBody, py_to_json};
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+use pyo3::exceptions::{PyKeyError, PyValueError};
+use reqwest::{Method, header::{HeaderMap, HeaderName, HeaderValue}};
+use std::{thread, collections::HashMap, str::FromStr, time::Duration};
+use std::sync::{mpsc, Arc, Mutex};
+
+/// A single request of a mixed batch, extracted from a dict with the keys
+/// `method`, `url`, `headers`, `data`, `json` and `timeout`. Only `url` is required.
+pub struct RequestSpec {
+    pub method: Method,
+    pub url: String,
+    pub headers: HeaderMap,
+    pub body: RequestBody,
+    pub timeout: Option<Duration>,
+}
+
+impl<'py> FromPyObject<'py> for RequestSpec {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        let spec = ob.downcast::<PyDict>()?;
+        let url: String = match spec.get_item("url")? {
+            Some(url) => url.extract()?,
+            None => return Err(PyKeyError::new_err("request spec is missing a `url`")),
+        };
+        let method = match spec.get_item("method")? {
+            Some(m) if !m.is_none() => parse_method(&m.extract::<String>()?)?,
+            _ => Method::GET,
+        };
+        let mut headers = HeaderMap::new();
+        if let Some(h) = spec.get_item("headers")? {
+            if !h.is_none() {
+                for (k, v) in h.extract::<HashMap<String, String>>()? {
+                    headers.insert(
+                        HeaderName::from_str(&k).map_err(|e| PyValueError::new_err(format!("Invalid header `{k}`: {e}")))?,
+                        HeaderValue::from_str(&v).map_err(|e| PyValueError::new_err(format!("Invalid header `{k}`: {e}")))?,
+                    );
+                }
+            }
+        }
+        let body = match (spec.get_item("json")?, spec.get_item("data")?) {
+            (Some(json), _) if !json.is_none() => RequestBody::Json(py_to_json(&json)?),
+            (_, Some(data)) => data.extract()?,
+            _ => RequestBody::Empty,
+        };
+        let timeout = match spec.get_item("timeout")? {
+            Some(t) if !t.is_none() => Some(Duration::from_secs_f64(t.extract()?)),
+            _ => None,
+        };
+        Ok(RequestSpec { method, url, headers, body, timeout })
+    }
+}
+
+impl RequestSpec {
+    pub fn send(self, client: &reqwest::blocking::Client) -> Result<reqwest::blocking::Response, String> {
+        let mut builder = client.request(self.method, &self.url).headers(self.headers);
+        if let Some(timeout) = self.timeout {
+            builder = builder.timeout(timeout);
+        }
+        self.body.apply_blocking(builder)?
+            .send()
+            .map_err(|e| e.to_string())
+    }
+}
+
+pub fn parse_method(method: &str) -> PyResult<Method> {
+    Ok(match method.to_uppercase().as_str() {
+        "GET" => Method::GET,
+        "POST" => Method::POST,
+        "PUT" => Method::PUT,
+        "DELETE" => Method::DELETE,
+        "HEAD" => Method::HEAD,
+        "OPTIONS" => Method::OPTIONS,
+        "CONNECT" => Method::CONNECT,
+        "TRACE" => Method::TRACE,
+        "PATCH" => Method::PATCH,
+        _ => return Err(PyValueError::new_err("Invalid HTTP method")),
+    })
+}
+
+/// Runs `work` over every item on a pool of at most `thread_limit` threads.
+/// Workers pull the next item as soon as they finish one, so a slow request only holds up its own thread.
+/// Results are sent back tagged with the index of their item, in completion order.
+pub fn spawn_pool<T, R, F>(items: Vec<T>, thread_limit: usize, work: F) -> mpsc::Receiver<(usize, R)>
+where
+    T: Send + 'static,
+    R: Send + 'static,
+    F: Fn(T) -> R + Send + Sync + 'static,
+{
+    spawn_pool_until(items, thread_limit, || false, work)
+}
+
+/// Like `spawn_pool`, but workers stop pulling items once `stopped` returns true.
+/// Items that were never pulled get no result.
+pub fn spawn_pool_until<T, R, S, F>(items: Vec<T>, thread_limit: usize, stopped: S, work: F) -> mpsc::Receiver<(usize, R)>
+where
+    T: Send + 'static,
+    R: Send + 'static,
+    S: Fn() -> bool + Send + Sync + 'static,
+    F: Fn(T) -> R + Send + Sync + 'static,
+{
+    let (tx, rx) = mpsc::channel();
+    let num_workers = thread_limit.max(1).min(items.len());
+    let queue = Arc::new(Mutex::new(items.into_iter().enumerate()));
+    let work = Arc::new(work);
+    let stopped = Arc::new(stopped);
+
+    for _ in 0..num_workers {
+        let tx = tx.clone();
+        let queue = queue.clone();
+        let work = work.clone();
+        let stopped = stopped.clone();
+        thread::spawn(move || loop {
+            if stopped() { break }
+            let next = queue.lock().unwrap().next();
+            let (ind, item) = match next {
+                Some(x) => x,
+                None => break,
+            };
+            if tx.send((ind, work(item))).is_err() { break }
+        });
+    }
+    rx
+}
+
+/// Places the results sent back by `spawn_pool` at the index of their item. Failed items stay `None`.
+pub fn collect_ordered<R, I>(rx: I, len: usize) -> Vec<Option<R>>
+where
+    I: IntoIterator<Item = (usize, Option<R>)>,
+{
+    let mut res: Vec<Option<R>> = (0..len).map(|_| None).collect();
+    for (ind, item) in rx {
+        res[ind] = item;
+    }
+    res
+}
@@ -0,0 +1,173 @@
+use pyo3::prelude::*;
+use pyo3::types::{PyBool, PyByteArray, PyBytes, PyDict, PyFloat, PyInt, PyList, PyString, PyTuple};
+use pyo3::exceptions::{PyTypeError, PyValueError};
+use reqwest::header::{self, HeaderValue};
+use serde_json::{Map, Number, Value as JsonValue};
+
+/// A request payload extracted from Python.
+/// `str`, `bytes` and `bytearray` are sent as-is, `None` sends no body and any other
+/// JSON compatible object (dict, list, int, float, bool) is serialized to JSON natively.
+#[derive(Clone)]
+pub enum RequestBody {
+    Empty,
+    Bytes(Vec<u8>),
+    Json(JsonValue),
+    Form(Vec<(String, String)>),
+    Multipart(Vec<(String, String)>, Vec<FilePart>),
+}
+
+/// A file in a multipart body, extracted from a `(field, filename, content, content_type)` tuple.
+#[derive(Clone)]
+pub struct FilePart {
+    field: String,
+    filename: String,
+    content: Vec<u8>,
+    mime: Option<String>,
+}
+
+/// A payload that is always serialized as JSON, even if it's a `str`.
+pub struct JsonBody(pub JsonValue);
+
+impl<'py> FromPyObject<'py> for RequestBody {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        if ob.is_none() {
+            return Ok(RequestBody::Empty);
+        }
+        if let Some(bytes) = extract_bytes(ob) {
+            return Ok(RequestBody::Bytes(bytes));
+        }
+        Ok(RequestBody::Json(py_to_json(ob)?))
+    }
+}
+
+impl<'py> FromPyObject<'py> for FilePart {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        let tuple = ob.downcast::<PyTuple>()?;
+        if tuple.len() != 4 {
+            return Err(PyValueError::new_err("file parts must be (field, filename, content, content_type) tuples"));
+        }
+        let content = extract_bytes(&tuple.get_item(2)?)
+            .ok_or_else(|| PyTypeError::new_err("file content must be bytes or str"))?;
+        Ok(FilePart {
+            field: tuple.get_item(0)?.extract()?,
+            filename: tuple.get_item(1)?.extract()?,
+            content: content,
+            mime: tuple.get_item(3)?.extract()?,
+        })
+    }
+}
+
+impl<'py> FromPyObject<'py> for JsonBody {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        Ok(JsonBody(py_to_json(ob)?))
+    }
+}
+
+impl RequestBody {
+    pub fn apply_blocking(self, builder: reqwest::blocking::RequestBuilder) -> Result<reqwest::blocking::RequestBuilder, String> {
+        use reqwest::blocking::multipart;
+        Ok(match self {
+            RequestBody::Empty => builder,
+            RequestBody::Bytes(b) => builder.body(b),
+            RequestBody::Json(v) => builder
+                .header(header::CONTENT_TYPE, HeaderValue::from_static("application/json"))
+                .body(serde_json::to_vec(&v).map_err(|e| e.to_string())?),
+            RequestBody::Form(pairs) => builder.form(&pairs),
+            RequestBody::Multipart(fields, files) => {
+                let mut form = multipart::Form::new();
+                for (k, v) in fields { form = form.text(k, v); }
+                for file in files {
+                    let mut part = multipart::Part::bytes(file.content).file_name(file.filename);
+                    if let Some(mime) = file.mime {
+                        part = part.mime_str(&mime).map_err(|e| e.to_string())?;
+                    }
+                    form = form.part(file.field, part);
+                }
+                builder.multipart(form)
+            }
+        })
+    }
+
+    pub fn apply_async(self, builder: reqwest::RequestBuilder) -> Result<reqwest::RequestBuilder, String> {
+        use reqwest::multipart;
+        Ok(match self {
+            RequestBody::Empty => builder,
+            RequestBody::Bytes(b) => builder.body(b),
+            RequestBody::Json(v) => builder
+                .header(header::CONTENT_TYPE, HeaderValue::from_static("application/json"))
+                .body(serde_json::to_vec(&v).map_err(|e| e.to_string())?),
+            RequestBody::Form(pairs) => builder.form(&pairs),
+            RequestBody::Multipart(fields, files) => {
+                let mut form = multipart::Form::new();
+                for (k, v) in fields { form = form.text(k, v); }
+                for file in files {
+                    let mut part = multipart::Part::bytes(file.content).file_name(file.filename);
+                    if let Some(mime) = file.mime {
+                        part = part.mime_str(&mime).map_err(|e| e.to_string())?;
+                    }
+                    form = form.part(file.field, part);
+                }
+                builder.multipart(form)
+            }
+        })
+    }
+}
+
+// Helper Functions
+fn extract_bytes(ob: &Bound<'_, PyAny>) -> Option<Vec<u8>> {
+    if let Ok(b) = ob.downcast::<PyBytes>() {
+        return Some(b.as_bytes().to_vec());
+    }
+    if let Ok(b) = ob.downcast::<PyByteArray>() {
+        return Some(b.to_vec());
+    }
+    if let Ok(s) = ob.downcast::<PyString>() {
+        return s.to_str().ok().map(|s| s.as_bytes().to_vec());
+    }
+    None
+}
+
+/// The inverse of `json_parser_helper` in response.rs. Mirrors the conversions done by `json.dumps`.
+pub fn py_to_json(ob: &Bound<'_, PyAny>) -> PyResult<JsonValue> {
+    if ob.is_none() {
+        return Ok(JsonValue::Null);
+    }
+    // bool must be checked before int since it's a subclass of int
+    if let Ok(b) = ob.downcast::<PyBool>() {
+        return Ok(JsonValue::Bool(b.is_true()));
+    }
+    if ob.is_instance_of::<PyInt>() {
+        if let Ok(i) = ob.extract::<i64>() { return Ok(JsonValue::from(i)); }
+        if let Ok(u) = ob.extract::<u64>() { return Ok(JsonValue::from(u)); }
+        return Err(PyValueError::new_err("int is too large to be serialized to JSON"));
+    }
+    if let Ok(f) = ob.downcast::<PyFloat>() {
+        return Number::from_f64(f.value())
+            .map(JsonValue::Number)
+            .ok_or_else(|| PyValueError::new_err("NaN and infinity can't be serialized to JSON"));
+    }
+    if let Ok(s) = ob.downcast::<PyString>() {
+        return Ok(JsonValue::String(s.to_str()?.to_string()));
+    }
+    if let Ok(dict) = ob.downcast::<PyDict>() {
+        let mut map = Map::with_capacity(dict.len());
+        for (k, v) in dict.iter() {
+            let key = match k.downcast::<PyString>() {
+                Ok(s) => s.to_str()?.to_string(),
+                Err(_) => k.str()?.to_str()?.to_string(),
+            };
+            map.insert(key, py_to_json(&v)?);
+        }
+        return Ok(JsonValue::Object(map));
+    }
+    if let Ok(list) = ob.downcast::<PyList>() {
+        return list.iter().map(|v| py_to_json(&v)).collect::<PyResult<Vec<_>>>().map(JsonValue::Array);
+    }
+    if let Ok(tuple) = ob.downcast::<PyTuple>() {
+        return tuple.iter().map(|v| py_to_json(&v)).collect::<PyResult<Vec<_>>>().map(JsonValue::Array);
+    }
+    Err(PyTypeError::new_err(format!(
+        "Object of type {} is not JSON serializable",
+        ob.get_type().name()?
+    )))
+}
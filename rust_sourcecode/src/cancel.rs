@@ -0,0 +1,186 @@
+use pyo3::prelude::*;
+use pyo3::exceptions::PyValueError;
+use std::sync::{mpsc, Arc, Mutex};
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::time::{Duration, Instant};
+
+/// How often a running batch checks for Ctrl-C while waiting on its workers
+const POLL_INTERVAL: Duration = Duration::from_millis(50);
+/// The least time between two progress reports
+const PROGRESS_INTERVAL: Duration = Duration::from_millis(500);
+
+/// Cancels the batches it's passed to from another thread (or a signal handler).
+/// Workers stop taking new requests and the batch returns what it has so far.
+#[pyclass]
+#[derive(Clone, Default)]
+pub struct CancelToken {
+    cancelled: Arc<AtomicBool>,
+}
+
+#[pymethods]
+impl CancelToken {
+    #[new]
+    pub fn new() -> Self {
+        CancelToken::default()
+    }
+
+    pub fn cancel(&self) {
+        self.cancelled.store(true, Ordering::SeqCst);
+    }
+
+    #[getter]
+    pub fn cancelled(&self) -> bool {
+        self.cancelled.load(Ordering::SeqCst)
+    }
+
+    pub fn __repr__(&self) -> String {
+        format!("<CancelToken [cancelled={}]>", self.cancelled())
+    }
+}
+
+/// Bounds a batch by a deadline and a cancel token, and reports its progress.
+///
+/// Workers check it before each request and between reads of each body, and cap each request's timeout at the time left.
+/// The thread collecting the results polls it while waiting on them, along with Ctrl-C, and calls
+/// the progress callback with the number of completed and failed requests and the bytes received.
+#[derive(Clone)]
+pub struct BatchControl {
+    inner: Arc<ControlInner>,
+}
+
+struct ControlInner {
+    token: Option<CancelToken>,
+    deadline: Option<Instant>,
+    stopped: AtomicBool,
+    progress: Option<PyObject>,
+    completed: AtomicUsize,
+    failed: AtomicUsize,
+    bytes: AtomicU64,
+    // Set when Ctrl-C or a callback raised, it's raised again once the batch returns
+    error: Mutex<Option<PyErr>>,
+}
+
+/// Iterates over the results of `spawn_pool` until they are all in or the batch is stopped
+pub struct Watch<R> {
+    control: BatchControl,
+    rx: mpsc::Receiver<(usize, R)>,
+    last_poll: Instant,
+    last_report: Instant,
+}
+
+impl BatchControl {
+    /// `deadline` is in seconds from now
+    pub fn new(deadline: Option<f64>, cancel: Option<CancelToken>, progress: Option<PyObject>) -> PyResult<Self> {
+        if matches!(deadline, Some(d) if !(d > 0.0) || !d.is_finite()) {
+            return Err(PyValueError::new_err("`deadline` must be a positive number of seconds"));
+        }
+        let now = Instant::now();
+        Ok(BatchControl {
+            inner: Arc::new(ControlInner {
+                token: cancel,
+                deadline: deadline.map(|d| now + Duration::from_secs_f64(d)),
+                stopped: AtomicBool::new(false),
+                progress: progress,
+                completed: AtomicUsize::new(0),
+                failed: AtomicUsize::new(0),
+                bytes: AtomicU64::new(0),
+                error: Mutex::new(None),
+            }),
+        })
+    }
+
+    pub fn deadline(&self) -> Option<Instant> {
+        self.inner.deadline
+    }
+
+    /// Whether workers should stop taking requests
+    pub fn stopped(&self) -> bool {
+        let inner = &self.inner;
+        inner.stopped.load(Ordering::Relaxed)
+            || inner.token.as_ref().map_or(false, |t| t.cancelled())
+            || inner.deadline.map_or(false, |d| Instant::now() >= d)
+    }
+
+    /// Counts a finished request towards the progress
+    pub fn record(&self, ok: bool, bytes: usize) {
+        let inner = &self.inner;
+        if ok {
+            inner.completed.fetch_add(1, Ordering::Relaxed);
+        } else {
+            inner.failed.fetch_add(1, Ordering::Relaxed);
+        }
+        inner.bytes.fetch_add(bytes as u64, Ordering::Relaxed);
+    }
+
+    pub fn watch<R>(&self, rx: mpsc::Receiver<(usize, R)>) -> Watch<R> {
+        let now = Instant::now();
+        Watch { control: self.clone(), rx: rx, last_poll: now, last_report: now }
+    }
+
+    /// Sends the final progress report and raises the error that interrupted the batch, if any.
+    /// Called with the GIL once the batch returned.
+    pub fn finish(&self, py: Python<'_>) -> PyResult<()> {
+        if let Some(err) = self.inner.error.lock().unwrap().take() {
+            return Err(err);
+        }
+        self.report(py)
+    }
+
+    fn report(&self, py: Python<'_>) -> PyResult<()> {
+        let inner = &self.inner;
+        if let Some(progress) = &inner.progress {
+            let counts = (
+                inner.completed.load(Ordering::Relaxed),
+                inner.failed.load(Ordering::Relaxed),
+                inner.bytes.load(Ordering::Relaxed),
+            );
+            progress.call1(py, counts)?;
+        }
+        Ok(())
+    }
+
+    /// Runs `f` with the GIL from a thread that doesn't hold it. If it raised, the batch is stopped
+    /// and the error is raised once the batch returns.
+    pub fn with_gil<F: FnOnce(Python<'_>) -> PyResult<()>>(&self, f: F) {
+        if let Err(e) = Python::with_gil(f) {
+            self.inner.stopped.store(true, Ordering::Relaxed);
+            self.inner.error.lock().unwrap().get_or_insert(e);
+        }
+    }
+
+    /// Checks for Ctrl-C and reports progress if one is due. Stops the batch if either raised.
+    fn poll(&self, report: bool) {
+        self.with_gil(|py| {
+            py.check_signals()?;
+            if report { self.report(py)?; }
+            Ok(())
+        });
+    }
+}
+
+impl<R> Iterator for Watch<R> {
+    type Item = (usize, R);
+
+    fn next(&mut self) -> Option<Self::Item> {
+        loop {
+            // Workers drop their requests at the next read, results that already came in are still handed out
+            if self.control.stopped() {
+                return self.rx.try_recv().ok();
+            }
+
+            if self.last_poll.elapsed() >= POLL_INTERVAL {
+                let report = self.control.inner.progress.is_some() && self.last_report.elapsed() >= PROGRESS_INTERVAL;
+                self.control.poll(report);
+                self.last_poll = Instant::now();
+                if report { self.last_report = self.last_poll; }
+                continue;
+            }
+
+            match self.rx.recv_timeout(POLL_INTERVAL) {
+                Ok(item) => return Some(item),
+                Err(mpsc::RecvTimeoutError::Timeout) => continue,
+                Err(mpsc::RecvTimeoutError::Disconnected) => return None,
+            }
+        }
+    }
+}
@@ -0,0 +1,162 @@
+use pyo3::prelude::*;
+use pyo3::exceptions::PyValueError;
+use scraper::{Html, Selector};
+use std::collections::{HashMap, HashSet};
+use url::Url;
+
+/// A single field of an extraction spec.
+/// `"sel"` extracts the text of every match, `"sel@attr"` an attribute of every match,
+/// `"@links"` every absolute link on the page and `"@meta"` the page's meta tags.
+pub enum Rule {
+    Text(Selector),
+    Attr(Selector, String),
+    Links,
+    Meta,
+}
+
+/// Maps the name of each field to extract to its rule, extracted from a `dict[str, str]`.
+pub struct ExtractSpec(Vec<(String, Rule)>);
+
+/// The value extracted for a field.
+pub enum Extracted {
+    List(Vec<String>),
+    Map(HashMap<String, String>),
+}
+
+impl<'py> FromPyObject<'py> for ExtractSpec {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        let fields: HashMap<String, String> = ob.extract()?;
+        let rules = fields.into_iter()
+            .map(|(name, rule)| Ok((name, Rule::parse(&rule).map_err(PyValueError::new_err)?)))
+            .collect::<PyResult<Vec<_>>>()?;
+        Ok(ExtractSpec(rules))
+    }
+}
+
+impl IntoPy<PyObject> for Extracted {
+    fn into_py(self, py: Python<'_>) -> PyObject {
+        match self {
+            Extracted::List(x) => x.into_py(py),
+            Extracted::Map(x) => x.into_py(py),
+        }
+    }
+}
+
+impl Rule {
+    fn parse(rule: &str) -> Result<Self, String> {
+        match rule.trim() {
+            "@links" => return Ok(Rule::Links),
+            "@meta" => return Ok(Rule::Meta),
+            _ => {}
+        }
+        match rule.rsplit_once('@') {
+            Some((sel, attr)) if !attr.is_empty() && !attr.contains(|c: char| c == ']' || c.is_whitespace()) => {
+                Ok(Rule::Attr(parse_selector(sel)?, attr.to_string()))
+            }
+            _ => Ok(Rule::Text(parse_selector(rule)?)),
+        }
+    }
+}
+
+impl ExtractSpec {
+    /// Parses the page once and extracts every field from it
+    pub fn apply(&self, html: &str, page_url: &str) -> HashMap<String, Extracted> {
+        let doc = Html::parse_document(html);
+        self.0.iter().map(|(name, rule)| {
+            let value = match rule {
+                Rule::Text(sel) => Extracted::List(select_text(&doc, sel)),
+                Rule::Attr(sel, attr) => Extracted::List(select_attr(&doc, sel, attr)),
+                Rule::Links => Extracted::List(links(&doc, page_url)),
+                Rule::Meta => Extracted::Map(meta(&doc)),
+            };
+            (name.clone(), value)
+        }).collect()
+    }
+}
+
+pub fn parse_selector(selector: &str) -> Result<Selector, String> {
+    Selector::parse(selector.trim()).map_err(|e| format!("Invalid selector `{selector}`: {e}"))
+}
+
+/// The text of every element matching `sel`, with its whitespace collapsed
+pub fn select_text(doc: &Html, sel: &Selector) -> Vec<String> {
+    doc.select(sel)
+        .map(|el| el.text().flat_map(str::split_whitespace).collect::<Vec<_>>().join(" "))
+        .collect()
+}
+
+/// The `attr` attribute of every element matching `sel` that has it
+pub fn select_attr(doc: &Html, sel: &Selector, attr: &str) -> Vec<String> {
+    doc.select(sel)
+        .filter_map(|el| el.value().attr(attr))
+        .map(|v| v.trim().to_string())
+        .collect()
+}
+
+/// Every distinct http(s) link of the page, resolved against its `<base>` or `page_url`, without fragments
+pub fn links(doc: &Html, page_url: &str) -> Vec<String> {
+    let page = Url::parse(page_url).ok();
+    let base_sel = Selector::parse("base[href]").unwrap();
+    let base = doc.select(&base_sel)
+        .next()
+        .and_then(|el| el.value().attr("href"))
+        .and_then(|href| resolve(page.as_ref(), href))
+        .or(page);
+
+    let link_sel = Selector::parse("a[href], area[href]").unwrap();
+    let mut seen = HashSet::new();
+    doc.select(&link_sel)
+        .filter_map(|el| el.value().attr("href"))
+        .filter_map(|href| resolve(base.as_ref(), href))
+        .filter(|url| url.scheme() == "http" || url.scheme() == "https")
+        .map(|mut url| {
+            url.set_fragment(None);
+            url.to_string()
+        })
+        .filter(|url| seen.insert(url.clone()))
+        .collect()
+}
+
+/// The content of every meta tag keyed by its lowercased `name`, `property` or `http-equiv`.
+/// A `<meta charset>` tag is stored under `charset`.
+pub fn meta(doc: &Html) -> HashMap<String, String> {
+    let sel = Selector::parse("meta").unwrap();
+    let mut res = HashMap::new();
+    for el in doc.select(&sel) {
+        let el = el.value();
+        if let Some(charset) = el.attr("charset") {
+            res.insert(String::from("charset"), charset.trim().to_ascii_lowercase());
+        }
+        let key = el.attr("name").or(el.attr("property")).or(el.attr("http-equiv"));
+        if let (Some(key), Some(content)) = (key, el.attr("content")) {
+            res.entry(key.trim().to_ascii_lowercase()).or_insert_with(|| content.trim().to_string());
+        }
+    }
+    res
+}
+
+/// The charset declared by the page's meta tags, if any
+pub fn meta_charset(doc: &Html) -> Option<String> {
+    let tags = meta(doc);
+    tags.get("charset")
+        .cloned()
+        .or_else(|| tags.get("content-type").and_then(|ct| charset_param(ct)))
+}
+
+/// The `charset` parameter of a content-type value
+pub fn charset_param(content_type: &str) -> Option<String> {
+    content_type.split(';')
+        .filter_map(|part| part.trim().split_once('='))
+        .find(|(k, _)| k.trim().eq_ignore_ascii_case("charset"))
+        .map(|(_, v)| v.trim().trim_matches(|c| c == '"' || c == '\'').to_ascii_lowercase())
+        .filter(|v| !v.is_empty())
+}
+
+// Helper Functions
+fn resolve(base: Option<&Url>, href: &str) -> Option<Url> {
+    let href = href.trim();
+    match base {
+        Some(base) => base.join(href).ok(),
+        None => Url::parse(href).ok(),
+    }
+}
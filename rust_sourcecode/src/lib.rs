@@ -1,10 +1,21 @@
 mod response;
+mod body;
+mod batch;
+mod sink;
+mod extract;
+mod timeouts;
+mod proxy_pool;
+mod cancel;
 mod async_session;
 mod thread_session;
 
-use response::HttpResponse;
+use response::{HttpResponse, set_max_decompressed_size};
 use async_session::AsyncSessionRs;
 use thread_session::ThreadSessionRs;
+use sink::{BatchSink, SinkManifest};
+use timeouts::{TimeoutPolicy, set_timeout_policy, host_latency};
+use proxy_pool::ProxyPool;
+use cancel::CancelToken;
 use pyo3::prelude::*;
 
 /// A Python module implemented in Rust.
@@ -13,5 +24,13 @@ fn pygrab_ll(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<AsyncSessionRs>()?;
     m.add_class::<ThreadSessionRs>()?;
     m.add_class::<HttpResponse>()?;
+    m.add_class::<BatchSink>()?;
+    m.add_class::<SinkManifest>()?;
+    m.add_class::<TimeoutPolicy>()?;
+    m.add_class::<ProxyPool>()?;
+    m.add_class::<CancelToken>()?;
+    m.add_function(wrap_pyfunction!(set_max_decompressed_size, m)?)?;
+    m.add_function(wrap_pyfunction!(set_timeout_policy, m)?)?;
+    m.add_function(wrap_pyfunction!(host_latency, m)?)?;
     Ok(())
 }
\ No newline at end of file
@@ -0,0 +1,307 @@
+use pyo3::prelude::*;
+use pyo3::types::PyDict;
+use pyo3::exceptions::PyValueError;
+use reqwest::blocking::Client;
+use std::sync::{Arc, Condvar, Mutex, OnceLock};
+use std::time::{Duration, Instant};
+
+/// Weight of the newest sample in the latency and error rate moving averages
+const EWMA_ALPHA: f64 = 0.2;
+/// A proxy isn't ejected before it has served this many requests
+const MIN_SAMPLES: u64 = 5;
+
+/// A set of proxies that requests are spread over.
+///
+/// Each proxy keeps a moving average of its latency and error rate, and is picked at random with a weight
+/// favouring fast and reliable proxies. A proxy serves at most `max_concurrency` requests at once. Once its
+/// error rate reaches `eject_error_rate` it is ejected for `cooldown` seconds, then re-admitted on probation.
+#[pyclass]
+#[derive(Clone)]
+pub struct ProxyPool {
+    inner: Arc<PoolInner>,
+}
+
+struct PoolInner {
+    urls: Vec<String>,
+    health: Mutex<Vec<ProxyHealth>>,
+    freed: Condvar,
+    max_concurrency: usize,
+    eject_error_rate: f64,
+    cooldown: Duration,
+}
+
+struct ProxyHealth {
+    in_flight: usize,
+    latency: f64,
+    error_rate: f64,
+    requests: u64,
+    failures: u64,
+    ejected_until: Option<Instant>,
+}
+
+/// A proxy slot taken from the pool. It's given back when finished (or dropped).
+pub struct Lease {
+    pool: ProxyPool,
+    pub index: usize,
+    start: Instant,
+    released: bool,
+}
+
+/// The proxy of a `ThreadSessionRs`, extracted from either a proxy url or a `ProxyPool`.
+/// `AsyncSessionRs` only takes a proxy url.
+pub enum ProxySetting {
+    Url(String),
+    Pool(ProxyPool),
+}
+
+/// One client per proxy of a pool. Each is only built once a request goes through its proxy,
+/// since sessions are often created for a single request.
+pub struct PoolClients {
+    pool: ProxyPool,
+    clients: Vec<OnceLock<Client>>,
+    make_client: Box<dyn Fn(&str) -> Client + Send + Sync>,
+}
+
+/// Sends requests on the session's client, or on the client of a proxy picked from its pool.
+#[derive(Clone)]
+pub struct ClientRouter {
+    client: Client,
+    pool: Option<Arc<PoolClients>>,
+}
+
+impl<'py> FromPyObject<'py> for ProxySetting {
+    fn extract_bound(ob: &Bound<'py, PyAny>) -> PyResult<Self> {
+        if let Ok(pool) = ob.extract::<ProxyPool>() {
+            return Ok(ProxySetting::Pool(pool));
+        }
+        Ok(ProxySetting::Url(ob.extract()?))
+    }
+}
+
+#[pymethods]
+impl ProxyPool {
+    #[new]
+    #[pyo3(signature = (proxies, max_concurrency=None, eject_error_rate=0.5, cooldown=30.0))]
+    pub fn new(proxies: Vec<String>, max_concurrency: Option<usize>, eject_error_rate: f64, cooldown: f64) -> PyResult<Self> {
+        if proxies.is_empty() {
+            return Err(PyValueError::new_err("a proxy pool needs at least one proxy"));
+        }
+        for proxy in proxies.iter() {
+            reqwest::Proxy::all(proxy).map_err(|e| PyValueError::new_err(format!("Invalid proxy `{proxy}`: {e}")))?;
+        }
+        if max_concurrency == Some(0) {
+            return Err(PyValueError::new_err("`max_concurrency` must be positive"));
+        }
+        if !(eject_error_rate > 0.0 && eject_error_rate <= 1.0) {
+            return Err(PyValueError::new_err("`eject_error_rate` must be between 0 and 1"));
+        }
+        if !(cooldown >= 0.0) || !cooldown.is_finite() {
+            return Err(PyValueError::new_err("`cooldown` must be a positive number of seconds"));
+        }
+
+        let health = proxies.iter().map(|_| ProxyHealth {
+            in_flight: 0,
+            latency: 0.0,
+            error_rate: 0.0,
+            requests: 0,
+            failures: 0,
+            ejected_until: None,
+        }).collect();
+        Ok(ProxyPool {
+            inner: Arc::new(PoolInner {
+                urls: proxies,
+                health: Mutex::new(health),
+                freed: Condvar::new(),
+                max_concurrency: max_concurrency.unwrap_or(0),
+                eject_error_rate: eject_error_rate,
+                cooldown: Duration::from_secs_f64(cooldown),
+            }),
+        })
+    }
+
+    /// The health of every proxy: its latency and error rate averages, requests in flight,
+    /// request and failure counts and whether it's currently admitted.
+    pub fn stats(&self, py: Python<'_>) -> PyResult<Vec<PyObject>> {
+        let health = self.inner.health.lock().unwrap();
+        let now = Instant::now();
+        self.inner.urls.iter().zip(health.iter()).map(|(url, h)| {
+            let dict = PyDict::new_bound(py);
+            dict.set_item("proxy", url)?;
+            dict.set_item("latency", h.latency)?;
+            dict.set_item("error_rate", h.error_rate)?;
+            dict.set_item("in_flight", h.in_flight)?;
+            dict.set_item("requests", h.requests)?;
+            dict.set_item("failures", h.failures)?;
+            dict.set_item("healthy", h.ejected_until.map_or(true, |t| now >= t))?;
+            Ok(dict.into_py(py))
+        }).collect()
+    }
+
+    pub fn __len__(&self) -> usize {
+        self.inner.urls.len()
+    }
+
+    pub fn __repr__(&self) -> String {
+        format!("<ProxyPool [{} proxies]>", self.inner.urls.len())
+    }
+}
+
+// Rust only methods
+impl ProxyPool {
+    pub fn urls(&self) -> &[String] {
+        &self.inner.urls
+    }
+
+    /// Picks a proxy, waiting for one to have a free slot if they're all at `max_concurrency`.
+    /// Gives up and returns `None` once `stopped` returns true while waiting.
+    pub fn acquire<S: Fn() -> bool>(&self, stopped: S) -> Option<Lease> {
+        let inner = &self.inner;
+        let mut health = inner.health.lock().unwrap();
+        loop {
+            let now = Instant::now();
+            for h in health.iter_mut() {
+                if matches!(h.ejected_until, Some(t) if now >= t) {
+                    // Re-admitted on probation, a couple more failures eject it again
+                    h.ejected_until = None;
+                    h.error_rate = inner.eject_error_rate / 2.0;
+                }
+            }
+            // Never stall the whole pool, if every proxy is ejected the one closest to re-admission is used
+            if health.iter().all(|h| h.ejected_until.is_some()) {
+                if let Some(h) = health.iter_mut().min_by_key(|h| h.ejected_until) {
+                    h.ejected_until = None;
+                    h.error_rate = inner.eject_error_rate / 2.0;
+                }
+            }
+
+            let candidates: Vec<(usize, f64)> = health.iter()
+                .enumerate()
+                .filter(|(_, h)| h.ejected_until.is_none())
+                .filter(|(_, h)| inner.max_concurrency == 0 || h.in_flight < inner.max_concurrency)
+                .map(|(i, h)| (i, h.score()))
+                .collect();
+
+            if let Some(index) = weighted_choice(&candidates) {
+                health[index].in_flight += 1;
+                return Some(Lease { pool: self.clone(), index: index, start: Instant::now(), released: false });
+            }
+            if stopped() {
+                return None;
+            }
+            health = inner.freed.wait_timeout(health, Duration::from_millis(100)).unwrap().0;
+        }
+    }
+
+    fn release(&self, index: usize, outcome: Option<(bool, f64)>) {
+        let inner = &self.inner;
+        let mut health = inner.health.lock().unwrap();
+        let h = &mut health[index];
+        h.in_flight -= 1;
+
+        if let Some((ok, elapsed)) = outcome {
+            h.requests += 1;
+            if ok {
+                // Failed requests usually ran into a timeout, so only successes are timed
+                h.latency = if h.latency == 0.0 { elapsed } else { ewma(h.latency, elapsed) };
+            } else {
+                h.failures += 1;
+            }
+            h.error_rate = ewma(h.error_rate, if ok { 0.0 } else { 1.0 });
+            if h.requests >= MIN_SAMPLES && h.error_rate >= inner.eject_error_rate && h.ejected_until.is_none() {
+                h.ejected_until = Some(Instant::now() + inner.cooldown);
+            }
+        }
+        drop(health);
+        inner.freed.notify_all();
+    }
+}
+
+impl ProxyHealth {
+    fn score(&self) -> f64 {
+        // Proxies without a successful request yet are treated as taking a second
+        let latency = if self.latency == 0.0 { 1.0 } else { self.latency.max(0.01) };
+        1.0 / (latency * (1.0 + 4.0 * self.error_rate))
+    }
+}
+
+impl Lease {
+    pub fn finish(mut self, ok: bool) {
+        self.released = true;
+        self.pool.release(self.index, Some((ok, self.start.elapsed().as_secs_f64())));
+    }
+}
+
+impl Drop for Lease {
+    fn drop(&mut self) {
+        if !self.released {
+            self.pool.release(self.index, None);
+        }
+    }
+}
+
+impl PoolClients {
+    pub fn new<F>(pool: ProxyPool, make_client: F) -> Self
+    where
+        F: Fn(&str) -> Client + Send + Sync + 'static,
+    {
+        let clients = pool.urls().iter().map(|_| OnceLock::new()).collect();
+        PoolClients { pool, clients, make_client: Box::new(make_client) }
+    }
+
+    fn client(&self, index: usize) -> &Client {
+        self.clients[index].get_or_init(|| (self.make_client)(&self.pool.urls()[index]))
+    }
+}
+
+impl ClientRouter {
+    pub fn new(client: Client, pool: Option<Arc<PoolClients>>) -> Self {
+        ClientRouter { client, pool }
+    }
+
+    /// Runs `f` with the client to send a request on, recording the outcome against the proxy it went through
+    pub fn run<T, F>(&self, f: F) -> Result<T, String>
+    where
+        F: FnOnce(&Client) -> Result<T, String>,
+    {
+        self.run_until(|| false, f)
+    }
+
+    /// Like `run`, but gives up waiting for a free proxy once `stopped` returns true.
+    /// A request that fails once `stopped` is true was cut short, so it isn't held against its proxy.
+    pub fn run_until<T, F, S>(&self, stopped: S, f: F) -> Result<T, String>
+    where
+        F: FnOnce(&Client) -> Result<T, String>,
+        S: Fn() -> bool,
+    {
+        match &self.pool {
+            None => f(&self.client),
+            Some(pool) => {
+                let lease = pool.pool.acquire(&stopped).ok_or_else(|| String::from("batch stopped"))?;
+                let res = f(pool.client(lease.index));
+                match &res {
+                    // Dropping the lease gives the slot back without an outcome
+                    Err(_) if stopped() => drop(lease),
+                    _ => lease.finish(res.is_ok()),
+                }
+                res
+            }
+        }
+    }
+}
+
+// Helper Functions
+fn ewma(avg: f64, sample: f64) -> f64 {
+    avg + EWMA_ALPHA * (sample - avg)
+}
+
+fn weighted_choice(candidates: &[(usize, f64)]) -> Option<usize> {
+    let total: f64 = candidates.iter().map(|(_, w)| w).sum();
+    let mut r = fastrand::f64() * total;
+    for (index, weight) in candidates {
+        if r < *weight {
+            return Some(*index);
+        }
+        r -= weight;
+    }
+    candidates.last().map(|(index, _)| *index)
+}
@@ -1,38 +1,71 @@
-use flate2::read::GzDecoder;
+use flate2::read::{GzDecoder, ZlibDecoder, DeflateDecoder};
 use brotli::Decompressor;
 use pyo3::prelude::*;
+use pyo3::buffer::PyBuffer;
 use pyo3::types::{PyDict, PyList};
 use pyo3::exceptions::{PyUnicodeDecodeError, PyException, PyValueError};
 use std::io::Read;
 use std::collections::HashMap;
+use std::time::Duration;
+use std::sync::atomic::{AtomicUsize, Ordering};
 use serde_json::Value as JsonValue;
+use scraper::Html;
+use crate::extract::{self, ExtractSpec, Extracted};
+
+/// Content codings that can be decoded. `identity` means no coding and is skipped.
+const SUPPORTED_ENCODINGS: [&str; 6] = ["gzip", "x-gzip", "deflate", "br", "zstd", "identity"];
+
+/// The largest size a body may decompress to, in bytes. 0 means no limit.
+static MAX_DECOMPRESSED_SIZE: AtomicUsize = AtomicUsize::new(0);
+
+/// Sets the largest size (in bytes) a response body may decompress to. `None` removes the limit.
+/// Bodies that would grow past the limit raise an exception instead of being decompressed.
+#[pyfunction]
+#[pyo3(signature = (limit=None))]
+pub fn set_max_decompressed_size(limit: Option<usize>) {
+    MAX_DECOMPRESSED_SIZE.store(limit.unwrap_or(0), Ordering::Relaxed);
+}
 
 #[pyclass]
+#[derive(Clone)]
 pub struct HttpResponse {
     body: Vec<u8>,
     status_code: u16,
     headers: HashMap<String, String>,
     encoding: String,
+    url: String,
+    elapsed: f64,
 }
 
 #[pymethods]
 impl HttpResponse {
     #[new]
-    pub fn new(body: Vec<u8>, status_code: u16, headers: HashMap<String, String>) -> Self {
+    #[pyo3(signature = (body, status_code, headers, url=None, elapsed=None))]
+    pub fn new(
+        body: Vec<u8>, 
+        status_code: u16, 
+        headers: HashMap<String, String>, 
+        url: Option<String>, 
+        elapsed: Option<f64>
+    ) -> Self {
         let mut res = HttpResponse {
             body: body,
             status_code: status_code,
             headers: headers,
             encoding: String::from(""),
+            url: url.unwrap_or_default(),
+            elapsed: elapsed.unwrap_or(0.0),
         };
-        res.get_encoding();
+        res.sniff_encoding();
         res
     }
 
     pub fn json(&mut self, py: Python) -> PyResult<PyObject> {
-        let text = self.get_text()?;
-        let parsed: JsonValue = serde_json::from_str(&text)
-        .map_err(|e| PyErr::new::<PyValueError, _>(format!("JSON parse error: {}", e)))?;
+        // Decompressing and parsing run without the GIL, it's only needed to build the python objects
+        let parsed: JsonValue = py.allow_threads(|| {
+            self.decompress_inner()?;
+            serde_json::from_slice(&self.body).map_err(|e| format!("JSON parse error: {}", e))
+        }).map_err(|e| PyErr::new::<PyValueError, _>(e))?;
         json_parser_helper(py, &parsed)
     }
 
@@ -40,41 +73,29 @@ impl HttpResponse {
         self.body.as_slice()
     }
 
-    pub fn decompress_body(&mut self) -> PyResult<()> {
-        if !self.is_compressed() { return Ok(()); }
-
-        if self.encoding == "gzip" {
-            let mut decoder = GzDecoder::new(self.body.as_slice());
-            let mut v: Vec<u8> = Vec::new();
-            if let Err(e) = decoder.read_to_end(&mut v) { 
-                return Err(PyException::new_err(format!("Unable to decompress response body: {e}")));
-            }
-            self.body = v;
-        }
-        else if self.encoding == "br" {
-            let mut decoder = Decompressor::new(self.body.as_slice(), 4096);
-            let mut v = Vec::new();
-            if let Err(e) = decoder.read_to_end(&mut v) {
-                return Err(PyException::new_err(format!("Unable to decompress response body: {e}")));
-            }
-            self.body = v;
-        }
-        self.encoding = String::from("utf-8");
-        Ok(())
+    #[pyo3(signature = (max_size=None))]
+    pub fn decompress_body(&mut self, py: Python, max_size: Option<usize>) -> PyResult<()> {
+        py.allow_threads(|| match max_size {
+            Some(limit) => self.decompress_limited(limit),
+            None => self.decompress_inner(),
+        }).map_err(|e| PyException::new_err(e))
     }
 
     #[getter]
-    pub fn get_text(&mut self) -> PyResult<String> {
-        self.decompress_body()?;
-        if let Ok(text) = String::from_utf8(self.body.clone()){
-            return Ok(text);
-        }
-        Err(PyUnicodeDecodeError::new_err(String::from("response body could not be decoded")))
+    pub fn get_text(&mut self, py: Python) -> PyResult<String> {
+        // Decompression errors raise as they do for `content`, only invalid utf-8 is a UnicodeDecodeError
+        self.decompress_body(py, None)?;
+        let body = self.body.as_slice();
+        py.allow_threads(|| std::str::from_utf8(body).map(str::to_owned))
+            .map_err(|e| match PyUnicodeDecodeError::new_utf8_bound(py, body, e) {
+                Ok(err) => PyErr::from_value_bound(err.into_any()),
+                Err(err) => err,
+            })
     }
 
     #[getter]
-    pub fn get_content(&mut self) -> PyResult<&[u8]> {
-        self.decompress_body()?;
+    pub fn get_content(&mut self, py: Python) -> PyResult<&[u8]> {
+        self.decompress_body(py, None)?;
         Ok(self.body.as_slice())
     }
 
@@ -88,8 +109,220 @@ impl HttpResponse {
         self.headers.clone()
     }
 
+    /// The final url of the response, after any redirects were followed
+    #[getter]
+    pub fn get_url(&self) -> &str {
+        self.url.as_str()
+    }
+
+    /// Seconds between sending the request and receiving the response headers (or finishing the render)
+    #[getter]
+    pub fn get_elapsed(&self) -> f64 {
+        self.elapsed
+    }
+
     #[getter]
-    pub fn get_encoding (&mut self) -> &str {
+    pub fn get_ok(&self) -> bool {
+        self.status_code < 400
+    }
+
+    #[getter]
+    pub fn get_encoding (&mut self, py: Python) -> String {
+        py.allow_threads(|| self.sniff_encoding().to_string())
+    }
+
+    /// The whitespace collapsed text of every element matching the CSS `selector`
+    pub fn select(&mut self, py: Python, selector: &str) -> PyResult<Vec<String>> {
+        let sel = extract::parse_selector(selector).map_err(|e| PyValueError::new_err(e))?;
+        py.allow_threads(|| {
+            let doc = Html::parse_document(&self.html()?);
+            Ok(extract::select_text(&doc, &sel))
+        }).map_err(|e: String| PyException::new_err(e))
+    }
+
+    /// The `attr` attribute of every element matching the CSS `selector`
+    pub fn select_attr(&mut self, py: Python, selector: &str, attr: &str) -> PyResult<Vec<String>> {
+        let sel = extract::parse_selector(selector).map_err(|e| PyValueError::new_err(e))?;
+        py.allow_threads(|| {
+            let doc = Html::parse_document(&self.html()?);
+            Ok(extract::select_attr(&doc, &sel, attr))
+        }).map_err(|e: String| PyException::new_err(e))
+    }
+
+    /// Every distinct http(s) link on the page, resolved against the final url of the response
+    pub fn links(&mut self, py: Python) -> PyResult<Vec<String>> {
+        py.allow_threads(|| {
+            let doc = Html::parse_document(&self.html()?);
+            Ok(extract::links(&doc, &self.url))
+        }).map_err(|e: String| PyException::new_err(e))
+    }
+
+    /// The content of the page's meta tags, keyed by their name, property or http-equiv
+    pub fn meta(&mut self, py: Python) -> PyResult<HashMap<String, String>> {
+        py.allow_threads(|| {
+            let doc = Html::parse_document(&self.html()?);
+            Ok(extract::meta(&doc))
+        }).map_err(|e: String| PyException::new_err(e))
+    }
+
+    /// The charset from the content-type header, or else from the page's meta tags
+    pub fn charset(&mut self, py: Python) -> PyResult<Option<String>> {
+        if let Some(charset) = self.headers.get("content-type").and_then(|ct| extract::charset_param(ct)) {
+            return Ok(Some(charset));
+        }
+        py.allow_threads(|| {
+            let doc = Html::parse_document(&self.html()?);
+            Ok(extract::meta_charset(&doc))
+        }).map_err(|e: String| PyException::new_err(e))
+    }
+
+    /// An independent copy of the response, decompressing or reading one doesn't affect the other
+    pub fn copy(&self) -> Self {
+        self.clone()
+    }
+
+    pub fn __copy__(&self) -> Self {
+        self.clone()
+    }
+
+    /// The size of the decompressed body, which is what `copy_into` writes
+    pub fn body_len(&mut self, py: Python) -> PyResult<usize> {
+        self.decompress_body(py, None)?;
+        Ok(self.body.len())
+    }
+
+    /// Decompresses the body and copies it into the start of a writable buffer, such as a shared memory block,
+    /// without creating a bytes object. Returns the number of bytes written.
+    pub fn copy_into(&mut self, py: Python, buffer: PyBuffer<u8>) -> PyResult<usize> {
+        self.decompress_body(py, None)?;
+        if buffer.readonly() || !buffer.is_c_contiguous() {
+            return Err(PyValueError::new_err("buffer must be writable and contiguous"));
+        }
+        if buffer.len_bytes() < self.body.len() {
+            return Err(PyValueError::new_err(format!(
+                "buffer holds {} bytes, the body needs {}", buffer.len_bytes(), self.body.len()
+            )));
+        }
+        let body = &self.body;
+        py.allow_threads(|| unsafe {
+            // The buffer was checked to be writable, contiguous and large enough
+            std::ptr::copy_nonoverlapping(body.as_ptr(), buffer.buf_ptr() as *mut u8, body.len());
+        });
+        Ok(self.body.len())
+    }
+
+    /// Builds a response whose body is copied out of a buffer in one go, such as the block filled by `copy_into`
+    #[staticmethod]
+    #[pyo3(signature = (buffer, status_code, headers, url=None, elapsed=None))]
+    pub fn from_buffer(
+        py: Python,
+        buffer: PyBuffer<u8>,
+        status_code: u16,
+        headers: HashMap<String, String>,
+        url: Option<String>,
+        elapsed: Option<f64>
+    ) -> PyResult<Self> {
+        Ok(Self::new(buffer.to_vec(py)?, status_code, headers, url, elapsed))
+    }
+
+    pub fn __str__(&self) -> String {
+        format!("<Response [{}]>", self.status_code)
+    }
+
+    pub fn __repr__(&self) -> String {
+        format!("<Response [{}]>", self.status_code)
+    }
+}
+
+// Rust only methods
+impl HttpResponse {
+    pub fn from_reqwest_blocking(res: reqwest::blocking::Response) -> Self {
+        let (status_code, url, headers) = Self::blocking_head(&res);
+        let body = match res.bytes() {
+            Ok(x) => { x.to_vec() }
+            Err(_) => { Vec::new() }
+        };
+        Self::new(body, status_code, headers, Some(url), None)
+    }
+
+    /// Like `from_reqwest_blocking`, but reads the body a chunk at a time and gives up
+    /// as soon as `stopped` returns true, so a stopped batch doesn't keep downloading. Unlike it, a body that
+    /// couldn't be read in full is an error rather than an empty response, so the request counts as failed
+    pub fn from_reqwest_blocking_until<F: Fn() -> bool>(mut res: reqwest::blocking::Response, stopped: F) -> Result<Self, String> {
+        let (status_code, url, headers) = Self::blocking_head(&res);
+        let mut body = Vec::new();
+        let mut buf = vec![0u8; 64 * 1024];
+        loop {
+            if stopped() { return Err(String::from("batch stopped")); }
+            match res.read(&mut buf) {
+                Ok(0) => break,
+                Ok(n) => body.extend_from_slice(&buf[..n]),
+                Err(e) => return Err(e.to_string()),
+            }
+        }
+        Ok(Self::new(body, status_code, headers, Some(url), None))
+    }
+
+    fn blocking_head(res: &reqwest::blocking::Response) -> (u16, String, HashMap<String, String>) {
+        let headers = res.headers().iter();
+        let headers: HashMap<String, String> = headers.map(|(k, v)| {
+            (k.to_string().to_ascii_lowercase(), v.to_str().unwrap_or_default().to_string())
+        }).collect();
+        (res.status().as_u16(), res.url().to_string(), headers)
+    }
+
+    pub async fn from_reqwest(res: reqwest::Response) -> Self {
+        let status_code = res.status().as_u16();
+        let url = res.url().to_string();
+        let headers = res.headers().iter();
+        let headers: HashMap<String, String> = headers.map(|(k, v)| {
+            (k.to_string().to_ascii_lowercase(), v.to_str().unwrap_or_default().to_string())
+        }).collect();
+        let body = match res.bytes().await {
+            Ok(x) => { x.to_vec() }
+            Err(_) => { Vec::new() }
+        };
+        Self::new(body, status_code, headers, Some(url), None)
+    }
+
+    pub fn status(&self) -> u16 {
+        self.status_code
+    }
+
+    pub fn header_map(&self) -> &HashMap<String, String> {
+        &self.headers
+    }
+
+    pub fn url(&self) -> &str {
+        self.url.as_str()
+    }
+
+    pub fn elapsed(&self) -> f64 {
+        self.elapsed
+    }
+
+    /// The body as it was received, before any decompression
+    pub fn raw_body(&self) -> &[u8] {
+        self.body.as_slice()
+    }
+
+    pub fn decompressed_body(&mut self) -> Result<&[u8], String> {
+        self.decompress_inner()?;
+        Ok(self.body.as_slice())
+    }
+
+    /// Runs an extraction spec over the page, used by batches so only the extracted fields reach python
+    pub fn extract(&mut self, spec: &ExtractSpec) -> Result<HashMap<String, Extracted>, String> {
+        let html = self.html()?;
+        Ok(spec.apply(&html, &self.url))
+    }
+
+    pub fn with_elapsed(mut self, elapsed: Duration) -> Self {
+        self.elapsed = elapsed.as_secs_f64();
+        self
+    }
+
+    fn sniff_encoding (&mut self) -> &str {
         if self.encoding == "" {
             if self.headers.contains_key("content-encoding") {
                 self.encoding = self.headers.get("content-encoding")
@@ -98,7 +331,7 @@ impl HttpResponse {
                     .to_ascii_lowercase();
             }
             else {
-                let text = match self.get_text() {
+                let text = match self.decompress_inner().and_then(|_| self.decode_text()) {
                     Ok(x) => { x }
                     Err(_) => { 
                         self.encoding = String::from("utf-8");
@@ -120,50 +353,86 @@ impl HttpResponse {
         self.encoding.as_str()
     }
 
-    pub fn __str__(&self) -> String {
-        format!("<Response [{}]>", self.status_code)
+    fn decompress_inner(&mut self) -> Result<(), String> {
+        self.decompress_limited(MAX_DECOMPRESSED_SIZE.load(Ordering::Relaxed))
     }
 
-    pub fn __repr__(&self) -> String {
-        format!("<Response [{}]>", self.status_code)
+    /// Undoes every coding listed in the content-encoding, last applied first.
+    /// Nothing is changed if any of the codings fails or the body grows past `limit` bytes (0 for no limit).
+    fn decompress_limited(&mut self, limit: usize) -> Result<(), String> {
+        if !self.is_compressed() { return Ok(()); }
+
+        let mut body: Option<Vec<u8>> = None;
+        for coding in self.encoding.rsplit(',').map(str::trim) {
+            let input = body.as_deref().unwrap_or(self.body.as_slice());
+            let decoded = match coding {
+                "gzip" | "x-gzip" => read_limited(GzDecoder::new(input), limit),
+                "deflate" => {
+                    // `deflate` should be zlib wrapped, but some servers send a raw deflate stream
+                    if is_zlib_header(input) { read_limited(ZlibDecoder::new(input), limit) }
+                    else { read_limited(DeflateDecoder::new(input), limit) }
+                },
+                "br" => read_limited(Decompressor::new(input, 4096), limit),
+                "zstd" => zstd::stream::read::Decoder::new(input)
+                    .map_err(|e| format!("Unable to decompress response body: {e}"))
+                    .and_then(|decoder| read_limited(decoder, limit)),
+                _ => continue,
+            };
+            body = Some(decoded?);
+        }
+
+        if let Some(body) = body { self.body = body; }
+        self.encoding = String::from("utf-8");
+        Ok(())
     }
-}
 
-// Rust only methods
-impl HttpResponse {
-    pub fn from_reqwest_blocking(res: reqwest::blocking::Response) -> Self {
-        let status_code = res.status().as_u16();
-        let headers = res.headers().iter();
-        let headers: HashMap<String, String> = headers.map(|(k, v)| {
-            (k.to_string().to_ascii_lowercase(), v.to_str().unwrap_or_default().to_string())
-        }).collect();
-        let body = match res.bytes() {
-            Ok(x) => { x.to_vec() }
-            Err(_) => { Vec::new() }
-        };
-        Self::new(body, status_code, headers)
+    /// The decompressed body as a string, invalid utf-8 is replaced rather than failing the parse
+    fn html(&mut self) -> Result<String, String> {
+        self.decompress_inner()?;
+        Ok(String::from_utf8_lossy(&self.body).into_owned())
     }
 
-    pub async fn from_reqwest(res: reqwest::Response) -> Self {
-        let status_code = res.status().as_u16();
-        let headers = res.headers().iter();
-        let headers: HashMap<String, String> = headers.map(|(k, v)| {
-            (k.to_string().to_ascii_lowercase(), v.to_str().unwrap_or_default().to_string())
-        }).collect();
-        let body = match res.bytes().await {
-            Ok(x) => { x.to_vec() }
-            Err(_) => { Vec::new() }
-        };
-        Self::new(body, status_code, headers)
+    fn decode_text(&self) -> Result<String, String> {
+        match std::str::from_utf8(&self.body) {
+            Ok(text) => Ok(text.to_owned()),
+            Err(_) => Err(String::from("response body could not be decoded")),
+        }
     }
 
-    #[inline]
+    /// Whether the encoding is a content-encoding list made only of codings we can decode.
+    /// Anything else (like a charset mistakenly sent as the content-encoding) is left as raw bytes.
     fn is_compressed(&self) -> bool {
-        self.encoding == "gzip" || self.encoding == "br"
+        let mut codings = self.encoding.split(',').map(str::trim).filter(|c| !c.is_empty()).peekable();
+        codings.peek().is_some()
+            && codings.all(|c| SUPPORTED_ENCODINGS.contains(&c))
+            && self.encoding.split(',').any(|c| c.trim() != "identity")
     }
 }
 
 // Helper Functions
+
+/// Decompresses in chunks so a body that exceeds `limit` bytes is rejected without being fully inflated
+fn read_limited<R: Read>(mut decoder: R, limit: usize) -> Result<Vec<u8>, String> {
+    let mut v: Vec<u8> = Vec::new();
+    if limit == 0 {
+        decoder.read_to_end(&mut v)
+    } else {
+        // One byte past the limit tells a body at the limit apart from one over it
+        decoder.take((limit as u64).saturating_add(1)).read_to_end(&mut v)
+    }.map_err(|e| format!("Unable to decompress response body: {e}"))?;
+
+    if limit != 0 && v.len() > limit {
+        return Err(format!("Decompressed response body exceeds the limit of {limit} bytes"));
+    }
+    Ok(v)
+}
+
+fn is_zlib_header(data: &[u8]) -> bool {
+    data.len() >= 2
+        && data[0] & 0x0F == 8
+        && ((data[0] as u16) << 8 | data[1] as u16) % 31 == 0
+}
+
 fn json_parser_helper<'a>(py: Python<'a>, value: &JsonValue) -> PyResult<PyObject> {
     match value {
         JsonValue::String(s) => Ok(s.to_string().into_py(py)),
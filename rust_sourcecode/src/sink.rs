@@ -0,0 +1,288 @@
+use crate::response::HttpResponse;
+use pyo3::prelude::*;
+use pyo3::exceptions::{PyIOError, PyValueError};
+use base64::Engine;
+use flate2::{Compression, write::GzEncoder};
+use serde_json::json;
+use std::fs::{File, OpenOptions};
+use std::io::{self, BufWriter, Write};
+use std::sync::{Arc, Mutex};
+use std::time::{SystemTime, UNIX_EPOCH};
+
+/// Where and how batch results are archived.
+/// Records are appended to `{path}-00000.{format}[.gz]`, and a new file is started once a file reaches `rotate_bytes`.
+/// The current file stays open across batches, and files that already exist are skipped rather than overwritten.
+/// Compressed files hold one gzip member per record, so they can be read with any gzip or WARC tool.
+#[pyclass]
+#[derive(Clone)]
+pub struct BatchSink {
+    path: String,
+    format: SinkFormat,
+    compress: bool,
+    rotate_bytes: u64,
+    // Shared between the clones handed to each batch, so every batch appends to the same file
+    state: Arc<Mutex<SinkState>>,
+}
+
+struct SinkState {
+    next_file: usize,
+    current: Option<SinkFile>,
+}
+
+struct SinkFile {
+    path: String,
+    writer: BufWriter<File>,
+    bytes: u64,
+}
+
+#[derive(Clone, Copy, PartialEq)]
+enum SinkFormat {
+    Jsonl,
+    Warc,
+}
+
+/// What was written by a batch sent to a `BatchSink`.
+#[pyclass]
+pub struct SinkManifest {
+    #[pyo3(get)]
+    pub files: Vec<String>,
+    #[pyo3(get)]
+    pub records: usize,
+    #[pyo3(get)]
+    pub failed: Vec<String>,
+    #[pyo3(get)]
+    pub bytes: u64,
+}
+
+#[pymethods]
+impl BatchSink {
+    #[new]
+    #[pyo3(signature = (path, format="jsonl", compress=false, rotate_bytes=None))]
+    pub fn new(path: String, format: &str, compress: bool, rotate_bytes: Option<u64>) -> PyResult<Self> {
+        let format = match format.to_ascii_lowercase().as_str() {
+            "jsonl" => SinkFormat::Jsonl,
+            "warc" => SinkFormat::Warc,
+            _ => return Err(PyValueError::new_err("`format` must be 'jsonl' or 'warc'")),
+        };
+        if rotate_bytes == Some(0) {
+            return Err(PyValueError::new_err("`rotate_bytes` must be positive"));
+        }
+        Ok(BatchSink {
+            path: path,
+            format: format,
+            compress: compress,
+            rotate_bytes: rotate_bytes.unwrap_or(1 << 30),
+            state: Arc::new(Mutex::new(SinkState { next_file: 0, current: None })),
+        })
+    }
+
+    /// Closes the current file, the next record is written to a new one
+    pub fn close(&self) -> PyResult<()> {
+        let current = self.state.lock().unwrap().current.take();
+        if let Some(mut file) = current {
+            file.writer.flush().map_err(|e| PyIOError::new_err(e.to_string()))?;
+        }
+        Ok(())
+    }
+
+    pub fn __repr__(&self) -> String {
+        format!("<BatchSink [{}-*.{}]>", self.path, self.extension())
+    }
+}
+
+#[pymethods]
+impl SinkManifest {
+    pub fn __repr__(&self) -> String {
+        format!(
+            "<SinkManifest [{} records, {} failed, {} files, {} bytes]>",
+            self.records, self.failed.len(), self.files.len(), self.bytes
+        )
+    }
+}
+
+// Rust only methods
+impl BatchSink {
+    /// Serializes a response into a record, ready to be appended to a sink file.
+    /// Called from the worker threads so the writer only has to copy bytes.
+    pub fn encode(&self, mut res: HttpResponse) -> Result<Vec<u8>, String> {
+        let record = match self.format {
+            SinkFormat::Jsonl => Self::jsonl_record(&mut res)?,
+            SinkFormat::Warc => Self::warc_response_record(&res),
+        };
+        self.maybe_compress(record)
+    }
+
+    /// Appends every record received to the sink files until all the senders are dropped.
+    /// Failed requests are sent as the url they were for. The current file is flushed once the batch is over.
+    pub fn write_all<I>(&self, rx: I) -> Result<SinkManifest, String>
+    where
+        I: IntoIterator<Item = (usize, Result<Vec<u8>, String>)>,
+    {
+        let mut manifest = SinkManifest { files: Vec::new(), records: 0, failed: Vec::new(), bytes: 0 };
+
+        for (_, record) in rx {
+            let record = match record {
+                Ok(x) => x,
+                Err(url) => {
+                    manifest.failed.push(url);
+                    continue;
+                }
+            };
+
+            // Locked per record, batches sharing the sink interleave whole records
+            let mut state = self.state.lock().unwrap();
+            let full = state.current.as_ref().map_or(true, |f| f.bytes + record.len() as u64 > self.rotate_bytes);
+            if full {
+                if let Some(mut f) = state.current.take() {
+                    f.writer.flush().map_err(|e| e.to_string())?;
+                }
+                let mut f = self.open_next(&mut state)?;
+                if self.format == SinkFormat::Warc {
+                    let info = self.maybe_compress(Self::warcinfo_record(&f.path))?;
+                    f.writer.write_all(&info).map_err(|e| e.to_string())?;
+                    f.bytes += info.len() as u64;
+                    manifest.bytes += info.len() as u64;
+                }
+                state.current = Some(f);
+            }
+
+            let f = state.current.as_mut().unwrap();
+            f.writer.write_all(&record).map_err(|e| e.to_string())?;
+            f.bytes += record.len() as u64;
+            if !manifest.files.contains(&f.path) {
+                manifest.files.push(f.path.clone());
+            }
+            manifest.bytes += record.len() as u64;
+            manifest.records += 1;
+        }
+
+        if let Some(f) = self.state.lock().unwrap().current.as_mut() {
+            f.writer.flush().map_err(|e| e.to_string())?;
+        }
+        Ok(manifest)
+    }
+
+    /// Creates the first file after the last one opened that doesn't exist yet,
+    /// so a sink over the files of an earlier run starts after them instead of overwriting them
+    fn open_next(&self, state: &mut SinkState) -> Result<SinkFile, String> {
+        loop {
+            let path = format!("{}-{:05}.{}", self.path, state.next_file, self.extension());
+            state.next_file += 1;
+            match OpenOptions::new().write(true).create_new(true).open(&path) {
+                Ok(file) => return Ok(SinkFile { path: path, writer: BufWriter::new(file), bytes: 0 }),
+                Err(e) if e.kind() == io::ErrorKind::AlreadyExists => continue,
+                Err(e) => return Err(format!("Unable to create `{path}`: {e}")),
+            }
+        }
+    }
+
+    fn extension(&self) -> &'static str {
+        match (self.format, self.compress) {
+            (SinkFormat::Jsonl, false) => "jsonl",
+            (SinkFormat::Jsonl, true) => "jsonl.gz",
+            (SinkFormat::Warc, false) => "warc",
+            (SinkFormat::Warc, true) => "warc.gz",
+        }
+    }
+
+    fn maybe_compress(&self, record: Vec<u8>) -> Result<Vec<u8>, String> {
+        if !self.compress { return Ok(record); }
+        let mut encoder = GzEncoder::new(Vec::with_capacity(record.len() / 4), Compression::default());
+        encoder.write_all(&record).map_err(|e| e.to_string())?;
+        encoder.finish().map_err(|e| e.to_string())
+    }
+
+    /// One JSON object per line. The body is decompressed, and stored as `body_base64` if it isn't utf-8.
+    fn jsonl_record(res: &mut HttpResponse) -> Result<Vec<u8>, String> {
+        let mut record = json!({
+            "url": res.url(),
+            "status": res.status(),
+            "headers": res.header_map(),
+            "elapsed": res.elapsed(),
+        });
+        let body = res.decompressed_body()?;
+        match std::str::from_utf8(body) {
+            Ok(text) => { record["body"] = json!(text); }
+            Err(_) => {
+                record["body"] = serde_json::Value::Null;
+                record["body_base64"] = json!(base64::engine::general_purpose::STANDARD.encode(body));
+            }
+        }
+        let mut line = serde_json::to_vec(&record).map_err(|e| e.to_string())?;
+        line.push(b'\n');
+        Ok(line)
+    }
+
+    /// A WARC/1.1 `response` record holding the response body as it was received (still content-encoded).
+    /// The status line and headers are rebuilt: the status line always reads HTTP/1.1, header names are
+    /// lowercased, a repeated header keeps only its last value and `Transfer-Encoding` is left out.
+    fn warc_response_record(res: &HttpResponse) -> Vec<u8> {
+        let reason = reqwest::StatusCode::from_u16(res.status())
+            .ok()
+            .and_then(|s| s.canonical_reason())
+            .unwrap_or("");
+        let mut block = format!("HTTP/1.1 {} {}\r\n", res.status(), reason).into_bytes();
+        for (k, v) in res.header_map() {
+            // The body was already de-chunked by the client, so a chunked header would misdescribe it
+            if k == "transfer-encoding" { continue; }
+            block.extend_from_slice(format!("{k}: {v}\r\n").as_bytes());
+        }
+        block.extend_from_slice(b"\r\n");
+        block.extend_from_slice(res.raw_body());
+
+        Self::warc_record("response", Some(res.url()), "application/http;msgtype=response", block)
+    }
+
+    fn warcinfo_record(path: &str) -> Vec<u8> {
+        let filename = std::path::Path::new(path)
+            .file_name()
+            .map(|f| f.to_string_lossy().to_string())
+            .unwrap_or_default();
+        let block = format!(
+            "software: pygrab/{}\r\nformat: WARC File Format 1.1\r\nfilename: {}\r\n",
+            env!("CARGO_PKG_VERSION"), filename
+        );
+        Self::warc_record("warcinfo", None, "application/warc-fields", block.into_bytes())
+    }
+
+    fn warc_record(warc_type: &str, target: Option<&str>, content_type: &str, block: Vec<u8>) -> Vec<u8> {
+        let mut head = format!(
+            "WARC/1.1\r\nWARC-Type: {}\r\nWARC-Record-ID: <urn:uuid:{}>\r\nWARC-Date: {}\r\n",
+            warc_type, uuid::Uuid::new_v4(), warc_date()
+        );
+        if let Some(target) = target {
+            head.push_str(&format!("WARC-Target-URI: {target}\r\n"));
+        }
+        head.push_str(&format!("Content-Type: {}\r\nContent-Length: {}\r\n\r\n", content_type, block.len()));
+
+        let mut record = head.into_bytes();
+        record.reserve(block.len() + 4);
+        record.extend_from_slice(&block);
+        record.extend_from_slice(b"\r\n\r\n");
+        record
+    }
+}
+
+// Helper Functions
+
+/// The current UTC time formatted as `YYYY-MM-DDThh:mm:ssZ`
+fn warc_date() -> String {
+    let secs = SystemTime::now().duration_since(UNIX_EPOCH).map(|d| d.as_secs()).unwrap_or(0);
+    let (days, rem) = (secs / 86400, secs % 86400);
+
+    // Converts days since the epoch to a civil date (Howard Hinnant's algorithm)
+    let z = days as i64 + 719468;
+    let era = z.div_euclid(146097);
+    let doe = z.rem_euclid(146097);
+    let yoe = (doe - doe / 1460 + doe / 36524 - doe / 146096) / 365;
+    let doy = doe - (365 * yoe + yoe / 4 - yoe / 100);
+    let mp = (5 * doy + 2) / 153;
+    let day = doy - (153 * mp + 2) / 5 + 1;
+    let month = if mp < 10 { mp + 3 } else { mp - 9 };
+    let year = yoe + era * 400 + if month <= 2 { 1 } else { 0 };
+
+    format!(
+        "{:04}-{:02}-{:02}T{:02}:{:02}:{:02}Z",
+        year, month, day, rem / 3600, rem % 3600 / 60, rem % 60
+    )
+}
@@ -1,59 +1,70 @@
 
 use crate::response::HttpResponse;
+use crate::body::{RequestBody, JsonBody, FilePart};
+use crate::batch::{RequestSpec, parse_method, spawn_pool, spawn_pool_until, collect_ordered};
+use crate::sink::{BatchSink, SinkManifest};
+use crate::extract::{ExtractSpec, Extracted};
+use crate::timeouts::{TimeoutPolicy, send_blocking, host_of};
+use crate::proxy_pool::{ProxyPool, ProxySetting, PoolClients, ClientRouter};
+use crate::cancel::{BatchControl, CancelToken};
 use pyo3::prelude::*;
-use pyo3::exceptions::{PyException, PyValueError};
-use std::{thread, fs, collections::HashMap, str::FromStr};
-use std::sync::{mpsc, Arc}; 
-use reqwest::{self, Method, header, blocking::Client};
+use pyo3::exceptions::{PyException, PyIOError};
+use std::{fs, collections::HashMap, str::FromStr, io::{Read, Write}};
+use std::sync::{Arc, atomic::{AtomicUsize, Ordering}};
+use std::time::{Duration, Instant};
+use reqwest::{self, header, blocking::Client, Method};
 
 
 #[pyclass]
 pub struct ThreadSessionRs {
     client: reqwest::blocking::Client,
-    num_req: usize,
+    num_req: AtomicUsize,
     timeout: f64,
     headers: HashMap<String, String>,
     proxy: Option<String>,
+    pool: Option<ProxyPool>,
+    pool_clients: Option<Arc<PoolClients>>,
+    policy: Option<TimeoutPolicy>,
 }
 
 #[pymethods]
 impl ThreadSessionRs {
     #[new]
-    pub fn new(timeout: f64, headers: HashMap<String, String>, proxy_url: Option<String>) -> Self {
-        let mut client_headers = header::HeaderMap::new();
-        for (k, v) in headers.iter() {
-            client_headers.insert(
-                header::HeaderName::from_str(k).unwrap(),
-                header::HeaderValue::from_str(v).unwrap()
-            );
-        }
-
-        let mut client = reqwest::blocking::Client::builder()
-            .timeout(std::time::Duration::from_secs_f64(timeout))
-            .default_headers(client_headers);
-
-        if let Some(ref proxy) = proxy_url {
-            let proxy= reqwest::Proxy::all(proxy).unwrap();
-            client = client.proxy(proxy);
-        }
-        let client = client.build().unwrap();
+    #[pyo3(signature = (timeout, headers, proxy_url=None))]
+    pub fn new(timeout: f64, headers: HashMap<String, String>, proxy_url: Option<ProxySetting>) -> Self {
+        let (proxy, pool) = match proxy_url {
+            Some(ProxySetting::Url(url)) => (Some(url), None),
+            Some(ProxySetting::Pool(pool)) => (None, Some(pool)),
+            None => (None, None),
+        };
+        let policy = TimeoutPolicy::default_policy();
+        let client = Self::make_client(&headers, timeout, proxy.as_deref(), policy.as_ref());
+        let pool_clients = Self::make_pool_clients(&headers, timeout, pool.as_ref(), policy.as_ref());
         
         ThreadSessionRs {
             client: client,
-            num_req: 0,
+            num_req: AtomicUsize::new(0),
             timeout: timeout,
             headers: headers,
-            proxy: proxy_url,
+            proxy: proxy,
+            pool: pool,
+            pool_clients: pool_clients,
+            policy: policy,
         }
     }
 
-    pub fn set_proxy(&mut self, proxy: String) {
-        self.proxy = Some(proxy);
+    /// Sends every request through `proxy`, which is either a proxy url or a `ProxyPool`
+    pub fn set_proxy(&mut self, proxy: ProxySetting) {
+        match proxy {
+            ProxySetting::Url(url) => { self.proxy = Some(url); self.pool = None; }
+            ProxySetting::Pool(pool) => { self.proxy = None; self.pool = Some(pool); }
+        }
         self.build_client();
     } 
 
     pub fn remove_proxy(&mut self) {
         self.proxy = None;
+        self.pool = None;
         self.build_client();
     }
 
@@ -62,258 +73,339 @@ impl ThreadSessionRs {
         self.build_client();
     }
 
-    pub fn get(&mut self, url: String) -> PyResult<HttpResponse> {
-        let res = self.client.get(url).send();
+    pub fn get(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        let (router, policy, timeout) = (self.router(), self.policy.as_ref(), self.timeout);
+        let res = py.allow_threads(move || send_blocking(&router, policy, timeout, None, Method::GET, &url));
         match res {
             Ok(x) => {
-                self.num_req += 1;
-                Ok(HttpResponse::from_reqwest_blocking(x))
+                self.num_req.fetch_add(1, Ordering::Relaxed);
+                Ok(x)
             }
             Err(x) => { Err(PyException::new_err(format!("Error: {}", x))) }
         }
     }
 
-    pub fn get_batch (&mut self, urls: Vec<String>, thread_limit: u32, warn_status: Option<bool>) -> HashMap<String, HttpResponse> {
-        let mut res: HashMap<String, HttpResponse> = HashMap::new();
-        let client_copy = Arc::new(self.client.clone());
-        let mut url_iter = urls.iter();
-        let mut ind = 0;
-
-        let warn_status = match warn_status {
-            Some(x) => { x }
-            None => { true }
-        };
+    #[getter]
+    pub fn get_num_req(&self) -> usize {
+        self.num_req.load(Ordering::Relaxed)
+    }
 
-        while ind < urls.len() {
-            let (tx, rx) = mpsc::channel();
-
-            for _ in 0..thread_limit {
-                let tx_cloned = tx.clone();
-                let client_cloned = client_copy.clone();
-                let url = url_iter.next();
-                if url.is_none() { break }
-                let url = url.unwrap().clone();
-                ind += 1;
-                thread::spawn(move || {
-                    let res = client_cloned.get(&url).send();
-                    if let Ok(body) = res {
-                        let _ = tx_cloned.send((url, body));
+    /// Gets every url concurrently. The responses are returned in the same order as `urls`,
+    /// with `None` in place of the requests that failed. Repeated urls are fetched once per occurrence.
+    /// The batch stops taking requests once `deadline` seconds passed or `cancel` is cancelled, and returns
+    /// `None` for the requests it didn't finish. `progress` is called with the number of completed and failed 
+    /// requests and the bytes received, at most twice a second and once more at the end.
+    /// `on_result` is called with the index and response (or `None`) of each request as soon as it finishes.
+    #[pyo3(signature = (urls, thread_limit, warn_status=None, deadline=None, cancel=None, progress=None, on_result=None))]
+    pub fn get_batch (
+        &self, 
+        py: Python<'_>, 
+        urls: Vec<String>, 
+        thread_limit: u32, 
+        warn_status: Option<bool>,
+        deadline: Option<f64>,
+        cancel: Option<CancelToken>,
+        progress: Option<PyObject>,
+        on_result: Option<PyObject>
+    ) -> PyResult<Vec<Option<HttpResponse>>> {
+        let warn_status = warn_status.unwrap_or(true);
+        let control = BatchControl::new(deadline, cancel, progress)?;
+        let router = self.router();
+        let (policy, timeout) = (self.policy.clone(), self.timeout);
+        let len = urls.len();
+
+        let (watcher, status, stopper) = (control.clone(), control.clone(), control.clone());
+        let res = py.allow_threads(move || {
+            let rx = spawn_pool_until(urls, thread_limit as usize, move || stopper.stopped(), move |url: String| {
+                let res = send_blocking(&router, policy.as_ref(), timeout, Some(&control), Method::GET, &url);
+                control.record(res.is_ok(), res.as_ref().map_or(0, |x| x.raw_body().len()));
+                match res {
+                    Ok(x) => { Some(x) }
+                    Err(e) => {
+                        // Requests cut short by a stopped batch aren't worth a warning
+                        if warn_status && !control.stopped() { println!("Request Failed: {e}") }
+                        None
                     }
-                    else if let Err(e) = res {
-                        if warn_status { println!("Request Failed: {e}") }
+                }
+            });
+            let results = watcher.watch(rx).inspect(|(ind, res)| {
+                if let Some(on_result) = &on_result {
+                    watcher.with_gil(|py| on_result.call1(py, (*ind, res.clone())).map(|_| ()));
+                }
+            });
+            collect_ordered(results, len)
+        });
+        self.num_req.fetch_add(res.iter().filter(|r| r.is_some()).count(), Ordering::Relaxed);
+        status.finish(py)?;
+        Ok(res)
+    }
+
+    /// Gets every url concurrently and runs the extraction `spec` over each page on the worker threads.
+    /// Only the extracted fields are returned, in the same order as `urls` with `None` for failed requests.
+    #[pyo3(signature = (urls, thread_limit, spec, warn_status=None, deadline=None, cancel=None, progress=None))]
+    pub fn get_batch_extract(
+        &self, 
+        py: Python<'_>, 
+        urls: Vec<String>, 
+        thread_limit: u32, 
+        spec: ExtractSpec, 
+        warn_status: Option<bool>,
+        deadline: Option<f64>,
+        cancel: Option<CancelToken>,
+        progress: Option<PyObject>
+    ) -> PyResult<Vec<Option<HashMap<String, Extracted>>>> {
+        let warn_status = warn_status.unwrap_or(true);
+        let control = BatchControl::new(deadline, cancel, progress)?;
+        let router = self.router();
+        let (policy, timeout) = (self.policy.clone(), self.timeout);
+        let spec = Arc::new(spec);
+        let len = urls.len();
+
+        let (watcher, status, stopper) = (control.clone(), control.clone(), control.clone());
+        let res = py.allow_threads(move || {
+            let rx = spawn_pool_until(urls, thread_limit as usize, move || stopper.stopped(), move |url: String| {
+                let res = send_blocking(&router, policy.as_ref(), timeout, Some(&control), Method::GET, &url);
+                control.record(res.is_ok(), res.as_ref().map_or(0, |x| x.raw_body().len()));
+                match res.and_then(|mut x| x.extract(&spec)) {
+                    Ok(fields) => Some(fields),
+                    Err(e) => {
+                        if warn_status && !control.stopped() { println!("Request Failed for {url}: {e}") }
+                        None
                     }
-                });
-            }
+                }
+            });
+            collect_ordered(watcher.watch(rx), len)
+        });
+        self.num_req.fetch_add(res.iter().filter(|r| r.is_some()).count(), Ordering::Relaxed);
+        status.finish(py)?;
+        Ok(res)
+    }
 
-            std::mem::drop(tx);
-            for (url, response) in rx {
-                res.insert(url, HttpResponse::from_reqwest_blocking(response));
-                self.num_req += 1;
-            }
-        }
-        res
+    /// Gets every url concurrently and archives the responses into `sink` straight from the worker threads.
+    /// Only the manifest of what was written is returned, no response reaches python.
+    /// Urls left unfinished by the `deadline` or `cancel` are listed as failed.
+    #[pyo3(signature = (urls, thread_limit, sink, warn_status=None, deadline=None, cancel=None, progress=None))]
+    pub fn get_batch_to_sink(
+        &self, 
+        py: Python<'_>, 
+        urls: Vec<String>, 
+        thread_limit: u32, 
+        sink: BatchSink, 
+        warn_status: Option<bool>,
+        deadline: Option<f64>,
+        cancel: Option<CancelToken>,
+        progress: Option<PyObject>
+    ) -> PyResult<SinkManifest> {
+        let warn_status = warn_status.unwrap_or(true);
+        let control = BatchControl::new(deadline, cancel, progress)?;
+        let router = self.router();
+        let (policy, timeout) = (self.policy.clone(), self.timeout);
+        let writer = sink.clone();
+        let (all_urls, len) = (urls.clone(), urls.len());
+
+        let (watcher, status, stopper) = (control.clone(), control.clone(), control.clone());
+        let (manifest, finished) = py.allow_threads(move || {
+            let rx = spawn_pool_until(urls, thread_limit as usize, move || stopper.stopped(), move |url: String| {
+                let res = send_blocking(&router, policy.as_ref(), timeout, Some(&control), Method::GET, &url);
+                control.record(res.is_ok(), res.as_ref().map_or(0, |x| x.raw_body().len()));
+                res.and_then(|x| sink.encode(x)).map_err(|e| {
+                    if warn_status && !control.stopped() { println!("Request Failed for {url}: {e}") }
+                    url
+                })
+            });
+            let mut finished = vec![false; len];
+            let manifest = writer.write_all(watcher.watch(rx).inspect(|(ind, _)| finished[*ind] = true));
+            (manifest, finished)
+        });
+        let mut manifest = manifest.map_err(|e| PyIOError::new_err(format!("Error writing to sink: {e}")))?;
+        // Requests abandoned in flight never reached the sink
+        manifest.failed.extend(
+            all_urls.into_iter().zip(finished).filter(|(_, done)| !done).map(|(url, _)| url)
+        );
+
+        self.num_req.fetch_add(manifest.records, Ordering::Relaxed);
+        status.finish(py)?;
+        Ok(manifest)
     }
 
-    pub fn download(&mut self, url: String, filename: String) -> PyResult<()> {
-        let resp = self.client.get(url).send();
-        let resp = match resp {
-            Ok(x) => { x }
-            Err(e) => { return Err(PyException::new_err(format!("{e}"))); }
-        };
-        let bytes = match resp.bytes() {
-            Ok(x) => { x }
-            Err(e) => { return  Err(PyException::new_err(format!("{e}"))); }
-        };
-        match fs::write(filename, bytes) {
+    pub fn download(&self, py: Python<'_>, url: String, filename: String) -> PyResult<()> {
+        let (router, timeout) = (self.router(), self.timeout);
+        let res = py.allow_threads(move || router.run(|client| Self::download_controlled(&url, &filename, client, timeout, None)));
+        match res {
             Ok(_) => { 
-                self.num_req += 1;
+                self.num_req.fetch_add(1, Ordering::Relaxed);
                 return Ok (()); 
             }
-            Err(e) => { return Err(PyException::new_err(format!("{e}"))); }
+            Err(e) => { return Err(PyException::new_err(e)); }
         }
     }
 
-    pub fn download_batch (&mut self, urls: Vec<String>, filenames: Vec<String>, thread_limit: u32, warn_status: Option<bool>) {
-        let client_copy = Arc::new(self.client.clone());
-        let mut url_iter = urls.iter();
-        let mut filename_iter = filenames.iter();
-        let mut ind = 0;
-
-        let warn_status = match warn_status {
-            Some(x) => { x }
-            None => { true }
-        };
+    /// Downloads every url to its filename concurrently. Files are streamed to disk, and a download
+    /// stopped by the `deadline` or `cancel` is aborted and its partial file removed.
+    #[pyo3(signature = (urls, filenames, thread_limit, warn_status=None, deadline=None, cancel=None, progress=None))]
+    pub fn download_batch (
+        &self, 
+        py: Python<'_>, 
+        urls: Vec<String>, 
+        filenames: Vec<String>, 
+        thread_limit: u32, 
+        warn_status: Option<bool>,
+        deadline: Option<f64>,
+        cancel: Option<CancelToken>,
+        progress: Option<PyObject>
+    ) -> PyResult<()> {
+        let warn_status = warn_status.unwrap_or(true);
+        let control = BatchControl::new(deadline, cancel, progress)?;
+        let (router, timeout) = (self.router(), self.timeout);
+        let jobs: Vec<(String, String)> = urls.into_iter().zip(filenames.into_iter()).collect();
     
-        while ind < urls.len() {
-            let mut handles = Vec::new();
-            for _ in 0..thread_limit {
-                let client_cloned = client_copy.clone();
-                let url = url_iter.next();
-                if url.is_none() { break }
-                let url = url.unwrap().clone();
-                let filename = filename_iter.next().unwrap().clone();
-                ind += 1;
-                handles.push(thread::spawn(move || {
-                    let res = Self::download_batch_helper(url.clone(), filename, client_cloned);
-                    if let Err(_) = res {
-                        if warn_status { println!("Download Failed for {}", url) }
-                    }
-                }));
-            }
-            for handle in handles { handle.join().unwrap(); }
-        }
+        let (watcher, status, stopper) = (control.clone(), control.clone(), control.clone());
+        let downloaded = py.allow_threads(move || {
+            let rx = spawn_pool_until(jobs, thread_limit as usize, move || stopper.stopped(), move |(url, filename): (String, String)| {
+                let res = router.run_until(|| control.stopped(), |client| {
+                    Self::download_controlled(&url, &filename, client, timeout, Some(&control))
+                });
+                control.record(res.is_ok(), *res.as_ref().unwrap_or(&0) as usize);
+                if let Err(e) = &res {
+                    if warn_status && !control.stopped() { println!("Download Failed for {}: {}", url, e) }
+                }
+                res.is_ok()
+            });
+            watcher.watch(rx).filter(|(_, ok)| *ok).count()
+        });
+        self.num_req.fetch_add(downloaded, Ordering::Relaxed);
+        status.finish(py)
     }
 
-    pub fn head(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "HEAD")
+    pub fn head(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "HEAD")
     }
 
-    pub fn post(&mut self,url: String, data:Vec<u8>) -> PyResult<HttpResponse> {
-        let res = self.client.post(url)
-            .body(data)
-            .send();
-        match res {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(HttpResponse::from_reqwest_blocking(x)) 
-            }            
-            Err(e) => { Err(PyException::new_err(format!("Error with POST request: {e}"))) }
-        }
+    pub fn post(&self, py: Python<'_>, url: String, data: RequestBody) -> PyResult<HttpResponse> {
+        self.post_body(py, url, data)
     }
 
+    /// Posts every payload concurrently. The responses are returned in the same order as the payloads,
+    /// with `None` in place of the requests that failed.
+    #[pyo3(signature = (urls, data, thread_limit, warn_status=None))]
     pub fn post_batch(
-        &mut self, 
+        &self, 
+        py: Python<'_>, 
         urls: Vec<String>, 
-        data: Vec<Vec<u8>>, 
+        data: Vec<RequestBody>, 
         thread_limit: u32, 
         warn_status: Option<bool>
-    ) -> HashMap<String, HttpResponse> {
-        let mut res: HashMap<String, HttpResponse> = HashMap::new();
-        let client_copy = Arc::new(self.client.clone());
-        let mut url_iter = urls.iter();
-        let mut bytes_iter = data.iter();
-        let mut ind = 0;
-
-        let warn_status = match warn_status {
-            Some(x) => { x }
-            None => { true }
-        };
-
-        while ind < urls.len() {
-            let (tx, rx) = mpsc::channel();
-
-            for _ in 0..thread_limit {
-                let tx_cloned = tx.clone();
-                let client_cloned = client_copy.clone();
-
-                let url = url_iter.next();
-                if url.is_none() { break }
-                let url = url.unwrap().clone();
-                let bytes = bytes_iter.next().unwrap().clone();
-                
-                ind += 1;
-                thread::spawn(move || {
-                    let res = client_cloned.post(&url).json(&bytes).send();
-                    if let Ok(body) = res {
-                        let _ = tx_cloned.send((url.clone(), body));
-                    }
-                    else if let Err(e) = res {
-                        if warn_status { println!("POST Request Failed for {url}: {e}") }
-                    }
-                });
-                self.num_req += 1;
-            }
-
-            std::mem::drop(tx);
-            for (url, response) in rx {
-                res.insert(url, HttpResponse::from_reqwest_blocking(response));
-            }
-        }
-        res
+    ) -> Vec<Option<HttpResponse>> {
+        self.post_body_batch(py, urls, data, thread_limit, warn_status.unwrap_or(true))
     }
 
-    pub fn post_json(&mut self,url: String, data: HashMap<String, String>) -> PyResult<HttpResponse> {
-        let res = self.client.post(url)
-            .json(&data)
-            .send();
-        match res {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(HttpResponse::from_reqwest_blocking(x)) 
-            }
-            Err(e) => { Err(PyException::new_err(format!("Error with POST request: {e}"))) }
-        }
+    pub fn post_json(&self, py: Python<'_>, url: String, data: JsonBody) -> PyResult<HttpResponse> {
+        self.post_body(py, url, RequestBody::Json(data.0))
     }
 
+    #[pyo3(signature = (urls, data, thread_limit, warn_status=None))]
     pub fn post_json_batch(
-        &mut self, 
+        &self, 
+        py: Python<'_>, 
         urls: Vec<String>, 
-        data: Vec<HashMap<String, String>>, 
+        data: Vec<JsonBody>, 
         thread_limit: u32, 
         warn_status: Option<bool>
-    ) -> HashMap<String, HttpResponse> {
-        let mut res: HashMap<String, HttpResponse> = HashMap::new();
-        let client_copy = Arc::new(self.client.clone());
-        let mut url_iter = urls.iter();
-        let mut data_iter = data.iter();
-        let mut ind = 0;
-
-        let warn_status = match warn_status {
-            Some(x) => { x }
-            None => { true }
-        };
-
-        while ind < urls.len() {
-            let (tx, rx) = mpsc::channel();
+    ) -> Vec<Option<HttpResponse>> {
+        let data = data.into_iter().map(|json| RequestBody::Json(json.0)).collect();
+        self.post_body_batch(py, urls, data, thread_limit, warn_status.unwrap_or(true))
+    }
 
-            for _ in 0..thread_limit {
-                let tx_cloned = tx.clone();
-                let client_cloned = client_copy.clone();
+    pub fn post_form(&self, py: Python<'_>, url: String, data: Vec<(String, String)>) -> PyResult<HttpResponse> {
+        self.post_body(py, url, RequestBody::Form(data))
+    }
 
-                let url = url_iter.next();
-                if url.is_none() { break }
-                let url = url.unwrap().clone();
-                let json = data_iter.next().unwrap().clone();
+    pub fn post_multipart(
+        &self, 
+        py: Python<'_>, 
+        url: String, 
+        fields: Vec<(String, String)>, 
+        files: Vec<FilePart>
+    ) -> PyResult<HttpResponse> {
+        self.post_body(py, url, RequestBody::Multipart(fields, files))
+    }
 
-                ind += 1;
-                thread::spawn(move || {
-                    let res = client_cloned.post(&url).json(&json).send();
-                    if let Ok(body) = res {
-                        let _ = tx_cloned.send((url.clone(), body));
-                    }
-                    else if let Err(e) = res {
-                        if warn_status { println!("POST Request Failed for {url}: {e}") }
-                    }
-                });
-                self.num_req += 1;
-            }
+    #[pyo3(signature = (url, body=RequestBody::Empty))]
+    pub fn put(&self, py: Python<'_>, url: String, body: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, body, "PUT")
+    }
 
-            std::mem::drop(tx);
-            for (url, response) in rx {
-                res.insert(url, HttpResponse::from_reqwest_blocking(response));
-            }
-        }
-        res
+    #[pyo3(signature = (url, body=RequestBody::Empty))]
+    pub fn patch(&self, py: Python<'_>, url: String, body: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, body, "PATCH")
     }
 
-    pub fn put(&mut self, url: String, body: String) -> PyResult<HttpResponse> {
-        self.send_request(url, body, "PUT")
+    pub fn delete(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "DELETE")
     }
 
-    pub fn delete(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "DELETE")
+    pub fn connect(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "CONNECT")
     }
 
-    pub fn connect(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "CONNECT")
+    pub fn options(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "OPTIONS")
     }
 
-    pub fn options(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "OPTIONS")
+    pub fn trace(&self, py: Python<'_>, url: String) -> PyResult<HttpResponse> {
+        self.send_request(py, url, RequestBody::Empty, "TRACE")
     }
 
-    pub fn trace(&mut self, url: String) -> PyResult<HttpResponse> {
-        self.send_request(url, String::new(), "TRACE")
+    /// Sends a list of requests with arbitrary methods concurrently.
+    /// The responses are keyed by the index of their request, failed requests are left out.
+    /// `deadline`, `cancel` and `progress` work as they do for `get_batch`.
+    #[pyo3(signature = (requests, thread_limit, warn_status=None, deadline=None, cancel=None, progress=None))]
+    pub fn request_batch(
+        &self, 
+        py: Python<'_>, 
+        requests: Vec<RequestSpec>, 
+        thread_limit: u32, 
+        warn_status: Option<bool>,
+        deadline: Option<f64>,
+        cancel: Option<CancelToken>,
+        progress: Option<PyObject>
+    ) -> PyResult<HashMap<usize, HttpResponse>> {
+        let warn_status = warn_status.unwrap_or(true);
+        let control = BatchControl::new(deadline, cancel, progress)?;
+        let router = self.router();
+        let timeout = self.timeout;
+
+        let (watcher, status, stopper) = (control.clone(), control.clone(), control.clone());
+        let res: HashMap<usize, HttpResponse> = py.allow_threads(move || {
+            let rx = spawn_pool_until(requests, thread_limit as usize, move || stopper.stopped(), move |mut spec: RequestSpec| {
+                let start = Instant::now();
+                let method = spec.method.clone();
+                let url = spec.url.clone();
+                // The request's timeout is capped at the time left before the deadline
+                if let Some(left) = control.deadline().map(|d| d.saturating_duration_since(start)) {
+                    spec.timeout = Some(spec.timeout.unwrap_or(Duration::from_secs_f64(timeout)).min(left));
+                }
+                let res = router.run_until(|| control.stopped(), |client| {
+                    let res = spec.send(client)?;
+                    let elapsed = start.elapsed();
+                    Ok(HttpResponse::from_reqwest_blocking_until(res, || control.stopped())?.with_elapsed(elapsed))
+                });
+                control.record(res.is_ok(), res.as_ref().map_or(0, |x| x.raw_body().len()));
+                match res {
+                    Ok(x) => { Some(x) }
+                    Err(e) => {
+                        if warn_status && !control.stopped() { println!("{method} Request Failed for {url}: {e}") }
+                        None
+                    }
+                }
+            });
+            watcher.watch(rx)
+                .filter_map(|(ind, response)| response.map(|r| (ind, r)))
+                .collect()
+        });
+        self.num_req.fetch_add(res.len(), Ordering::Relaxed);
+        status.finish(py)?;
+        Ok(res)
     }
 
     #[setter]
@@ -328,71 +420,167 @@ impl ThreadSessionRs {
         self.build_client();
     }
 
-    fn send_request(&mut self, url: String, body: String, method_str: &str) -> PyResult<HttpResponse> {
-        let method  = match method_str.to_uppercase().as_str() {
-            "POST" => Method::POST,
-            "PUT" => Method::PUT,
-            "DELETE" => Method::DELETE,
-            "HEAD" => Method::HEAD,
-            "OPTIONS" => Method::OPTIONS,
-            "CONNECT" => Method::CONNECT,
-            "TRACE" => Method::TRACE,
-            "PATCH" => Method::PATCH,
-            _ => return Err(PyValueError::new_err("Invalid HTTP method")),
-        };
-
-        let builder = self.client.request(method.clone(), &url);
-        let res = if method == Method::POST || method == Method::PUT || method == Method::PATCH {
-            builder.body(body).send()
-        } 
-        else {
-            builder.send()
-        };
+    #[getter]
+    pub fn get_timeout_policy(&self) -> Option<TimeoutPolicy> {
+        self.policy.clone()
+    }
 
-        match res {
-            Ok(x) => {
-                self.num_req += 1;
-                Ok(HttpResponse::from_reqwest_blocking(x))
-            },
-            Err(e) => Err(PyException::new_err(format!("Error with {method_str} request: {e}"))),
-        }
+    #[setter]
+    pub fn set_timeout_policy(&mut self, policy: Option<TimeoutPolicy>) {
+        self.policy = policy;
+        self.build_client();
     }
 
     fn build_client(&mut self) {
+        self.client = Self::make_client(&self.headers, self.timeout, self.proxy.as_deref(), self.policy.as_ref());
+        self.pool_clients = Self::make_pool_clients(&self.headers, self.timeout, self.pool.as_ref(), self.policy.as_ref());
+    }
+}
+
+impl ThreadSessionRs {
+    fn make_client(headers: &HashMap<String, String>, timeout: f64, proxy: Option<&str>, policy: Option<&TimeoutPolicy>) -> Client {
         let header_iter = reqwest::header::HeaderMap::from_iter(
-            self.headers.iter().map(|(k, v)| {
+            headers.iter().map(|(k, v)| {
                 let k = header::HeaderName::from_str(k.as_str()).unwrap();
                 let v = header::HeaderValue::from_str(v.as_str()).unwrap();
                 (k, v)
             })
         );
 
-        let mut client = reqwest::blocking::Client::builder()
-            .timeout(std::time::Duration::from_secs_f64(self.timeout))
+        // Configured on the async builder, the blocking one has no read timeout
+        let mut client = reqwest::Client::builder()
             .default_headers(header_iter);
 
-        if let Some(ref proxy) = self.proxy {
+        if let Some(proxy) = proxy {
             let proxy= reqwest::Proxy::all(proxy).unwrap();
             client = client.proxy(proxy);
         }
-        self.client = client.build().unwrap();
+        if let Some(policy) = policy {
+            client = policy.configure_async(client);
+        }
+        reqwest::blocking::ClientBuilder::from(client)
+            .timeout(std::time::Duration::from_secs_f64(timeout))
+            .build()
+            .unwrap()
+    }
+
+    fn make_pool_clients(
+        headers: &HashMap<String, String>, 
+        timeout: f64, 
+        pool: Option<&ProxyPool>, 
+        policy: Option<&TimeoutPolicy>
+    ) -> Option<Arc<PoolClients>> {
+        let (headers, policy) = (headers.clone(), policy.cloned());
+        pool.map(|pool| Arc::new(PoolClients::new(pool.clone(), move |proxy: &str| {
+            Self::make_client(&headers, timeout, Some(proxy), policy.as_ref())
+        })))
+    }
+
+    /// Sends requests through the session's proxy pool if it has one
+    fn router(&self) -> ClientRouter {
+        ClientRouter::new(self.client.clone(), self.pool_clients.clone())
+    }
+
+    fn send_request(&self, py: Python<'_>, url: String, body: RequestBody, method_str: &str) -> PyResult<HttpResponse> {
+        let method = parse_method(method_str)?;
+        let router = self.router();
+        let (policy, timeout) = (self.policy.as_ref(), self.timeout);
+
+        // Serializing the body, waiting on the server and reading the response don't need the GIL
+        let res = py.allow_threads(move || {
+            // Requests without a body can be rebuilt, so they may be hedged. The rest only get the policy's deadline.
+            if let RequestBody::Empty = body {
+                return send_blocking(&router, policy, timeout, None, method, &url);
+            }
+            let start = Instant::now();
+            let res = router.run(|client| {
+                let mut builder = body.apply_blocking(client.request(method, &url))?;
+                if let Some(policy) = policy {
+                    builder = builder.timeout(policy.request_timeout(&host_of(&url), timeout));
+                }
+                builder.send().map_err(|e| e.to_string())
+            })?;
+            Ok::<_, String>(HttpResponse::from_reqwest_blocking(res).with_elapsed(start.elapsed()))
+        });
+
+        match res {
+            Ok(x) => {
+                self.num_req.fetch_add(1, Ordering::Relaxed);
+                Ok(x)
+            },
+            Err(e) => Err(PyException::new_err(format!("Error with {method_str} request: {e}"))),
+        }
     }
-}
 
-impl ThreadSessionRs {
-    fn download_batch_helper(url: String, filename: String, client: Arc<Client>) -> Result<(), ()> {
-        let resp = client.get(url).send();
-        let resp = match resp {
-            Ok(x) => { x }
-            Err(_) => { return Err(()); }
-        };
-        let bytes = match resp.bytes() {
-            Ok(x) => { x }
-            Err(_) => { return Err(()); }
-        };
-        match fs::write(filename, bytes) {
-            Ok(_) => { return Ok (()); }
-            Err(_) => { return Err(()); }
+    fn post_body(&self, py: Python<'_>, url: String, body: RequestBody) -> PyResult<HttpResponse> {
+        self.send_request(py, url, body, "POST")
+    }
+
+    fn post_body_batch(
+        &self, 
+        py: Python<'_>, 
+        urls: Vec<String>, 
+        data: Vec<RequestBody>, 
+        thread_limit: u32, 
+        warn_status: bool
+    ) -> Vec<Option<HttpResponse>> {
+        let router = self.router();
+        let jobs: Vec<(String, RequestBody)> = urls.into_iter().zip(data.into_iter()).collect();
+        let len = jobs.len();
+
+        let res = py.allow_threads(move || {
+            let rx = spawn_pool(jobs, thread_limit as usize, move |(url, body): (String, RequestBody)| {
+                let start = Instant::now();
+                let res = router.run(|client| {
+                    body.apply_blocking(client.post(&url))
+                        .and_then(|builder| builder.send().map_err(|e| e.to_string()))
+                });
+                match res {
+                    Ok(x) => { Some(HttpResponse::from_reqwest_blocking(x).with_elapsed(start.elapsed())) }
+                    Err(e) => {
+                        if warn_status { println!("POST Request Failed for {url}: {e}") }
+                        None
+                    }
+                }
+            });
+            collect_ordered(rx, len)
+        });
+        self.num_req.fetch_add(res.iter().filter(|r| r.is_some()).count(), Ordering::Relaxed);
+        res
+    }
+
+    /// Streams the body of `url` into `filename` and returns its size. With a `control`, the request's `timeout`
+    /// is capped at the time left before its deadline, and it's dropped as soon as the batch is stopped,
+    /// which closes the connection.
+    fn download_controlled(url: &str, filename: &str, client: &Client, timeout: f64, control: Option<&BatchControl>) -> Result<u64, String> {
+        let mut builder = client.get(url);
+        if let Some(deadline) = control.and_then(|c| c.deadline()) {
+            let left = deadline.saturating_duration_since(Instant::now());
+            builder = builder.timeout(left.min(Duration::from_secs_f64(timeout)));
+        }
+        let mut resp = builder.send().map_err(|e| e.to_string())?;
+        let mut file = fs::File::create(filename).map_err(|e| e.to_string())?;
+
+        let mut buf = vec![0u8; 64 * 1024];
+        let mut written: u64 = 0;
+        loop {
+            if control.map_or(false, |c| c.stopped()) {
+                drop(file);
+                let _ = fs::remove_file(filename);
+                return Err(String::from("download cancelled"));
+            }
+            let n = match resp.read(&mut buf) {
+                Ok(0) => break,
+                Ok(n) => n,
+                Err(e) => {
+                    drop(file);
+                    let _ = fs::remove_file(filename);
+                    return Err(e.to_string());
+                }
+            };
+            file.write_all(&buf[..n]).map_err(|e| e.to_string())?;
+            written += n as u64;
         }
+        Ok(written)
     }
 }
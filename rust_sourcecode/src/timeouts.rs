@@ -0,0 +1,392 @@
+use crate::response::HttpResponse;
+use crate::cancel::BatchControl;
+use crate::proxy_pool::ClientRouter;
+use pyo3::prelude::*;
+use pyo3::exceptions::PyValueError;
+use reqwest::Method;
+use std::collections::{HashMap, VecDeque};
+use std::sync::{mpsc, Arc, Mutex, MutexGuard, OnceLock, RwLock};
+use std::sync::atomic::{AtomicBool, AtomicU8, Ordering};
+use std::thread;
+use std::time::{Duration, Instant};
+
+/// Number of recent latencies kept per host
+const LATENCY_WINDOW: usize = 128;
+/// Percentiles aren't trusted until a host has this many samples
+const MIN_SAMPLES: usize = 10;
+/// Number of hosts whose latency is kept, the least recently used one is forgotten past it
+const MAX_HOSTS: usize = 1024;
+
+static HOST_LATENCY: OnceLock<Mutex<LatencyTable>> = OnceLock::new();
+static DEFAULT_POLICY: RwLock<Option<TimeoutPolicy>> = RwLock::new(None);
+static HEDGE_TIMER: OnceLock<Mutex<mpsc::Sender<(Instant, HedgeJob)>>> = OnceLock::new();
+
+/// How long requests may take and when they are hedged.
+///
+/// `connect` bounds establishing a connection, `read` bounds each read from it and `total` bounds the
+/// whole request (defaulting to the session's timeout). With `adaptive`, a host's total deadline is
+/// learned from how long its whole requests took, body included: its `percentile` latency times
+/// `multiplier`, kept between `floor` and `total`. With `hedge_percentile`, a duplicate of an idempotent
+/// request is sent once the first has been outstanding for that percentile of the host's latency, and
+/// whichever finishes first wins. Only safe methods (GET, HEAD, OPTIONS, TRACE) are hedged.
+/// Latency is only recorded for the hosts requested with `adaptive` or `hedge_percentile` set.
+#[pyclass]
+#[derive(Clone)]
+pub struct TimeoutPolicy {
+    connect: Option<f64>,
+    read: Option<f64>,
+    total: Option<f64>,
+    adaptive: bool,
+    percentile: f64,
+    multiplier: f64,
+    floor: f64,
+    hedge_percentile: Option<f64>,
+}
+
+#[pymethods]
+impl TimeoutPolicy {
+    #[new]
+    #[pyo3(signature = (
+        total=None, connect=None, read=None, adaptive=false,
+        percentile=0.99, multiplier=2.0, floor=1.0, hedge_percentile=None
+    ))]
+    pub fn new(
+        total: Option<f64>,
+        connect: Option<f64>,
+        read: Option<f64>,
+        adaptive: bool,
+        percentile: f64,
+        multiplier: f64,
+        floor: f64,
+        hedge_percentile: Option<f64>
+    ) -> PyResult<Self> {
+        for (name, value) in [("total", total), ("connect", connect), ("read", read), ("floor", Some(floor)), ("multiplier", Some(multiplier))] {
+            if matches!(value, Some(v) if !(v > 0.0) || !v.is_finite()) {
+                return Err(PyValueError::new_err(format!("`{name}` must be a positive number of seconds")));
+            }
+        }
+        for p in [Some(percentile), hedge_percentile].into_iter().flatten() {
+            if !(p > 0.0 && p < 1.0) {
+                return Err(PyValueError::new_err("percentiles must be between 0 and 1"));
+            }
+        }
+        Ok(TimeoutPolicy { connect, read, total, adaptive, percentile, multiplier, floor, hedge_percentile })
+    }
+
+    pub fn __repr__(&self) -> String {
+        format!(
+            "<TimeoutPolicy [connect={:?}, read={:?}, total={:?}, adaptive={}, hedge_percentile={:?}]>",
+            self.connect, self.read, self.total, self.adaptive, self.hedge_percentile
+        )
+    }
+}
+
+/// Sets the policy used by every session created afterwards. `None` restores the plain timeouts.
+#[pyfunction]
+#[pyo3(signature = (policy=None))]
+pub fn set_timeout_policy(policy: Option<TimeoutPolicy>) {
+    *DEFAULT_POLICY.write().unwrap() = policy;
+}
+
+/// The 50th, 90th and 99th percentile latency (in seconds) observed for `host`, once enough requests were made to it.
+#[pyfunction]
+pub fn host_latency(host: &str) -> Option<(f64, f64, f64)> {
+    Some((
+        latency_percentile(host, 0.5)?,
+        latency_percentile(host, 0.9)?,
+        latency_percentile(host, 0.99)?,
+    ))
+}
+
+impl TimeoutPolicy {
+    pub fn default_policy() -> Option<TimeoutPolicy> {
+        DEFAULT_POLICY.read().unwrap().clone()
+    }
+
+    /// The blocking client has no read timeout of its own, so blocking clients are configured
+    /// through the async builder they are made from
+    pub fn configure_async(&self, builder: reqwest::ClientBuilder) -> reqwest::ClientBuilder {
+        let mut builder = builder;
+        if let Some(connect) = self.connect { builder = builder.connect_timeout(Duration::from_secs_f64(connect)); }
+        if let Some(read) = self.read { builder = builder.read_timeout(Duration::from_secs_f64(read)); }
+        builder
+    }
+
+    /// Whether requests sent with this policy have to record their host's latency
+    pub fn learns_latency(&self) -> bool {
+        self.adaptive || self.hedge_percentile.is_some()
+    }
+
+    /// The deadline of a whole request to `host`
+    pub fn request_timeout(&self, host: &str, session_timeout: f64) -> Duration {
+        let total = self.total.unwrap_or(session_timeout);
+        if !self.adaptive {
+            return Duration::from_secs_f64(total);
+        }
+        let learned = latency_percentile(host, self.percentile)
+            .map(|p| (p * self.multiplier).clamp(self.floor.min(total), total))
+            .unwrap_or(total);
+        Duration::from_secs_f64(learned)
+    }
+
+    /// How long to wait for a request to `host` before sending its duplicate, if it should be hedged
+    pub fn hedge_delay(&self, host: &str, method: &Method) -> Option<Duration> {
+        if !is_safe(method) { return None; }
+        let p = self.hedge_percentile?;
+        latency_percentile(host, p).map(Duration::from_secs_f64)
+    }
+}
+
+/// Sends a request without a body on the client of `router`, following `policy` (if any).
+/// In a batch, the request's timeout is capped at the time left before the batch's deadline,
+/// and the body stops being read once the batch is stopped.
+pub fn send_blocking(
+    router: &ClientRouter,
+    policy: Option<&TimeoutPolicy>,
+    session_timeout: f64,
+    control: Option<&BatchControl>,
+    method: Method,
+    url: &str
+) -> Result<HttpResponse, String> {
+    let remaining = match control.and_then(|c| c.deadline()).map(|d| d.saturating_duration_since(Instant::now())) {
+        Some(left) if left.is_zero() => return Err(String::from("batch deadline passed")),
+        left => left,
+    };
+    match (policy, remaining) {
+        (None, None) => router.run_until(|| is_stopped(control, None), |client| {
+            fetch_blocking(client.request(method, url), control, None)
+        }),
+        (None, Some(left)) => {
+            let timeout = left.min(Duration::from_secs_f64(session_timeout));
+            router.run_until(|| is_stopped(control, None), |client| {
+                fetch_blocking(client.request(method, url).timeout(timeout), control, None)
+            })
+        }
+        (Some(policy), _) => send_with_policy(router, policy, session_timeout, remaining, control, method, url),
+    }
+}
+
+fn send_with_policy(
+    router: &ClientRouter,
+    policy: &TimeoutPolicy,
+    session_timeout: f64,
+    remaining: Option<Duration>,
+    control: Option<&BatchControl>,
+    method: Method,
+    url: &str
+) -> Result<HttpResponse, String> {
+    let host = host_of(url);
+    let timeout = policy.request_timeout(&host, session_timeout);
+    let timeout = remaining.map_or(timeout, |left| timeout.min(left));
+    let learn = policy.learns_latency().then_some(host.as_str());
+    let delay = match policy.hedge_delay(&host, &method) {
+        Some(delay) => delay,
+        None => return router.run_until(|| is_stopped(control, None), |client| {
+            fetch_learning(client.request(method, url).timeout(timeout), timeout, learn, control, None)
+        }),
+    };
+
+    // The request is sent on this thread. If it's still running once `delay` has passed, it's a straggler
+    // and a duplicate is sent on a thread of its own, through its own proxy lease. Whichever attempt
+    // succeeds first wins, the other one stops reading its body.
+    let race = Arc::new(HedgeRace { won: AtomicBool::new(false), duplicate: AtomicU8::new(DUPLICATE_PENDING) });
+    let (tx, rx) = mpsc::channel();
+    {
+        let (race, router, control) = (race.clone(), router.clone(), control.cloned());
+        let (method, url, learn) = (method.clone(), url.to_string(), learn.map(str::to_string));
+        schedule_hedge(Instant::now() + delay, Box::new(move || {
+            if !race.claim(DUPLICATE_SENT) { return; }
+            thread::spawn(move || {
+                let res = router.run_until(|| is_stopped(control.as_ref(), Some(&race.won)), |client| {
+                    let builder = client.request(method, &url).timeout(timeout);
+                    fetch_learning(builder, timeout, learn.as_deref(), control.as_ref(), Some(&race.won))
+                });
+                if res.is_ok() { race.won.store(true, Ordering::Relaxed); }
+                let _ = tx.send(res);
+            });
+        }));
+    }
+
+    let res = router.run_until(|| is_stopped(control, Some(&race.won)), |client| {
+        fetch_learning(client.request(method, url).timeout(timeout), timeout, learn, control, Some(&race.won))
+    });
+    if race.claim(DUPLICATE_SKIPPED) {
+        // Finished before it turned into a straggler, the duplicate won't be sent
+        return res;
+    }
+    match res {
+        Ok(res) => {
+            race.won.store(true, Ordering::Relaxed);
+            Ok(res)
+        }
+        // Lost the race or failed, only settle for an error once the duplicate failed too
+        Err(e) => match rx.recv() {
+            Ok(Ok(res)) => Ok(res),
+            _ => Err(e),
+        },
+    }
+}
+
+/// Sends the request and reads the whole response, unless `control`'s batch is stopped
+/// or the other attempt of a hedged request has `won` first
+pub fn fetch_blocking(
+    builder: reqwest::blocking::RequestBuilder,
+    control: Option<&BatchControl>,
+    won: Option<&AtomicBool>
+) -> Result<HttpResponse, String> {
+    let start = Instant::now();
+    let res = builder.send().map_err(|e| e.to_string())?;
+    let elapsed = start.elapsed();
+    let res = if control.is_some() || won.is_some() {
+        HttpResponse::from_reqwest_blocking_until(res, || is_stopped(control, won))?
+    } else {
+        HttpResponse::from_reqwest_blocking(res)
+    };
+    Ok(res.with_elapsed(elapsed))
+}
+
+/// Sends the request and reads the whole response. With `learn`, the time the whole request took
+/// is recorded as that host's latency, since it's the whole request the learned deadline bounds.
+/// A request that ran out its `timeout` is recorded too, otherwise a host that slows down would
+/// time out without ever adding a sample, and its learned deadline could never widen again.
+fn fetch_learning(
+    builder: reqwest::blocking::RequestBuilder,
+    timeout: Duration,
+    learn: Option<&str>,
+    control: Option<&BatchControl>,
+    won: Option<&AtomicBool>
+) -> Result<HttpResponse, String> {
+    let start = Instant::now();
+    let res = fetch_blocking(builder, control, won);
+    if let Some(host) = learn {
+        let took = start.elapsed();
+        if res.is_ok() || (took >= timeout && !is_stopped(control, won)) {
+            record_latency(host, took.as_secs_f64());
+        }
+    }
+    res
+}
+
+fn is_stopped(control: Option<&BatchControl>, won: Option<&AtomicBool>) -> bool {
+    control.map_or(false, |c| c.stopped()) || won.map_or(false, |w| w.load(Ordering::Relaxed))
+}
+
+const DUPLICATE_PENDING: u8 = 0;
+const DUPLICATE_SENT: u8 = 1;
+const DUPLICATE_SKIPPED: u8 = 2;
+
+/// The two attempts of a hedged request
+struct HedgeRace {
+    // Set once either attempt succeeded, so the other one stops
+    won: AtomicBool,
+    // Whether the duplicate was sent, or skipped because the first attempt finished before it was due
+    duplicate: AtomicU8,
+}
+
+impl HedgeRace {
+    /// Moves the duplicate out of pending, returns false if it already was
+    fn claim(&self, state: u8) -> bool {
+        self.duplicate
+            .compare_exchange(DUPLICATE_PENDING, state, Ordering::AcqRel, Ordering::Acquire)
+            .is_ok()
+    }
+}
+
+type HedgeJob = Box<dyn FnOnce() + Send>;
+
+/// Runs `job` at `at` on a timer thread shared by every hedged request,
+/// so a thread is only spawned for requests whose duplicate is actually sent
+fn schedule_hedge(at: Instant, job: HedgeJob) {
+    let timer = HEDGE_TIMER.get_or_init(|| {
+        let (tx, rx) = mpsc::channel();
+        thread::spawn(move || run_hedge_timer(rx));
+        Mutex::new(tx)
+    });
+    let _ = timer.lock().unwrap().send((at, job));
+}
+
+fn run_hedge_timer(rx: mpsc::Receiver<(Instant, HedgeJob)>) {
+    let mut pending: Vec<(Instant, HedgeJob)> = Vec::new();
+    loop {
+        let now = Instant::now();
+        let (due, later): (Vec<_>, Vec<_>) = pending.into_iter().partition(|(at, _)| *at <= now);
+        pending = later;
+        for (_, job) in due { job(); }
+
+        let next = match pending.iter().map(|(at, _)| *at).min() {
+            Some(at) => rx.recv_timeout(at.saturating_duration_since(Instant::now())),
+            None => rx.recv().map_err(|_| mpsc::RecvTimeoutError::Disconnected),
+        };
+        match next {
+            Ok(job) => pending.push(job),
+            Err(mpsc::RecvTimeoutError::Timeout) => {}
+            Err(mpsc::RecvTimeoutError::Disconnected) => return,
+        }
+    }
+}
+
+/// The latency samples of the hosts requested most recently
+struct LatencyTable {
+    hosts: HashMap<String, HostLatency>,
+    // Incremented on every use, so the host with the smallest `last_used` is the least recently used
+    clock: u64,
+}
+
+struct HostLatency {
+    samples: VecDeque<f64>,
+    last_used: u64,
+}
+
+fn latency_table() -> MutexGuard<'static, LatencyTable> {
+    HOST_LATENCY
+        .get_or_init(|| Mutex::new(LatencyTable { hosts: HashMap::new(), clock: 0 }))
+        .lock()
+        .unwrap()
+}
+
+pub fn record_latency(host: &str, secs: f64) {
+    let mut table = latency_table();
+    table.clock += 1;
+    let clock = table.clock;
+    if !table.hosts.contains_key(host) && table.hosts.len() >= MAX_HOSTS {
+        let oldest = table.hosts.iter().min_by_key(|(_, h)| h.last_used).map(|(k, _)| k.clone());
+        if let Some(oldest) = oldest { table.hosts.remove(&oldest); }
+    }
+    let entry = table.hosts.entry(host.to_string()).or_insert_with(|| HostLatency {
+        samples: VecDeque::with_capacity(LATENCY_WINDOW),
+        last_used: clock,
+    });
+    entry.last_used = clock;
+    if entry.samples.len() == LATENCY_WINDOW {
+        entry.samples.pop_front();
+    }
+    entry.samples.push_back(secs);
+}
+
+pub fn latency_percentile(host: &str, p: f64) -> Option<f64> {
+    let mut table = latency_table();
+    table.clock += 1;
+    let clock = table.clock;
+    let entry = table.hosts.get_mut(host)?;
+    entry.last_used = clock;
+    if entry.samples.len() < MIN_SAMPLES {
+        return None;
+    }
+    let mut sorted: Vec<f64> = entry.samples.iter().copied().collect();
+    drop(table);
+    sorted.sort_by(|a, b| a.total_cmp(b));
+    let ind = ((sorted.len() as f64 * p).ceil() as usize).clamp(1, sorted.len()) - 1;
+    Some(sorted[ind])
+}
+
+pub fn host_of(url: &str) -> String {
+    url::Url::parse(url)
+        .ok()
+        .and_then(|u| u.host_str().map(|h| h.to_ascii_lowercase()))
+        .unwrap_or_default()
+}
+
+/// Only requests without side effects are duplicated
+fn is_safe(method: &Method) -> bool {
+    matches!(*method, Method::GET | Method::HEAD | Method::OPTIONS | Method::TRACE)
+}
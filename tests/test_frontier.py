@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("pygrab_ll")
+
+from pygrab import frontier as frontier_module
+from pygrab.frontier import Frontier
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.fixture
+def frontier(tmp_path, monkeypatch):
+    monkeypatch.setattr(frontier_module, 'HttpResponse', FakeResponse)
+    with Frontier(str(tmp_path / "frontier.db"), batch_size=2) as frontier:
+        yield frontier
+
+
+def test_failed_add_is_rolled_back(frontier):
+    frontier.add(["https://example.com/0"])
+    with pytest.raises(Exception):
+        # sqlite can't bind a list, so the insert fails halfway through the chunk
+        frontier.add(["https://example.com/1", ["https://example.com/2"]])
+
+    assert frontier.add(["https://example.com/1", "https://example.com/3"]) == 2
+    assert frontier.stats()['pending'] == 3
+
+
+def test_run_after_failed_checkpoint(frontier, monkeypatch):
+    frontier.add([f"https://example.com/{i}" for i in range(3)])
+
+    # A status code sqlite can't bind makes the checkpoint fail
+    monkeypatch.setattr(frontier_module, '_get_batch', lambda urls, **kwargs: [FakeResponse(object()) for _ in urls])
+    with pytest.raises(Exception):
+        frontier.run(max_batches=1)
+
+    monkeypatch.setattr(frontier_module, '_get_batch', lambda urls, **kwargs: [FakeResponse(200) for _ in urls])
+    stats = frontier.run()
+    # The urls of the failed batch stay in flight until the frontier is reopened
+    assert stats == {'pending': 0, 'in_flight': 2, 'done': 1, 'failed': 0}
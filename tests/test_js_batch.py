@@ -0,0 +1,72 @@
+import pytest
+
+pytest.importorskip("pygrab_ll")
+
+import pygrab
+from pygrab import js_scraper as js_module
+from pygrab.js_scraper import js_scraper
+
+
+class FakeDocument:
+    status = 200
+    headers = {'Content-Type': 'text/html', 'Content-Length': '10'}
+
+
+class FakePage:
+    def __init__(self):
+        self.url = None
+
+    async def goto(self, url, **kwargs):
+        self.url = url
+        return FakeDocument()
+
+    async def content(self):
+        return f"<html><body>{self.url}</body></html>"
+
+    async def close(self):
+        pass
+
+
+class FakeBrowser:
+    async def newPage(self):
+        return FakePage()
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_browser(monkeypatch):
+    async def launch(**kwargs):
+        return FakeBrowser()
+
+    monkeypatch.setattr(js_module, 'pyppeteer_working', True)
+    monkeypatch.setattr(js_module, '_launch', launch)
+    monkeypatch.setattr(js_scraper, 'browser_reg', None)
+    monkeypatch.setattr(js_scraper, 'cleanup_registered', True)
+
+
+def test_js_batch_renders_every_url(fake_browser):
+    urls = [f"https://example.com/{i}" for i in range(5)]
+    result = pygrab.get_batch(urls, enable_js=True, thread_limit=2)
+
+    assert list(result) == urls
+    for url, res in result.items():
+        assert res.status_code == 200
+        assert res.url == url
+        assert res.text == f"<html><body>{url}</body></html>"
+        assert 'content-length' not in res.headers
+
+
+def test_js_batch_reports_progress_across_chunks(fake_browser):
+    urls = [f"https://example.com/{i}" for i in range(5)]
+    reports = []
+    result = pygrab.get_batch(
+        urls, enable_js=True, ordered=True, thread_limit=2, deadline=30,
+        cancel=pygrab.CancelToken(), progress=lambda *counts: reports.append(counts),
+    )
+
+    assert [res.url for res in result] == urls
+    completed, failed, received = reports[-1]
+    assert (completed, failed) == (5, 0)
+    assert received == sum(len(res.content) for res in result)